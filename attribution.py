@@ -0,0 +1,96 @@
+# attribution.py
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from typing import Dict
+from db import connect, transaction
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deep_link_hits (
+    payload TEXT NOT NULL,
+    event TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (payload, event)
+);
+"""
+
+FLUSH_INTERVAL = float(os.getenv("ATTRIBUTION_FLUSH_INTERVAL", 30))
+MAX_PAYLOADS = int(os.getenv("ATTRIBUTION_MAX_PAYLOADS", 1000))
+OTHER_PAYLOAD = "other"  # unrecognised payloads, and new ones past MAX_PAYLOADS
+
+
+class AttributionCounter:
+    """
+    Counts deep-link events (e.g. "open", "checkout") per /start payload.
+    Hits only bump an in-memory counter; a background thread adds the
+    accumulated counts to SQLite in one transaction per interval. At most
+    max_payloads distinct payloads are tracked; later ones are counted under
+    OTHER_PAYLOAD, so the table can't be grown without bound.
+    """
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL, max_payloads: int = MAX_PAYLOADS):
+        self.flush_interval = flush_interval
+        self.max_payloads = max_payloads
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        connect().executescript(SCHEMA)
+        self._known = {row[0] for row in connect().execute("SELECT DISTINCT payload FROM deep_link_hits")}
+
+    def hit(self, payload: str, event: str = "open"):
+        with self._lock:
+            if payload not in self._known:
+                if len(self._known) >= self.max_payloads:
+                    payload = OTHER_PAYLOAD
+                self._known.add(payload)
+            self._counts[(payload, event)] += 1
+
+    def start(self):
+        threading.Thread(target=self._run, name="attribution-flush", daemon=True).start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        if not counts:
+            return
+        now = time.time()
+        conn = connect()
+        try:
+            with transaction(conn):
+                conn.executemany(
+                    "INSERT INTO deep_link_hits (payload, event, count, last_seen) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(payload, event) DO UPDATE SET count = count + excluded.count, "
+                    "last_seen = excluded.last_seen",
+                    [(payload, event, n, now) for (payload, event), n in counts.items()])
+        except Exception:
+            logger.exception("Attribution flush failed; will retry")
+            with self._lock:
+                self._counts.update(counts)
+            return
+        metrics.incr("attribution.rows_written", len(counts))
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+    def totals(self) -> Dict[str, Dict[str, int]]:
+        """payload -> {event: count}, flushed and unflushed."""
+        with self._lock:
+            pending = dict(self._counts)
+        totals: Dict[str, Dict[str, int]] = {}
+        for row in connect().execute("SELECT payload, event, count FROM deep_link_hits"):
+            totals.setdefault(row["payload"], {})[row["event"]] = row["count"]
+        for (payload, event), n in pending.items():
+            events = totals.setdefault(payload, {})
+            events[event] = events.get(event, 0) + n
+        return totals
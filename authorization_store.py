@@ -0,0 +1,54 @@
+# authorization_store.py
+import time
+import logging
+from typing import Dict, Any, Optional
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS saved_authorizations (
+    user_id INTEGER PRIMARY KEY,
+    email TEXT NOT NULL,
+    authorization_code TEXT NOT NULL,
+    signature TEXT,
+    card_type TEXT,
+    last4 TEXT,
+    exp_month TEXT,
+    exp_year TEXT,
+    bank TEXT,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class AuthorizationStore:
+    """
+    Reusable Paystack card authorizations, one per Telegram user. Written by
+    whichever process verifies a payment, read by the bot for one-tap checkout.
+    """
+
+    def __init__(self):
+        connect().executescript(SCHEMA)
+
+    def save(self, user_id: int, email: str, authorization: Dict[str, Any]) -> bool:
+        if not authorization.get("reusable") or not authorization.get("authorization_code"):
+            return False
+        if authorization.get("channel", "card") != "card":
+            return False
+        connect().execute(
+            "INSERT OR REPLACE INTO saved_authorizations "
+            "(user_id, email, authorization_code, signature, card_type, last4, exp_month, exp_year, bank, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (int(user_id), email.lower(), authorization["authorization_code"], authorization.get("signature"),
+             (authorization.get("card_type") or "card").strip(), authorization.get("last4"),
+             authorization.get("exp_month"), authorization.get("exp_year"), authorization.get("bank"),
+             time.time()))
+        return True
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        row = connect().execute("SELECT * FROM saved_authorizations WHERE user_id = ?", (int(user_id),)).fetchone()
+        return dict(row) if row else None
+
+    def delete(self, user_id: int):
+        connect().execute("DELETE FROM saved_authorizations WHERE user_id = ?", (int(user_id),))
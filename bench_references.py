@@ -0,0 +1,49 @@
+# bench_references.py
+"""
+Compares uuid4 and time-ordered references as a SQLite TEXT primary key:
+insert throughput and on-disk size of the table plus its index.
+
+    python bench_references.py [rows] [batch]
+"""
+import os
+import sys
+import time
+import uuid
+import sqlite3
+import tempfile
+from references import new_reference
+
+
+def bench(name, make_reference, rows, batch):
+    path = os.path.join(tempfile.mkdtemp(), f"{name}.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE pending (reference TEXT PRIMARY KEY, user_id INTEGER, created_at REAL)")
+    started = time.perf_counter()
+    for start in range(0, rows, batch):
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO pending VALUES (?, ?, ?)",
+                         ((make_reference(), i, time.time()) for i in range(start, min(rows, start + batch))))
+        conn.execute("COMMIT")
+    elapsed = time.perf_counter() - started
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    sample = conn.execute("SELECT reference FROM pending LIMIT 1").fetchone()[0]
+    conn.close()
+    os.remove(path)
+    return {"name": name, "rows_per_s": rows / elapsed, "mb": pages * page_size / 1e6, "sample": sample}
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 1_000
+    print(f"{rows} rows, {batch} per transaction")
+    for result in (bench("uuid4", lambda: str(uuid.uuid4()), rows, batch),
+                   bench("ordered", new_reference, rows, batch)):
+        print(f"{result['name']:>8}: {result['rows_per_s']:>10,.0f} rows/s  {result['mb']:7.1f} MB  "
+              f"e.g. {result['sample']}")
+
+
+if __name__ == "__main__":
+    main()
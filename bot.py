@@ -1,81 +1,1171 @@
 # bot.py
 import os
-import uuid
+import re
+import time
+import datetime
 import logging
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot
-from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, CallbackContext
-from paystack_handler import PaystackHandler
-from product_service import ProductService
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Bot, LabeledPrice
+from telegram.ext import (Updater, CommandHandler, InlineQueryHandler, CallbackQueryHandler, CallbackContext,
+                          ConversationHandler, MessageHandler, Filters, PreCheckoutQueryHandler, JobQueue)
+from telegram.utils.request import Request
+from queue import Queue
+from paystack_handler import (PaystackHandler, MOBILE_MONEY_PROVIDER, CHARGE_SUCCESS, CHARGE_SEND_OTP,
+                              CHARGE_WAITING, CART_PRODUCT_ID)
+from mpesa_handler import MpesaHandler
+from product_service import ProductService, BASE_CURRENCY, format_minor, to_minor_units
+from link_prober import LinkProber
+from metrics import serve_metrics, metrics
+from sqlite_persistence import SQLitePersistence
+from delivery import deliver_products, TELEGRAM_TIMEOUT
+from delivery_outbox import DeliveryOutbox
+from chat_scheduler import ChatScheduler, OrderedDispatcher
+from deadline import timed_call
+from logging_setup import setup_logging
+from leader_lease import LeaderLease
+from broadcast import BroadcastEngine
+from pending_store import PendingPayments
+from timer_scheduler import TimerScheduler
+from rate_limiter import TokenBucket
+from references import new_reference
+from attribution import AttributionCounter, OTHER_PAYLOAD
+from product_search import ProductSearch
+from inventory import Inventory
+from coupons import CouponBook
+from subscriptions import Entitlements, ACTIVE, PAST_DUE, CANCELLED
+from telegram.error import TelegramError, BadRequest
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
-paystack = PaystackHandler()
 product_service = ProductService()
+paystack = PaystackHandler(product_service)  # shared, so a catalog reload reprices checkout too
+mpesa = MpesaHandler()
+link_prober = LinkProber(product_service)
+broadcasts = None  # BroadcastEngine, created in main() once this instance is the poller
 
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 CALLBACK_URL = os.getenv("PAYSTACK_CALLBACK_URL")  # must be set
+HIDE_BROKEN_PRODUCTS = os.getenv("HIDE_BROKEN_PRODUCTS", "1") == "1"  # else flag them
+METRICS_PORT = os.getenv("METRICS_PORT")
+MOBILE_MONEY_POLL_INTERVAL = float(os.getenv("MOBILE_MONEY_POLL_INTERVAL", 5))
+MOBILE_MONEY_TIMEOUT = float(os.getenv("MOBILE_MONEY_TIMEOUT", 180))
+PAYMENT_PROVIDER_TOKEN = os.getenv("TELEGRAM_PAYMENT_PROVIDER_TOKEN")  # enables in-Telegram checkout
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# generous by default: a payment that lands after expiry finds no session and isn't delivered
+PENDING_PAYMENT_TTL = float(os.getenv("PENDING_PAYMENT_TTL", 24 * 3600))
+CHECKOUT_REMINDER_AFTER = float(os.getenv("CHECKOUT_REMINDER_AFTER", 1800))  # 0 disables reminders
+CHECKOUT_REMINDER_RATE = float(os.getenv("CHECKOUT_REMINDER_RATE", 5))  # reminders per second
+INLINE_PAGE_SIZE = 20  # Telegram accepts up to 50 results per answer
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 60))  # seconds Telegram may reuse an answer
+SUBSCRIPTION_REMINDER_DAYS = float(os.getenv("SUBSCRIPTION_REMINDER_DAYS", 3))  # notice before access ends
+SUBSCRIPTION_NOTIFY_RATE = float(os.getenv("SUBSCRIPTION_NOTIFY_RATE", 5))  # reminders/revocations per second
+SUBSCRIPTION_SWEEP_HOUR = int(os.getenv("SUBSCRIPTION_SWEEP_HOUR", 9))  # UTC hour of the daily sweep
+SUBSCRIPTION_BATCH = 200  # entitlements claimed per transaction
+OUTBOX_SWEEP_INTERVAL = 30
+MPESA_RECHECK_AFTER = float(os.getenv("MPESA_RECHECK_AFTER", 60))  # callback's chance before we query Daraja
+MPESA_REQUEST_TTL = float(os.getenv("MPESA_REQUEST_TTL", 3600))  # give up on a request unconfirmed this long
+MPESA_SWEEP_INTERVAL = 60
+MPESA_SWEEP_BATCH = 50
+OUTBOX_BATCH = 50
 
 if not TELEGRAM_BOT_TOKEN:
     raise SystemExit("Missing TELEGRAM_BOT_TOKEN env var")
 
 bot = Bot(token=TELEGRAM_BOT_TOKEN)
-PENDING_PAYMENTS = {}  # reference -> {user_id, product_id}
+PENDING_PAYMENTS = PendingPayments(ttl=PENDING_PAYMENT_TTL)  # reference -> {user_id, product_id}, shared with server.py
+pending_timers = TimerScheduler("pending_timers")
+reminder_bucket = TokenBucket(CHECKOUT_REMINDER_RATE)
+attribution = AttributionCounter()
+product_search = ProductSearch(product_service)
+_menu_cache = {}  # (catalog version, link health version) -> InlineKeyboardMarkup
+inventory = Inventory()
+inventory.sync(product_service.get_products())
+coupons = CouponBook()  # rules loaded in main() once elected
+entitlements = Entitlements()  # shared with server.py, which grants and renews from webhooks
+subscription_bucket = TokenBucket(SUBSCRIPTION_NOTIFY_RATE)
+outbox = DeliveryOutbox()  # paid deliveries still to send, queued by the bot and server.py
+
+# conversation states
+ASK_EMAIL, ASK_PHONE, ASK_OTP, ASK_COUPON = range(4)
+
+SOLD_OUT_MESSAGE = "😔 Sorry, this product is sold out. Tap /start to see what's available."
+RESERVATION_SWEEP_INTERVAL = 30
+CART_MAX_ITEMS = 10
+CART_ADD_BUTTONS = 20  # products offered on the cart screen; keeps the keyboard small
+
+EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[A-Za-z]{2,}$")
+KE_PHONE_RE = re.compile(r"^(?:\+?254|0)?([17]\d{8})$")
+
+# product buttons carry the bare product id; other buttons use "<action>:<arg>"
+PRODUCT_PATTERN = r"^[^:]+$"
+
+def _reply(update: Update, text: str, **kwargs):
+    # edit the tapped message for button presses, reply for typed messages
+    if update.callback_query:
+        return timed_call("telegram.send", TELEGRAM_TIMEOUT, update.callback_query.edit_message_text, text, **kwargs)
+    return timed_call("telegram.send", TELEGRAM_TIMEOUT, update.effective_message.reply_text, text, **kwargs)
+
+def _alt_payment_buttons(product_id: str):
+    rows = []
+    if MOBILE_MONEY_PROVIDER:
+        rows.append([InlineKeyboardButton("📱 Pay with M-Pesa (no browser)", callback_data=f"paymm:{product_id}")])
+    if PAYMENT_PROVIDER_TOKEN:
+        rows.append([InlineKeyboardButton("✈️ Pay inside Telegram", callback_data=f"payinvoice:{product_id}")])
+    return rows
+
+def _normalize_phone(text: str):
+    match = KE_PHONE_RE.match(re.sub(r"[\s-]", "", text))
+    return f"+254{match.group(1)}" if match else None
+
+def _parse_start_payload(payload: str) -> dict:
+    """
+    Deep-link payloads (t.me/<bot>?start=...) are "__"-separated parts:
+    "buy_<product_id>" opens checkout directly, "ref_<tag>" tags the source,
+    "promo_<code>" applies a coupon, e.g. "buy_3__ref_channel__promo_SALE".
+    Returns {kind: value}.
+    """
+    parts = {}
+    for part in filter(None, payload.split("__")):
+        kind, _, value = part.partition("_")
+        if kind in ("buy", "ref", "promo") and value:
+            parts[kind] = value
+    return parts
+
+def _attribution_key(parts: dict) -> str:
+    # only recognised parts count: a known product and the ref tag. Promo codes stay out of the stats
+    key = "__".join(f"{kind}_{parts[kind]}" for kind in ("buy", "ref")
+                    if parts.get(kind) and (kind != "buy" or product_service.get_product(parts[kind])))
+    return key or OTHER_PAYLOAD
 
 def start(update: Update, context: CallbackContext):
-    products = product_service.get_products()
+    payload = context.args[0][:64] if context.args else ""
+    if payload:
+        parts = _parse_start_payload(payload)
+        key = _attribution_key(parts)
+        attribution.hit(key)
+        context.user_data["deep_link"] = key
+        if parts.get("ref"):
+            context.user_data["ref"] = parts["ref"]
+        if parts.get("promo"):
+            context.user_data["coupon"] = parts["promo"]
+        product_id = parts.get("buy")
+        if product_id and product_service.get_product(product_id) and link_prober.is_healthy(product_id):
+            return _begin_checkout(update, context, product_id)
+
+    note = "🏷 Your promo code will be applied at checkout.\n\n" if context.user_data.get("coupon") else ""
+    update.message.reply_text(f"{note}Available products:", reply_markup=_menu_markup())
+    return ConversationHandler.END
+
+def _menu_markup() -> InlineKeyboardMarkup:
+    # rebuilt only when the catalog or a product's link health changes
+    key = (product_service.version, link_prober.health_version)
+    markup = _menu_cache.get(key)
+    if markup is not None:
+        return markup
     keyboard = []
-    for p in products:
-        keyboard.append([InlineKeyboardButton(f"{p['name']} — KES {p['price']}", callback_data=p['id'])])
-    update.message.reply_text("Available products:", reply_markup=InlineKeyboardMarkup(keyboard))
+    for p in product_service.get_products():
+        label = f"{p['name']} — {_price_label(p)}"
+        # health comes from the background prober; nothing is checked here
+        if not link_prober.is_healthy(p['id']):
+            if HIDE_BROKEN_PRODUCTS:
+                continue
+            label = f"⚠️ {label} (delivery delayed)"
+        keyboard.append([InlineKeyboardButton(label, callback_data=p['id'])])
+    keyboard.append([InlineKeyboardButton("🛒 Cart", callback_data="cart:show")])
+    markup = InlineKeyboardMarkup(keyboard)
+    _menu_cache.clear()
+    _menu_cache[key] = markup
+    return markup
+
+def _price_label(product: dict) -> str:
+    label = product["price_label"]
+    return f"{label} every {product['period_days']} days" if product.get("plan_code") else label
+
+def _format_day(epoch: float) -> str:
+    return time.strftime("%d %b %Y", time.gmtime(epoch))
+
+def _on_catalog_change(changed_ids):
+    # runs on the catalog watcher thread: do the expensive rebuilds here, not in handlers
+    _menu_cache.clear()
+    inventory.sync(filter(None, map(product_service.get_product, changed_ids)))
+    link_prober.on_catalog_change(changed_ids)
+    product_search.index()
+
+product_service.add_listener(_on_catalog_change)
 
 def button(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     product_id = query.data
+    if not product_service.get_product(product_id):
+        query.edit_message_text("Product not found.")
+        return ConversationHandler.END
+    return _begin_checkout(update, context, product_id)
+
+def _begin_checkout(update: Update, context: CallbackContext, product_id: str):
+    # ask for an email once; afterwards checkout goes straight to Paystack
+    if not context.user_data.get("email"):
+        context.user_data["checkout_product_id"] = product_id
+        _reply(update, "📧 Please send the email address for your payment receipt (or /cancel):")
+        return ASK_EMAIL
+    return checkout(update, context, product_id)
+
+def ask_email(update: Update, context: CallbackContext):
+    current = context.user_data.get("email")
+    note = f"Current email: {current}\n" if current else ""
+    update.message.reply_text(f"{note}📧 Send the email address for your payment receipts (or /cancel):")
+    return ASK_EMAIL
+
+def receive_email(update: Update, context: CallbackContext):
+    email = update.message.text.strip().lower()
+    if not EMAIL_RE.match(email):
+        update.message.reply_text("That doesn't look like a valid email address. Please try again, or /cancel.")
+        return ASK_EMAIL
+
+    context.user_data["email"] = email
+    context.user_data.pop("paystack_customer_code", None)
+    customer = paystack.get_or_create_customer(email)
+    if customer.get("ok"):
+        context.user_data["paystack_customer_code"] = customer["data"]["customer_code"]
+    else:
+        # not fatal: Paystack also matches customers by email at checkout
+        logger.warning("Could not create Paystack customer for user %s: %s",
+                       update.effective_user.id, customer.get("error"))
+
+    product_id = context.user_data.pop("checkout_product_id", None)
+    if product_id:
+        return checkout(update, context, product_id)
+    if context.user_data.pop("checkout_cart", None):
+        return checkout_cart(update, context)
+    product_id = context.user_data.get("mobile_money_product_id")
+    if product_id:
+        if not context.user_data.get("phone"):
+            update.message.reply_text("📱 Now send the M-Pesa phone number to charge, e.g. 0712345678 (or /cancel):")
+            return ASK_PHONE
+        context.user_data.pop("mobile_money_product_id")
+        return charge_mobile_money(update, context, product_id)
+    update.message.reply_text(f"✅ Email saved: {email}")
+    return ConversationHandler.END
+
+def cancel(update: Update, context: CallbackContext):
+    otp_charge = context.user_data.get("otp_charge")
+    if otp_charge:
+        # the charge can't complete without the OTP: drop its pending entry and give the stock back
+        PENDING_PAYMENTS.discard(otp_charge["reference"])
+        _release_holds(otp_charge["reference"])
+    for key in ("checkout_product_id", "mobile_money_product_id", "otp_charge", "coupon_product_id",
+                "checkout_cart"):
+        context.user_data.pop(key, None)
+    update.message.reply_text("Cancelled. Send /start to see the products again.")
+    return ConversationHandler.END
+
+def checkout(update: Update, context: CallbackContext, product_id: str, offer_saved_card: bool = True):
+    user_id = update.effective_user.id
     product = product_service.get_product(product_id)
     if not product:
-        query.edit_message_text("Product not found.")
-        return
+        _reply(update, "Product not found.")
+        return ConversationHandler.END
+
+    subscription = bool(product.get("plan_code"))
+    if subscription:
+        current = entitlements.active(user_id, product_id)
+        if current and current["status"] == ACTIVE and current["subscription_code"]:
+            _reply(update, f"✅ You're subscribed to *{product['name']}*; it renews on "
+                           f"{_format_day(current['expires_at'])}.", parse_mode="Markdown")
+            return ConversationHandler.END
+
+    email = context.user_data["email"]
+    coupon_code = context.user_data.get("coupon")
+    # one-tap charges the full price, so a pending promo code goes through the payment link;
+    # a subscription needs the hosted checkout so Paystack can attach the plan
+    card = paystack.get_saved_authorization(user_id) if offer_saved_card and not coupon_code \
+        and not subscription else None
+    if card and card["email"] == email:
+        # returning buyer: confirm in-chat and charge server-side, no redirect
+        keyboard = [
+            [InlineKeyboardButton(f"💳 Pay {product['price_label']} with {card['card_type'].upper()} •••• {card['last4']}",
+                                  callback_data=f"paycard:{product_id}")],
+            [InlineKeyboardButton("🌐 Pay another way", callback_data=f"paylink:{product_id}")],
+        ] + _alt_payment_buttons(product_id)
+        _reply(update, f"Buy *{product['name']}*?", parse_mode="Markdown",
+               reply_markup=InlineKeyboardMarkup(keyboard))
+        return ConversationHandler.END
 
-    reference = str(uuid.uuid4())
-    # For now using placeholder email; you can ask user for email later.
-    email = (query.from_user.username or f"user{query.from_user.id}") + "@example.com"
+    reference = new_reference()
+    metadata = {"user_id": user_id}
+    if context.user_data.get("paystack_customer_code"):
+        metadata["customer_code"] = context.user_data["paystack_customer_code"]
+    if context.user_data.get("ref"):
+        metadata["ref"] = context.user_data["ref"]
+    if context.user_data.get("deep_link"):
+        # counted once per deep-link visit; later organic checkouts aren't attributed to it
+        attribution.hit(context.user_data.pop("deep_link"), "checkout")
+
+    # hold a unit of limited stock before Paystack is involved; released if this attempt fails
+    if not inventory.reserve(product_id, reference, user_id):
+        _reply(update, SOLD_OUT_MESSAGE)
+        return ConversationHandler.END
+    # a new link replaces the one sent before; give back what that one held
+    previous = context.user_data.pop("open_checkout", None)
+    if previous:
+        _release_holds(previous)
+
+    amount_minor, coupon_note = product["amount_minor"], ""
+    if context.user_data.pop("coupon", None):
+        # quoted from memory; only the redemption counter touches SQLite
+        coupon = coupons.quote(coupon_code, product)
+        if coupon.get("ok"):
+            discount = coupon["data"]["discount_minor"]
+            coupon = coupons.redeem(coupon_code, reference, user_id)
+        if coupon.get("ok"):
+            amount_minor -= discount
+            metadata["coupon"] = coupon_code.upper()
+            coupon_note = f"🏷 Code `{coupon_code.upper()}`: −{format_minor(discount, product['currency'])}\n"
+        else:
+            coupon_note = f"🏷 {coupon['detail']} Charging the full price.\n"
 
     # initialize payment with structured response
-    result = paystack.initialize_payment(email=email, product_id=product_id, reference=reference, callback_url=CALLBACK_URL)
+    result = paystack.initialize_payment(email=email, product_id=product_id, reference=reference,
+                                         callback_url=CALLBACK_URL, metadata=metadata, amount_minor=amount_minor)
+    if not result.get("ok"):
+        _release_holds(reference)
+
+    if result.get("error") == "paystack_unavailable" and mpesa.configured and not subscription:
+        # Paystack is degraded (breaker open): route to direct M-Pesa instead
+        if not context.user_data.get("phone"):
+            context.user_data["mobile_money_product_id"] = product_id
+            _reply(update, f"{result['detail']}\n\n📱 You can pay with M-Pesa instead. "
+                           "Send your M-Pesa phone number, e.g. 0712345678 (or /cancel):")
+            return ASK_PHONE
+        return mpesa_fallback(update, context, product_id)
 
     if not result.get("ok"):
         # detailed error — send to user and log
         err = result.get("error")
         detail = result.get("detail")
-        logger.error("Paystack init error for user %s product %s: %s %s", query.from_user.id, product_id, err, detail)
+        logger.error("Paystack init error for user %s product %s: %s %s", user_id, product_id, err, detail)
         # Surface a short friendly message plus the error code so you can debug.
-        query.edit_message_text(
-            f"❌ Failed to create payment.\nReason: {err}\nDetails: {str(detail)}"
-        )
-        return
+        _reply(update, f"❌ Failed to create payment.\nReason: {err}\nDetails: {str(detail)}")
+        return ConversationHandler.END
 
     data = result.get("data", {})
     auth_url = data.get("authorization_url")
     ref = data.get("reference", reference)
 
-    # store pending
-    PENDING_PAYMENTS[ref] = {"user_id": query.from_user.id, "product_id": product_id}
+    # store pending; it expires, and gets one reminder if still unpaid
+    PENDING_PAYMENTS[ref] = {"user_id": user_id, "product_id": product_id}
+    _schedule_pending_timers(context.bot, ref, PENDING_PAYMENTS[ref])
+    context.user_data["open_checkout"] = ref
+
+    # Send the link clearly, with the in-chat alternatives underneath
+    price_label = _price_label(product) if amount_minor == product["amount_minor"] \
+        else format_minor(amount_minor, product["currency"])
+    # M-Pesa and Telegram invoices are one-off charges; they can't start a subscription
+    buttons = [] if subscription else _alt_payment_buttons(product_id)
+    if not metadata.get("coupon") and not subscription:
+        buttons.append([InlineKeyboardButton("🏷 Have a code?", callback_data=f"promo:{product_id}")])
+    _reply(update,
+           f"{coupon_note}🔗 Open this link to pay for *{product['name']}* ({price_label}):\n\n{auth_url}",
+           parse_mode="Markdown",
+           reply_markup=InlineKeyboardMarkup(buttons))
+    return ConversationHandler.END
+
+def _release_holds(reference: str):
+    # stock and coupon uses held for a payment that won't happen
+    inventory.release(reference)
+    coupons.release(reference)
+
+def ask_coupon(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    context.user_data["coupon_product_id"] = query.data.split(":", 1)[1]
+    query.edit_message_text("🏷 Send your promo code (or /cancel):")
+    return ASK_COUPON
+
+def receive_coupon(update: Update, context: CallbackContext):
+    code = update.message.text.strip()
+    product_id = context.user_data.get("coupon_product_id")
+    product = product_service.get_product(product_id) if product_id else None
+    if not product:
+        return ConversationHandler.END
+    quote = coupons.quote(code, product)
+    if not quote.get("ok"):
+        update.message.reply_text(f"{quote['detail']} Try another code, or /cancel.")
+        return ASK_COUPON
+    context.user_data.pop("coupon_product_id")
+    context.user_data["coupon"] = code
+    # a fresh link at the new price; the old one's holds are released in checkout
+    return checkout(update, context, product_id, offer_saved_card=False)
+
+def _cart_items(context: CallbackContext) -> list:
+    # the cart is a list of product ids in user_data (persisted); ids gone from the catalog drop out
+    cart = [pid for pid in context.user_data.get("cart", []) if product_service.get_product(pid)]
+    context.user_data["cart"] = cart
+    return cart
+
+def _cart_view(context: CallbackContext):
+    cart = _cart_items(context)
+    products = [product_service.get_product(pid) for pid in cart]
+    keyboard = [[InlineKeyboardButton(f"❌ {p['name']}", callback_data=f"cart:rm:{p['id']}")] for p in products]
+    if products:
+        # one Paystack transaction has one currency, so only offer products priced like the cart
+        currency = products[0]["currency"]
+        total = format_minor(sum(p["amount_minor"] for p in products), currency)
+        text = "🛒 Your cart:\n" + "\n".join(f"• {p['name']} — {p['price_label']}" for p in products) \
+            + f"\n\nTotal: {total}"
+    else:
+        currency, text = None, "🛒 Your cart is empty. Add products below."
+    if len(cart) < CART_MAX_ITEMS:
+        addable = [p for p in product_service.get_products()
+                   if p["id"] not in cart and link_prober.is_healthy(p["id"]) and not p.get("plan_code")
+                   and currency in (None, p["currency"])][:CART_ADD_BUTTONS]
+        keyboard += [[InlineKeyboardButton(f"➕ {p['name']} — {p['price_label']}", callback_data=f"cart:add:{p['id']}")]
+                     for p in addable]
+    if products:
+        keyboard.append([InlineKeyboardButton("💳 Checkout", callback_data="cart:pay"),
+                         InlineKeyboardButton("🗑 Clear", callback_data="cart:clear")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+def cart_command(update: Update, context: CallbackContext):
+    text, markup = _cart_view(context)
+    update.message.reply_text(text, reply_markup=markup)
+
+def cart_button(update: Update, context: CallbackContext):
+    # add/remove/clear edit the cart message in place
+    query = update.callback_query
+    _, action, product_id = (query.data.split(":", 2) + [""])[:3]
+    cart = _cart_items(context)
+    product = product_service.get_product(product_id) if product_id else None
+    if action == "add" and product and product_id not in cart and not product.get("plan_code"):
+        if len(cart) >= CART_MAX_ITEMS:
+            query.answer(f"A cart holds up to {CART_MAX_ITEMS} items.", show_alert=True)
+            return
+        cart.append(product_id)
+    elif action == "rm" and product_id in cart:
+        cart.remove(product_id)
+    elif action == "clear":
+        cart.clear()
+    query.answer()
+    text, markup = _cart_view(context)
+    try:
+        _reply(update, text, reply_markup=markup)
+    except BadRequest as e:
+        # a double tap leaves the message unchanged, which Telegram reports as an error
+        if "not modified" not in str(e):
+            raise
+
+def pay_cart(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    if not context.user_data.get("email"):
+        context.user_data["checkout_cart"] = True
+        query.edit_message_text("📧 Please send the email address for your payment receipt (or /cancel):")
+        return ASK_EMAIL
+    return checkout_cart(update, context)
+
+def checkout_cart(update: Update, context: CallbackContext):
+    """Every item in the cart in one Paystack transaction, with one unit of stock held per line."""
+    user_id = update.effective_user.id
+    cart = _cart_items(context)
+    if not cart:
+        _reply(update, "🛒 Your cart is empty. Send /cart to add products.")
+        return ConversationHandler.END
+
+    reference = new_reference()
+    metadata = {"user_id": user_id}
+    if context.user_data.get("paystack_customer_code"):
+        metadata["customer_code"] = context.user_data["paystack_customer_code"]
+    if context.user_data.get("ref"):
+        metadata["ref"] = context.user_data["ref"]
+    if context.user_data.get("deep_link"):
+        attribution.hit(context.user_data.pop("deep_link"), "checkout")
+
+    # each line is held under "<reference>/<product_id>", so the reference alone releases or commits them all
+    for product_id in cart:
+        if not inventory.reserve(product_id, f"{reference}/{product_id}", user_id):
+            _release_holds(reference)
+            text, markup = _cart_view(context)
+            _reply(update, f"😔 {product_service.get_product(product_id)['name']} is sold out; "
+                           f"remove it to check out.\n\n{text}", reply_markup=markup)
+            return ConversationHandler.END
+    previous = context.user_data.pop("open_checkout", None)
+    if previous:
+        _release_holds(previous)
+
+    result = paystack.initialize_cart_payment(email=context.user_data["email"], product_ids=cart,
+                                              reference=reference, callback_url=CALLBACK_URL, metadata=metadata)
+    if not result.get("ok"):
+        _release_holds(reference)
+        logger.error("Paystack cart init error for user %s: %s %s", user_id, result.get("error"), result.get("detail"))
+        _reply(update, f"❌ Failed to create payment.\nReason: {result.get('error')}\nDetails: {result.get('detail')}")
+        return ConversationHandler.END
+
+    data = result.get("data", {})
+    ref = data.get("reference", reference)
+    PENDING_PAYMENTS[ref] = {"user_id": user_id, "product_id": CART_PRODUCT_ID}
+    _schedule_pending_timers(context.bot, ref, PENDING_PAYMENTS[ref])
+    context.user_data["open_checkout"] = ref
+
+    products = [product_service.get_product(pid) for pid in cart]
+    total = format_minor(sum(p["amount_minor"] for p in products), products[0]["currency"])
+    summary = "\n".join(f"• {p['name']} — {p['price_label']}" for p in products)
+    # the link is the order now; the cart starts over
+    context.user_data["cart"] = []
+    _reply(update, f"🔗 Open this link to pay {total} for {len(products)} items:\n{summary}\n\n"
+                   f"{data.get('authorization_url')}", disable_web_page_preview=True)
+    return ConversationHandler.END
+
+def _schedule_pending_timers(bot: Bot, reference: str, entry: dict):
+    pending_timers.schedule(("expire", reference), entry["expires_at"], lambda: _expire_pending(reference))
+    remind_at = entry["created_at"] + CHECKOUT_REMINDER_AFTER
+    if CHECKOUT_REMINDER_AFTER and not entry["reminded"] and remind_at < entry["expires_at"]:
+        pending_timers.schedule(("remind", reference), remind_at, lambda: _remind_pending(bot, reference))
+
+def _expire_pending(reference: str):
+    if PENDING_PAYMENTS.discard(reference):
+        metrics.incr("pending_payments.expired")
+    _release_holds(reference)
+
+def _remind_pending(bot: Bot, reference: str):
+    # claimed in SQLite, so a restart between claim and send never reminds twice
+    entry = PENDING_PAYMENTS.claim_reminder(reference)
+    if not entry or PENDING_PAYMENTS.superseded(entry):
+        return
+    product = product_service.get_product(entry["product_id"])
+    if not product:
+        return
+    reminder_bucket.acquire()
+    try:
+        # the button re-enters checkout, which creates a fresh payment link
+        timed_call("telegram.send", TELEGRAM_TIMEOUT, bot.send_message, chat_id=entry["user_id"],
+                   text=f"🛒 You didn't finish buying *{product['name']}* ({product['price_label']}).",
+                   parse_mode="Markdown",
+                   reply_markup=InlineKeyboardMarkup(
+                       [[InlineKeyboardButton("💳 Pay now", callback_data=entry["product_id"])]]))
+        metrics.incr("pending_payments.reminded")
+    except TelegramError as e:
+        logger.info("Checkout reminder to user %s not sent: %s", entry["user_id"], e)
+
+def _notify_subscriber(bot: Bot, entry: dict, text: str, button: InlineKeyboardButton = None) -> bool:
+    subscription_bucket.acquire()
+    try:
+        timed_call("telegram.send", TELEGRAM_TIMEOUT, bot.send_message, chat_id=entry["user_id"], text=text,
+                   parse_mode="Markdown", reply_markup=InlineKeyboardMarkup([[button]]) if button else None)
+        return True
+    except TelegramError as e:
+        logger.info("Subscription notice to user %s not sent: %s", entry["user_id"], e)
+        return False
+
+def _subscription_reminder(entry: dict):
+    product = product_service.get_product(entry["product_id"])
+    name = product["name"] if product else entry["product_id"]
+    renew = InlineKeyboardButton("🔁 Renew", callback_data=entry["product_id"]) if product else None
+    day = _format_day(entry["expires_at"])
+    if entry["status"] == PAST_DUE:
+        link = paystack.subscription_manage_link(entry["subscription_code"]) if entry["subscription_code"] else {}
+        if link.get("ok") and link["data"]["link"]:
+            renew = InlineKeyboardButton("💳 Update card", url=link["data"]["link"])
+        return f"⚠️ We couldn't renew *{name}*. Update your card to keep access after {day}.", renew
+    if entry["status"] == ACTIVE and entry["subscription_code"]:
+        return f"🔁 Your *{name}* subscription renews on {day}.", None
+    if entry["status"] in (CANCELLED, ACTIVE):
+        return f"⏳ Your *{name}* subscription ends on {day}.", renew
+    return None, None
+
+def subscription_sweep(context: CallbackContext):
+    """
+    Daily: remind subscribers whose access ends within SUBSCRIPTION_REMINDER_DAYS,
+    then revoke access past its grace period. Rows are claimed in batches off
+    the expiry index and messages go out at SUBSCRIPTION_NOTIFY_RATE.
+    """
+    horizon = time.time() + SUBSCRIPTION_REMINDER_DAYS * 86400
+    reminded = revoked = 0
+    while True:
+        batch = entitlements.claim_reminders(horizon, SUBSCRIPTION_BATCH)
+        for entry in batch:
+            text, button = _subscription_reminder(entry)
+            if text:
+                reminded += _notify_subscriber(context.bot, entry, text, button)
+        if len(batch) < SUBSCRIPTION_BATCH:
+            break
+    while True:
+        batch = entitlements.claim_lapsed(SUBSCRIPTION_BATCH)
+        for entry in batch:
+            product = product_service.get_product(entry["product_id"])
+            name = product["name"] if product else entry["product_id"]
+            button = InlineKeyboardButton("🔁 Subscribe again", callback_data=entry["product_id"]) if product else None
+            revoked += _notify_subscriber(context.bot, entry, f"🔒 Your *{name}* subscription has ended.", button)
+        if len(batch) < SUBSCRIPTION_BATCH:
+            break
+    metrics.incr("subscriptions.reminders_sent", reminded)
+    logger.info("Subscription sweep: %s reminders and %s revocation notices sent", reminded, revoked)
+
+def _restore_pending_timers(bot: Bot):
+    purged = PENDING_PAYMENTS.purge_expired()
+    restored = 0
+    for entry in PENDING_PAYMENTS.iter_live():
+        _schedule_pending_timers(bot, entry["reference"], entry)
+        restored += 1
+    logger.info("Restored timers for %s pending payments (%s expired while down)", restored, purged)
+
+def pay_with_mobile_money(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    product_id = query.data.split(":", 1)[1]
+    if not context.user_data.get("email"):
+        context.user_data["mobile_money_product_id"] = product_id
+        query.edit_message_text("📧 Please send the email address for your payment receipt (or /cancel):")
+        return ASK_EMAIL
+    if not context.user_data.get("phone"):
+        context.user_data["mobile_money_product_id"] = product_id
+        query.edit_message_text("📱 Send the M-Pesa phone number to charge, e.g. 0712345678 (or /cancel):")
+        return ASK_PHONE
+    return charge_mobile_money(update, context, product_id)
 
-    # Send the link clearly
-    query.edit_message_text(
-        f"🔗 Open this link to pay for *{product['name']}* (KES {product['price']}):\n\n{auth_url}",
-        parse_mode="Markdown"
+def ask_phone(update: Update, context: CallbackContext):
+    current = context.user_data.get("phone")
+    note = f"Current number: {current}\n" if current else ""
+    update.message.reply_text(f"{note}📱 Send your M-Pesa phone number, e.g. 0712345678 (or /cancel):")
+    return ASK_PHONE
+
+def receive_phone(update: Update, context: CallbackContext):
+    phone = _normalize_phone(update.message.text)
+    if not phone:
+        update.message.reply_text("That doesn't look like a Kenyan mobile number. Please try again, or /cancel.")
+        return ASK_PHONE
+    context.user_data["phone"] = phone
+
+    product_id = context.user_data.pop("mobile_money_product_id", None)
+    if product_id:
+        return charge_mobile_money(update, context, product_id)
+    update.message.reply_text(f"✅ Phone number saved: {phone}")
+    return ConversationHandler.END
+
+def charge_mobile_money(update: Update, context: CallbackContext, product_id: str):
+    user_id = update.effective_user.id
+    if not paystack.available() and mpesa.configured:
+        return mpesa_fallback(update, context, product_id)
+    reference = new_reference()
+    if not inventory.reserve(product_id, reference, user_id):
+        _reply(update, SOLD_OUT_MESSAGE)
+        return ConversationHandler.END
+    result = paystack.charge_mobile_money(phone=context.user_data["phone"], product_id=product_id,
+                                          reference=reference, email=context.user_data["email"],
+                                          metadata={"user_id": user_id})
+    return _handle_charge(update, context, result, product_id, reference)
+
+def mpesa_fallback(update: Update, context: CallbackContext, product_id: str):
+    # delivery happens in server.py when Daraja calls MPESA_CALLBACK_URL, or in resolve_mpesa_requests()
+    product = product_service.get_product(product_id)
+    reference = new_reference()
+    if not inventory.reserve(product_id, reference, update.effective_user.id):
+        _reply(update, SOLD_OUT_MESSAGE)
+        return ConversationHandler.END
+    result = mpesa.stk_push(context.user_data["phone"], product, reference, update.effective_user.id)
+    metrics.incr("payments.fallback.mpesa")
+    if not result.get("ok"):
+        inventory.release(reference)
+        logger.error("M-Pesa fallback failed for user %s product %s: %s %s",
+                     update.effective_user.id, product_id, result.get("error"), result.get("detail"))
+        _reply(update, "❌ Payments are temporarily unavailable. Please try again in a few minutes.")
+        return ConversationHandler.END
+    _reply(update, f"📱 Check your phone and enter your M-Pesa PIN to pay {product['price_label']} "
+                   f"for *{product['name']}*.", parse_mode="Markdown")
+    return ConversationHandler.END
+
+def receive_otp(update: Update, context: CallbackContext):
+    pending = context.user_data.pop("otp_charge", None)
+    if not pending:
+        return ConversationHandler.END
+    result = paystack.submit_otp(update.message.text.strip(), pending["reference"])
+    return _handle_charge(update, context, result, pending["product_id"], pending["reference"])
+
+def _handle_charge(update: Update, context: CallbackContext, result, product_id: str, reference: str):
+    user_id = update.effective_user.id
+    product = product_service.get_product(product_id)
+    if not result.get("ok"):
+        inventory.release(reference)
+        logger.warning("Mobile money charge failed for user %s product %s: %s %s",
+                       user_id, product_id, result.get("error"), result.get("detail"))
+        _reply(update, f"❌ M-Pesa payment failed: {result.get('detail')}\nTap /start to try again.")
+        return ConversationHandler.END
+
+    data = result["data"]
+    status = data["status"]
+    # persisted like a hosted checkout: if this process restarts or the poll gives up, the webhook delivers
+    PENDING_PAYMENTS[data["reference"]] = {"user_id": user_id, "product_id": product_id}
+    if status == CHARGE_SUCCESS:
+        inventory.commit(reference)
+        queue_delivery(context.bot, data["reference"], user_id, [product_id])
+        PENDING_PAYMENTS.discard(data["reference"])
+        _reply(update, f"✅ Paid {product['price_label']} for *{product['name']}*.", parse_mode="Markdown")
+        return ConversationHandler.END
+    if status == CHARGE_SEND_OTP:
+        # expires like any pending payment if the user never sends the OTP
+        _schedule_pending_timers(context.bot, data["reference"], PENDING_PAYMENTS[data["reference"]])
+        context.user_data["otp_charge"] = {"reference": data["reference"], "product_id": product_id}
+        _reply(update, f"🔐 {data.get('display_text') or 'Enter the OTP sent to your phone'} (or /cancel):")
+        return ASK_OTP
+    if status in CHARGE_WAITING:
+        # polled here for a quick answer; whichever of poll and webhook claims the order delivers
+        _schedule_pending_timers(context.bot, data["reference"], PENDING_PAYMENTS[data["reference"]])
+        _reply(update, f"📱 {data.get('display_text') or 'Check your phone and enter your M-Pesa PIN to pay.'}\n"
+                       f"Amount: {product['price_label']}")
+        context.job_queue.run_repeating(
+            poll_mobile_money, interval=MOBILE_MONEY_POLL_INTERVAL, first=MOBILE_MONEY_POLL_INTERVAL,
+            context={"reference": data["reference"], "user_id": user_id, "product_id": product_id,
+                     "started": time.time()},
+            name=f"mobile_money:{data['reference']}")
+        return ConversationHandler.END
+
+    logger.warning("Unexpected mobile money charge status %s for %s", status, data.get("reference"))
+    PENDING_PAYMENTS.discard(data["reference"])
+    inventory.release(reference)
+    _reply(update, "⚠️ Unexpected payment state. Tap /start to try again.")
+    return ConversationHandler.END
+
+def poll_mobile_money(context: CallbackContext):
+    job = context.job
+    state = job.context
+    result = paystack.check_pending_charge(state["reference"])
+    if result.get("ok") and result["data"]["status"] in CHARGE_WAITING:
+        if time.time() - state["started"] < MOBILE_MONEY_TIMEOUT:
+            return
+        job.schedule_removal()
+        # the pending entry stays: a payment that still lands is delivered by the webhook
+        inventory.release(state["reference"])
+        context.bot.send_message(chat_id=state["user_id"],
+                                 text="⌛ The M-Pesa prompt expired without payment. Tap /start to try again.")
+        return
+    if not result.get("ok") and result.get("error") == "http_error":
+        return  # transient, try again next tick
+
+    job.schedule_removal()
+    if result.get("ok") and result["data"]["status"] == CHARGE_SUCCESS:
+        inventory.commit(state["reference"])
+        queue_delivery(context.bot, state["reference"], state["user_id"], [state["product_id"]])
+        PENDING_PAYMENTS.discard(state["reference"])
+        return
+    PENDING_PAYMENTS.discard(state["reference"])
+    inventory.release(state["reference"])
+    logger.warning("Mobile money charge %s did not succeed: %s", state["reference"], result)
+    context.bot.send_message(chat_id=state["user_id"], text="❌ M-Pesa payment was not completed. Tap /start to try again.")
+
+def pay_with_link(update: Update, context: CallbackContext):
+    update.callback_query.answer()
+    product_id = update.callback_query.data.split(":", 1)[1]
+    if not context.user_data.get("email"):
+        context.user_data["checkout_product_id"] = product_id
+        update.callback_query.edit_message_text("📧 Please send the email address for your payment receipt (or /cancel):")
+        return ASK_EMAIL
+    return checkout(update, context, product_id, offer_saved_card=False)
+
+def pay_with_saved_card(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    product_id = query.data.split(":", 1)[1]
+    user_id = query.from_user.id
+    product = product_service.get_product(product_id)
+    card = paystack.get_saved_authorization(user_id)
+    if not product or not card:
+        return checkout(update, context, product_id, offer_saved_card=False)
+
+    reference = new_reference()
+    if not inventory.reserve(product_id, reference, user_id):
+        query.edit_message_text(SOLD_OUT_MESSAGE)
+        return ConversationHandler.END
+    query.edit_message_text(f"⏳ Charging {card['card_type'].upper()} •••• {card['last4']}…")
+    result = paystack.charge_authorization(email=card["email"], authorization_code=card["authorization_code"],
+                                           product_id=product_id, reference=reference,
+                                           metadata={"user_id": user_id, "one_tap": True})
+    if result.get("error") == "charge_unknown":
+        # the card may have been charged: ask Paystack before offering another way to pay
+        result = _settle_unknown_charge(reference)
+        if result is None:
+            # keep the stock held and let the charge.success webhook deliver if it went through
+            PENDING_PAYMENTS[reference] = {"user_id": user_id, "product_id": product_id}
+            _schedule_pending_timers(context.bot, reference, PENDING_PAYMENTS[reference])
+            query.edit_message_text("⏳ We're confirming your card payment with the bank. Your product will "
+                                    "arrive here as soon as it clears; there's no need to pay again.")
+            return ConversationHandler.END
+    if not result.get("ok"):
+        inventory.release(reference)
+        logger.warning("Saved card charge failed for user %s product %s: %s",
+                       user_id, product_id, result.get("error"))
+        # the card may need extra verification; fall back to the hosted checkout
+        query.edit_message_text("⚠️ Your saved card couldn't be charged. Creating a payment link instead…")
+        return checkout(update, context, product_id, offer_saved_card=False)
+
+    # the charge.success webhook delivers from metadata too; the order claim lets only one of us send
+    inventory.commit(reference)
+    queue_delivery(context.bot, reference, user_id, [product_id])
+    query.edit_message_text(f"✅ Paid {product['price_label']} for *{product['name']}*.", parse_mode="Markdown")
+    return ConversationHandler.END
+
+def _settle_unknown_charge(reference: str):
+    """Paystack's verdict on a charge whose outcome we didn't see, or None while it's still open."""
+    verify = paystack.verify_payment(reference)
+    if verify.get("ok"):
+        return verify
+    detail = verify.get("detail") if isinstance(verify.get("detail"), dict) else {}
+    if verify.get("error") == "not_successful" and detail.get("status") in ("failed", "abandoned", "reversed"):
+        return verify
+    if verify.get("error") == "verify_failed" and "not found" in str(detail.get("message", "")).lower():
+        return verify  # the charge request never reached Paystack
+    return None
+
+def pay_with_invoice(update: Update, context: CallbackContext):
+    query = update.callback_query
+    query.answer()
+    product_id = query.data.split(":", 1)[1]
+    product = product_service.get_product(product_id)
+    if not product or not PAYMENT_PROVIDER_TOKEN:
+        query.edit_message_text("Product not found.")
+        return
+    context.bot.send_invoice(
+        chat_id=query.message.chat_id,
+        title=product["name"][:32],
+        description=(product.get("description") or product["name"])[:255],
+        payload=f"{product_id}:{new_reference()}",
+        provider_token=PAYMENT_PROVIDER_TOKEN,
+        currency=product["currency"],
+        prices=[LabeledPrice(product["name"][:32], product["amount_minor"])],
     )
 
+def precheckout(update: Update, context: CallbackContext):
+    # Telegram cancels the payment if this isn't answered within 10s, so it is
+    # answered from the in-memory catalog only, with no outbound calls
+    with metrics.timer("precheckout.answer"):
+        query = update.pre_checkout_query
+        product = product_service.get_product(query.invoice_payload.split(":", 1)[0])
+        if not product:
+            query.answer(ok=False, error_message="This product is no longer available.")
+        elif query.total_amount != product["amount_minor"] or query.currency != product["currency"]:
+            query.answer(ok=False, error_message="The price has changed. Please tap /start and try again.")
+        elif not inventory.reserve(product["id"], query.invoice_payload, query.from_user.id):
+            # a local SQLite write; a held unit is released by the expiry sweep if payment never lands
+            query.answer(ok=False, error_message="Sorry, this product is sold out.")
+        else:
+            query.answer(ok=True)
+
+def successful_payment(update: Update, context: CallbackContext):
+    payment = update.message.successful_payment
+    product = product_service.get_product(payment.invoice_payload.split(":", 1)[0])
+    logger.info("Telegram payment received: user=%s payload=%s charge=%s",
+                update.effective_user.id, payment.invoice_payload, payment.provider_payment_charge_id)
+    metrics.incr("payments.telegram")
+    if not product:
+        logger.error("Paid invoice for unknown product: %s", payment.invoice_payload)
+        update.message.reply_text("✅ Payment received, but the product could not be found. Please contact support.")
+        return
+    inventory.commit(payment.invoice_payload)
+    queue_delivery(context.bot, payment.invoice_payload, update.effective_user.id, [product["id"]])
+
+def _is_admin(update: Update) -> bool:
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
+def broadcast_command(update: Update, context: CallbackContext):
+    if not _is_admin(update):
+        return
+    text = update.message.text.partition(" ")[2].strip()
+    if not text and update.message.reply_to_message:
+        text = update.message.reply_to_message.text or ""
+    if not text:
+        update.message.reply_text("Usage: /broadcast <message>, or reply /broadcast to the message to send.")
+        return
+    broadcast_id = broadcasts.create(text, update.effective_user.id)
+    update.message.reply_text(f"📣 Broadcast #{broadcast_id} started. Check it with /broadcast_status {broadcast_id}")
+
+def broadcast_status_command(update: Update, context: CallbackContext):
+    if not _is_admin(update):
+        return
+    if not context.args or not context.args[0].isdigit():
+        update.message.reply_text("Usage: /broadcast_status <id>")
+        return
+    state = broadcasts.status(int(context.args[0]))
+    if not state:
+        update.message.reply_text("No such broadcast.")
+        return
+    lines = [f"📣 Broadcast #{state['id']}: {state['status']}",
+             f"{state['handled']}/{state['total']} handled — sent {state['sent']}, "
+             f"failed {state['failed']}, pruned {state['pruned']}"]
+    if state["throughput"]:
+        lines.append(f"{state['throughput']:.1f} msg/s, ETA {int(state['eta_seconds'])}s")
+    update.message.reply_text("\n".join(lines))
+
+def broadcast_cancel_command(update: Update, context: CallbackContext):
+    if not _is_admin(update):
+        return
+    if not context.args or not context.args[0].isdigit():
+        update.message.reply_text("Usage: /broadcast_cancel <id>")
+        return
+    cancelled = broadcasts.cancel(int(context.args[0]))
+    update.message.reply_text("Cancelled." if cancelled else "Not running.")
+
+def inline_search(update: Update, context: CallbackContext):
+    query = update.inline_query
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    results = product_search.articles(query.query, context.bot.username)
+    end = offset + INLINE_PAGE_SIZE
+    query.answer(results[offset:end], next_offset=str(end) if end < len(results) else "",
+                 cache_time=INLINE_CACHE_TIME)
+
+def restock_command(update: Update, context: CallbackContext):
+    if not _is_admin(update):
+        return
+    if len(context.args) != 2 or not context.args[1].lstrip("-").isdigit():
+        update.message.reply_text("Usage: /restock <product_id> <units to add>")
+        return
+    product_id, count = context.args[0], int(context.args[1])
+    if not product_service.get_product(product_id):
+        update.message.reply_text("Product not found.")
+        return
+    update.message.reply_text(f"📦 {product_id}: {inventory.restock(product_id, count)} available")
+
+def release_expired_reservations(context: CallbackContext):
+    inventory.release_expired()
+
+def queue_delivery(bot: Bot, reference: str, user_id: int, product_ids: list) -> bool:
+    """
+    Queues a confirmed payment in the outbox, then tries to send it right
+    away. Whatever doesn't go out now is retried by deliver_outbox().
+    """
+    outbox.add(reference, user_id, product_ids)
+    return deliver_queued(bot, reference)
+
+def deliver_queued(bot: Bot, reference: str) -> bool:
+    entry = outbox.claim(reference)
+    if not entry:
+        return False  # already sent, or another path is sending it
+    user_id = entry["user_id"]
+    paid = [product_service.get_product(product_id) for product_id in entry["product_ids"]]
+    try:
+        # one product, or every line of a cart in one batched message; the order claim stops repeats
+        products = [product for product in paid if product]
+        if products and not deliver_products(bot, user_id, products, reference=reference):
+            outbox.retry(reference, entry["attempts"], "being delivered by another path")
+            return False
+    except Exception as e:
+        logger.exception("Delivery of %s to user %s failed (attempt %s)", reference, user_id, entry["attempts"])
+        if not outbox.retry(reference, entry["attempts"], str(e)):
+            _alert_admins(bot, f"🚨 Gave up delivering {reference} to user {user_id} after "
+                               f"{entry['attempts']} attempts: {e}. Deliver by hand.")
+        return False
+    missing = [product_id for product_id, product in zip(entry["product_ids"], paid) if not product]
+    if missing:
+        _report_undelivered(bot, user_id, reference, missing)
+    outbox.done(reference)
+    return True
+
+def _report_undelivered(bot: Bot, user_id: int, reference: str, product_ids: list):
+    # paid for but gone from the catalog: someone has to refund or deliver these by hand
+    logger.error("Paid items %s of %s are missing from the catalog; not delivered to user %s",
+                 product_ids, reference, user_id)
+    metrics.incr("delivery.missing_items", len(product_ids))
+    try:
+        bot.send_message(chat_id=user_id,
+                         text=f"⚠️ {len(product_ids)} item(s) you paid for are no longer available, so they weren't "
+                              f"delivered. We've told support, who will refund or send them. Reference: {reference}")
+    except TelegramError as e:
+        logger.warning("Could not send undelivered-items notice to %s: %s", user_id, e)
+    _alert_admins(bot, f"🚨 Paid but undeliverable: {', '.join(map(str, product_ids))} "
+                       f"(user {user_id}, reference {reference}). Refund or deliver by hand.")
+
+def _alert_admins(bot: Bot, text: str):
+    for admin_id in ADMIN_IDS:
+        try:
+            bot.send_message(chat_id=admin_id, text=text)
+        except TelegramError as e:
+            logger.warning("Could not alert admin %s: %s", admin_id, e)
+
+def deliver_outbox(context: CallbackContext):
+    """Retries queued deliveries that are due: failed sends, and ones whose sender died."""
+    for reference in outbox.due(OUTBOX_BATCH):
+        deliver_queued(context.bot, reference)
+
+def settle_mpesa_request(bot: Bot, checkout_request_id: str, success: bool, detail=None) -> bool:
+    """
+    Finishes an STK request once Daraja's status query has confirmed it:
+    commits the stock and queues delivery, or releases the stock and tells
+    the buyer. Used by the callback in server.py and resolve_mpesa_requests();
+    only the first caller for a request gets True.
+    """
+    pending = mpesa.complete(checkout_request_id, success)
+    if not pending:
+        return False
+    if success:
+        inventory.commit(pending["reference"])
+        outbox.add(pending["reference"], pending["user_id"], [pending["product_id"]])
+        return True
+    inventory.release(pending["reference"])
+    logger.info("M-Pesa payment %s not completed: %s", checkout_request_id, detail)
+    try:
+        bot.send_message(chat_id=pending["user_id"], text="❌ M-Pesa payment was not completed. Tap /start to try again.")
+    except TelegramError as e:
+        logger.warning("Could not tell user %s about M-Pesa request %s: %s", pending["user_id"], checkout_request_id, e)
+    return True
+
+def resolve_mpesa_requests(context: CallbackContext):
+    """
+    Daraja doesn't resend STK callbacks, so a request still pending after
+    MPESA_RECHECK_AFTER (callback lost, or not confirmable when it came) is
+    re-queried here and settled the same way. One that stays unconfirmed
+    past MPESA_REQUEST_TTL is given up and its stock released.
+    """
+    now = time.time()
+    for row in mpesa.pending_before(now - MPESA_RECHECK_AFTER, MPESA_SWEEP_BATCH):
+        status = mpesa.query_status(row["checkout_request_id"])
+        if status.get("ok") and status["data"]["status"] != "pending":
+            paid = status["data"]["status"] == "paid"
+            if settle_mpesa_request(context.bot, row["checkout_request_id"], paid, status["data"]["detail"]) and paid:
+                deliver_queued(context.bot, row["reference"])
+            continue
+        if now - row["created_at"] < MPESA_REQUEST_TTL or not mpesa.expire(row["checkout_request_id"]):
+            continue
+        inventory.release(row["reference"])
+        metrics.incr("mpesa.expired")
+        logger.error("Gave up on M-Pesa request %s (reference %s) after %.0fs unconfirmed: %s",
+                     row["checkout_request_id"], row["reference"], now - row["created_at"], status)
+        try:
+            context.bot.send_message(chat_id=row["user_id"],
+                                     text=f"⚠️ We couldn't confirm your M-Pesa payment. If you were charged, "
+                                          f"contact support with reference {row['reference']}.")
+        except TelegramError as e:
+            logger.warning("Could not tell user %s about expired M-Pesa request: %s", row["user_id"], e)
+
+def coupon_command(update: Update, context: CallbackContext):
+    """/coupon CODE 20%|150 [products=1,2] [days=7] [max=100] [per_user=1]"""
+    if not _is_admin(update):
+        return
+    if len(context.args) < 2:
+        update.message.reply_text("Usage: /coupon CODE 20%|150 [products=1,2] [days=7] [max=100] [per_user=1]")
+        return
+    code, value = context.args[0], context.args[1]
+    options = dict(arg.split("=", 1) for arg in context.args[2:] if "=" in arg)
+    try:
+        percent_off = int(value[:-1]) if value.endswith("%") else None
+        currency = BASE_CURRENCY if percent_off is None else None
+        coupons.add(
+            code,
+            percent_off=percent_off,
+            amount_off_minor=to_minor_units(value, currency) if currency else None,
+            currency=currency,
+            product_ids=options["products"].split(",") if options.get("products") else None,
+            expires_at=time.time() + float(options["days"]) * 86400 if options.get("days") else None,
+            max_redemptions=int(options["max"]) if options.get("max") else None,
+            per_user_limit=int(options["per_user"]) if options.get("per_user") else None,
+        )
+    except (ValueError, KeyError) as e:
+        update.message.reply_text(f"❌ {e}")
+        return
+    update.message.reply_text(f"🏷 Coupon saved. Share it as t.me/{context.bot.username}?start=promo_{code}")
+
+def attribution_command(update: Update, context: CallbackContext):
+    if not _is_admin(update):
+        return
+    totals = attribution.totals()
+    if not totals:
+        update.message.reply_text("No deep-link traffic yet.")
+        return
+    top = sorted(totals.items(), key=lambda item: item[1].get("open", 0), reverse=True)[:20]
+    lines = [f"{payload}: {events.get('open', 0)} opens, {events.get('checkout', 0)} checkouts"
+             for payload, events in top]
+    update.message.reply_text("🔗 Deep links\n" + "\n".join(lines))
+
 def main():
-    updater = Updater(TELEGRAM_BOT_TOKEN)
-    dp = updater.dispatcher
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(CallbackQueryHandler(button))
-    updater.start_polling()
-    updater.idle()
+    # only one instance may poll getUpdates; others wait here as hot standbys.
+    # Elect before building the dispatcher so a new leader loads fresh persisted state.
+    lease = LeaderLease("telegram-poller")
+    lease.wait_until_elected()
+
+    # updates are ordered per chat and run in parallel across chats
+    scheduler = ChatScheduler()
+    job_queue = JobQueue()
+    persistence = SQLitePersistence()
+    dp = OrderedDispatcher(
+        Bot(token=TELEGRAM_BOT_TOKEN, request=Request(con_pool_size=scheduler.workers + 4)),
+        Queue(), job_queue=job_queue, persistence=persistence, scheduler=scheduler)
+    job_queue.set_dispatcher(dp)
+    updater = Updater(dispatcher=dp)
+
+    def step_down():
+        # stop polling before the lease can pass to a standby, then exit
+        updater.is_idle = False
+
+    # renew from the start: restoring timers and broadcasts below may outlast LEASE_TTL
+    lease.start_heartbeat(on_lost=step_down)
+    dp.add_handler(ConversationHandler(
+        entry_points=[
+            # /start is an entry point so a buy_ deep link can go straight to the email prompt
+            CommandHandler("start", start),
+            CallbackQueryHandler(button, pattern=PRODUCT_PATTERN),
+            CallbackQueryHandler(pay_with_link, pattern=r"^paylink:"),
+            CallbackQueryHandler(pay_with_mobile_money, pattern=r"^paymm:"),
+            # its fallback to checkout() may ask for a phone number (M-Pesa route), so it needs the states
+            CallbackQueryHandler(pay_with_saved_card, pattern=r"^paycard:"),
+            CallbackQueryHandler(ask_coupon, pattern=r"^promo:"),
+            CallbackQueryHandler(pay_cart, pattern=r"^cart:pay$"),
+            CommandHandler("email", ask_email),
+            CommandHandler("phone", ask_phone),
+        ],
+        states={
+            ASK_EMAIL: [MessageHandler(Filters.text & ~Filters.command, receive_email)],
+            ASK_PHONE: [MessageHandler(Filters.text & ~Filters.command, receive_phone)],
+            ASK_OTP: [MessageHandler(Filters.text & ~Filters.command, receive_otp)],
+            ASK_COUPON: [MessageHandler(Filters.text & ~Filters.command, receive_coupon)],
+        },
+        fallbacks=[CommandHandler("cancel", cancel)],
+        name="checkout",
+        persistent=True,
+        allow_reentry=True,
+    ))
+    dp.add_handler(CallbackQueryHandler(pay_with_invoice, pattern=r"^payinvoice:"))
+    dp.add_handler(CallbackQueryHandler(cart_button, pattern=r"^cart:(add|rm|clear|show)"))
+    dp.add_handler(CommandHandler("cart", cart_command))
+    # run_async so pre-checkout answers never queue behind slow handlers
+    dp.add_handler(PreCheckoutQueryHandler(precheckout, run_async=True))
+    dp.add_handler(MessageHandler(Filters.successful_payment, successful_payment))
+    dp.add_handler(CommandHandler("broadcast", broadcast_command))
+    dp.add_handler(CommandHandler("broadcast_status", broadcast_status_command))
+    dp.add_handler(CommandHandler("broadcast_cancel", broadcast_cancel_command))
+    dp.add_handler(CommandHandler("attribution", attribution_command))
+    dp.add_handler(CommandHandler("restock", restock_command))
+    dp.add_handler(CommandHandler("coupon", coupon_command))
+    # needs inline mode enabled for the bot in @BotFather (/setinline)
+    dp.add_handler(InlineQueryHandler(inline_search))
+    # resume only once elected, so two instances never send the same broadcast
+    global broadcasts
+    broadcasts = BroadcastEngine(dp.bot)
+    broadcasts.resume_unfinished()
+    _restore_pending_timers(dp.bot)
+    coupons.load()
+    pending_timers.start()
+    attribution.start()
+    job_queue.run_repeating(release_expired_reservations, interval=RESERVATION_SWEEP_INTERVAL, first=0)
+    job_queue.run_repeating(deliver_outbox, interval=OUTBOX_SWEEP_INTERVAL, first=0)
+    if mpesa.configured:
+        job_queue.run_repeating(resolve_mpesa_requests, interval=MPESA_SWEEP_INTERVAL, first=MPESA_SWEEP_INTERVAL)
+    # claims are by expiry window, so a day missed while down is caught up by the next run
+    job_queue.run_daily(subscription_sweep, time=datetime.time(hour=SUBSCRIPTION_SWEEP_HOUR))
+    link_prober.start()
+    if METRICS_PORT:
+        serve_metrics(int(METRICS_PORT))
+    # lost during startup: never poll alongside the new leader
+    if not lease.lost:
+        # keep updates Telegram still holds: whatever the previous leader didn't fetch is ours
+        updater.start_polling(drop_pending_updates=False)
+        if not lease.lost:
+            updater.idle()
+    updater.stop()
+    scheduler.shutdown()
+    # Updater.stop() doesn't flush; write the dirty user_data/conversations before the next leader loads them
+    dp.update_persistence()
+    persistence.flush()
+    pending_timers.stop()
+    attribution.stop()
+    lease.release()
+    if lease.lost:
+        raise SystemExit("Lost the poller lease; exiting so a supervisor restarts this instance as a standby")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,165 @@
+# broadcast.py
+import os
+import time
+import logging
+import threading
+from typing import Dict, Any, Optional
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, TelegramError, Unauthorized
+from db import connect
+from metrics import metrics
+from order_store import OrderStore
+from rate_limiter import KeyedRateLimiter, TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS broadcasts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running',
+    cursor INTEGER NOT NULL DEFAULT 0,
+    total INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    pruned INTEGER NOT NULL DEFAULT 0,
+    created_by INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+RUNNING, DONE, CANCELLED = "running", "done", "cancelled"
+
+GLOBAL_RATE = float(os.getenv("BROADCAST_RATE", 25))  # Telegram allows ~30 msg/s per bot
+PER_CHAT_INTERVAL = float(os.getenv("BROADCAST_PER_CHAT_INTERVAL", 1))
+PAGE_SIZE = 500
+CHECKPOINT_EVERY = 50
+
+
+class BroadcastEngine:
+    """
+    Sends an announcement to every past buyer. Recipients are streamed from
+    the orders table in user_id order and the last one handled is
+    checkpointed, so a crash or restart resumes where it stopped. Sends are
+    limited globally and per chat; users who blocked the bot are pruned.
+    """
+
+    def __init__(self, bot: Bot, orders: Optional[OrderStore] = None):
+        self.bot = bot
+        self.orders = orders or OrderStore()
+        self.bucket = TokenBucket(GLOBAL_RATE)
+        self.per_chat = KeyedRateLimiter(PER_CHAT_INTERVAL)
+        self._threads: Dict[int, threading.Thread] = {}
+        self._started: Dict[int, tuple] = {}  # id -> (monotonic start, handled at start)
+        connect().executescript(SCHEMA)
+
+    def create(self, text: str, created_by: int) -> int:
+        now = time.time()
+        cur = connect().execute(
+            "INSERT INTO broadcasts (text, total, created_by, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (text, self.orders.count_buyers(), created_by, now, now))
+        broadcast_id = cur.lastrowid
+        self.start(broadcast_id)
+        return broadcast_id
+
+    def start(self, broadcast_id: int):
+        thread = self._threads.get(broadcast_id)
+        if thread and thread.is_alive():
+            return
+        thread = threading.Thread(target=self._run, args=(broadcast_id,), name=f"broadcast-{broadcast_id}",
+                                  daemon=True)
+        self._threads[broadcast_id] = thread
+        thread.start()
+
+    def resume_unfinished(self):
+        for row in connect().execute("SELECT id FROM broadcasts WHERE status = ?", (RUNNING,)).fetchall():
+            logger.info("Resuming broadcast %s", row["id"])
+            self.start(row["id"])
+
+    def cancel(self, broadcast_id: int) -> bool:
+        cur = connect().execute("UPDATE broadcasts SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                                (CANCELLED, time.time(), broadcast_id, RUNNING))
+        return cur.rowcount == 1
+
+    def _load(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        row = connect().execute("SELECT * FROM broadcasts WHERE id = ?", (broadcast_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _checkpoint(self, state: Dict[str, Any], status: str = RUNNING) -> bool:
+        # conditional on still running, so a cancel from another thread sticks
+        cur = connect().execute(
+            "UPDATE broadcasts SET cursor = ?, sent = ?, failed = ?, pruned = ?, status = ?, updated_at = ? "
+            "WHERE id = ? AND status = ?",
+            (state["cursor"], state["sent"], state["failed"], state["pruned"], status, time.time(),
+             state["id"], RUNNING))
+        return cur.rowcount == 1
+
+    def _send(self, user_id: int, text: str) -> str:
+        """Returns 'sent', 'pruned' or 'failed'."""
+        for _ in range(3):
+            self.bucket.acquire()
+            self.per_chat.acquire(user_id)
+            try:
+                self.bot.send_message(chat_id=user_id, text=text)
+                return "sent"
+            except RetryAfter as e:
+                # flood control: everyone waits, then retry the same chat
+                logger.warning("Broadcast hit flood limit; sleeping %ss", e.retry_after)
+                time.sleep(float(e.retry_after) + 1)
+            except Unauthorized:
+                self.orders.mark_blocked(user_id)
+                return "pruned"
+            except BadRequest as e:
+                if "chat not found" in str(e).lower():
+                    self.orders.mark_blocked(user_id)
+                    return "pruned"
+                logger.warning("Broadcast to %s rejected: %s", user_id, e)
+                return "failed"
+            except TelegramError as e:
+                logger.warning("Broadcast to %s failed: %s", user_id, e)
+                return "failed"
+        return "failed"
+
+    def _run(self, broadcast_id: int):
+        state = self._load(broadcast_id)
+        if not state or state["status"] != RUNNING:
+            return
+        self._started[broadcast_id] = (time.monotonic(), state["sent"] + state["failed"] + state["pruned"])
+        since_checkpoint = 0
+        try:
+            for user_id in self.orders.iter_buyers(after=state["cursor"], page_size=PAGE_SIZE):
+                outcome = self._send(user_id, state["text"])
+                state[outcome] += 1
+                state["cursor"] = user_id
+                metrics.incr(f"broadcast.{outcome}")
+                since_checkpoint += 1
+                if since_checkpoint >= CHECKPOINT_EVERY:
+                    since_checkpoint = 0
+                    if not self._checkpoint(state):
+                        logger.info("Broadcast %s cancelled", broadcast_id)
+                        return
+            self._checkpoint(state, status=DONE)
+            logger.info("Broadcast %s done: sent=%s failed=%s pruned=%s",
+                        broadcast_id, state["sent"], state["failed"], state["pruned"])
+        except Exception:
+            # progress up to the last checkpoint is kept; resume_unfinished picks it up
+            logger.exception("Broadcast %s crashed", broadcast_id)
+            self._checkpoint(state)
+
+    def status(self, broadcast_id: int) -> Optional[Dict[str, Any]]:
+        state = self._load(broadcast_id)
+        if not state:
+            return None
+        handled = state["sent"] + state["failed"] + state["pruned"]
+        state["handled"] = handled
+        state["throughput"] = None
+        state["eta_seconds"] = None
+        started = self._started.get(broadcast_id)
+        if started and state["status"] == RUNNING:
+            elapsed = time.monotonic() - started[0]
+            done_this_run = handled - started[1]
+            if elapsed > 0 and done_this_run > 0:
+                state["throughput"] = done_this_run / elapsed
+                state["eta_seconds"] = max(0, state["total"] - handled) / state["throughput"]
+        return state
@@ -0,0 +1,120 @@
+# catalog_io.py
+import io
+import csv
+import json
+import logging
+from typing import Any, Callable, Dict, Iterator, Optional, TextIO, Tuple
+from product_service import ProductService, validate_entry, source_fields
+
+logger = logging.getLogger(__name__)
+
+CSV_FIELDS = ["id", "name", "description", "price", "currency", "prices", "pixeldrain_link", "file_path",
+              "stock", "plan_code", "period_days"]
+MAX_REPORTED_ERRORS = 1000
+FORMATS = ("csv", "jsonl")
+
+
+def _iter_raw(stream: TextIO, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """(line number, raw row) pairs, read lazily; JSONL lines are parsed by the caller."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # blank cells mean "not set"; columns past the header land under None
+            yield reader.line_num, {k.strip(): v.strip() for k, v in row.items()
+                                    if k and isinstance(v, str) and v.strip()}
+    elif fmt == "jsonl":
+        for n, line in enumerate(stream, start=1):
+            if line.strip():
+                yield n, line
+    else:
+        raise ValueError(f"unsupported format {fmt!r}; use one of {FORMATS}")
+
+
+def import_products(service: ProductService, stream: TextIO, fmt: str, replace: bool = False,
+                    partial: bool = False) -> Dict[str, Any]:
+    """
+    Streams rows from a CSV or JSONL file into the catalog with one swap at
+    the end. Rows with an id update that product; rows without one get a
+    fresh id from service.allocate_id(). With replace=True the import becomes
+    the whole catalog. Any invalid row aborts the import unless partial=True,
+    in which case the valid rows are committed. Either way the report lists
+    the rejected rows (the first MAX_REPORTED_ERRORS of them).
+    """
+    products = {} if replace else dict(service.products)
+    seen, errors = set(), []
+    created = updated = error_count = 0
+    for line, raw in _iter_raw(stream, fmt):
+        try:
+            entry = json.loads(raw) if fmt == "jsonl" else raw
+            product = validate_entry(entry, require_id=False)
+            if "id" in product:
+                if product["id"] in seen:
+                    raise ValueError(f"duplicate id {product['id']} in this import")
+                updated += product["id"] in service.products
+                created += product["id"] not in service.products
+            else:
+                product["id"] = service.allocate_id()
+                created += 1
+            seen.add(product["id"])
+            products[product["id"]] = product
+        except (ValueError, TypeError, AttributeError) as e:
+            error_count += 1
+            if len(errors) < MAX_REPORTED_ERRORS:
+                errors.append({"line": line, "error": str(e)})
+
+    report = {"created": created, "updated": updated, "rejected": error_count, "errors": errors,
+              "removed": len(service.products.keys() - products.keys()) if replace else 0}
+    if error_count and not partial:
+        return {"ok": False, "error": "invalid_rows", "detail": report}
+    try:
+        service.commit(products)
+    except (OSError, ValueError) as e:
+        logger.exception("Catalog import could not be committed")
+        return {"ok": False, "error": "commit_failed", "detail": str(e)}
+    logger.info("Catalog import: %s created, %s updated, %s rejected, %s removed",
+                created, updated, error_count, report["removed"])
+    report["version"] = service.version
+    return {"ok": True, "data": report}
+
+
+def export_products(service: ProductService, fmt: str,
+                    stock_level: Optional[Callable[[str], Optional[int]]] = None) -> Iterator[str]:
+    """
+    Yields the catalog as CSV or JSONL text chunks, one product at a time,
+    from a snapshot taken when iteration starts. CSV carries CSV_FIELDS only;
+    JSONL carries every field. With `stock_level` (Inventory.stock_level)
+    "stock" is the live count, so an export edited and imported back only
+    changes the stock that was edited.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"unsupported format {fmt!r}; use one of {FORMATS}")
+    products = service.get_products()
+
+    def fields(product: Dict[str, Any]) -> Dict[str, Any]:
+        row = source_fields(product)
+        if stock_level is not None:
+            level = stock_level(product["id"])
+            if level is None:
+                row.pop("stock", None)
+            else:
+                row["stock"] = level
+        return row
+
+    if fmt == "jsonl":
+        for product in products:
+            yield json.dumps(fields(product), ensure_ascii=False, default=str) + "\n"
+        return
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for product in products:
+        row = fields(product)
+        if row.get("prices"):
+            row["prices"] = json.dumps(row["prices"])
+        writer.writerow(row)
+        # header goes out with the first row; the buffer never holds more than one row
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if not products:
+        yield buffer.getvalue()
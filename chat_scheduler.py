@@ -0,0 +1,117 @@
+# chat_scheduler.py
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Hashable, Optional, Tuple
+from telegram import Update
+from telegram.ext import Dispatcher
+from metrics import metrics
+from deadline import deadline_scope
+
+logger = logging.getLogger(__name__)
+
+# time budget per update, counted from when it reached the dispatcher
+UPDATE_DEADLINE = float(os.getenv("UPDATE_DEADLINE", 30))
+
+_Item = Tuple[Callable, tuple, float]  # (fn, args, enqueued_at)
+
+
+class ChatScheduler:
+    """
+    Runs work for different chats in parallel on a bounded pool while keeping
+    strict FIFO order within each chat: a chat has at most one item running,
+    the rest wait in that chat's queue.
+    """
+
+    def __init__(self, workers: Optional[int] = None):
+        self.workers = workers or int(os.getenv("SCHEDULER_WORKERS", 8))
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="chat-worker")
+        self._lock = threading.Lock()
+        self._queues: Dict[Hashable, Deque[_Item]] = {}  # only chats with work in flight
+        self._closing = False
+        metrics.register_gauge("scheduler.queue_lengths", self.queue_lengths)
+        metrics.register_gauge("scheduler.active_chats", lambda: len(self._queues))
+
+    def submit(self, key: Hashable, fn: Callable, *args: Any):
+        item = (fn, args, time.monotonic())
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is not None:
+                # something for this chat is already running; wait our turn
+                queue.append(item)
+                return
+            self._queues[key] = deque()
+        self._pool.submit(self._run, key, item)
+
+    def _run(self, key: Hashable, item: _Item):
+        while True:
+            fn, args, enqueued_at = item
+            metrics.observe("scheduler.wait", time.monotonic() - enqueued_at)
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Scheduled work for chat %s failed", key)
+
+            with self._lock:
+                queue = self._queues[key]
+                if not queue:
+                    del self._queues[key]
+                    return
+                item = queue.popleft()
+                closing = self._closing
+            if closing:
+                continue  # the pool takes no new work once shut down: drain this chat here
+            try:
+                # resubmit instead of looping so one busy chat can't hog a worker
+                self._pool.submit(self._run, key, item)
+                return
+            except RuntimeError:
+                continue  # shut down between the check and the submit
+
+    def queue_lengths(self) -> Dict[str, int]:
+        # items waiting behind the running one, per chat
+        with self._lock:
+            return {str(k): len(q) for k, q in self._queues.items() if q}
+
+    def shutdown(self, wait: bool = True):
+        # running workers finish their chats' queues instead of resubmitting, so nothing queued is lost
+        with self._lock:
+            self._closing = True
+        self._pool.shutdown(wait=wait)
+
+
+def _chat_key(update: object) -> Optional[Hashable]:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat:
+        return update.effective_chat.id
+    if update.effective_user:
+        # inline and pre-checkout queries have no chat; order them per user
+        return ("user", update.effective_user.id)
+    return None
+
+
+class OrderedDispatcher(Dispatcher):
+    """
+    Dispatcher that hands each update to a ChatScheduler instead of processing
+    it inline, so slow handlers in one chat don't hold up other chats.
+    """
+
+    def __init__(self, *args, scheduler: ChatScheduler, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def process_update(self, update: object):
+        key = _chat_key(update)
+        if key is None:
+            super().process_update(update)
+            return
+        # the deadline starts now, so time spent queued behind the chat counts
+        self.scheduler.submit(key, self._process_before, time.monotonic() + UPDATE_DEADLINE, update)
+
+    def _process_before(self, deadline: float, update: object):
+        with deadline_scope(at=deadline):
+            super().process_update(update)
@@ -0,0 +1,105 @@
+# circuit_breaker.py
+import time
+import logging
+import threading
+from collections import deque
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Rolling-window circuit breaker. Calls that raise, return a server error or
+    take longer than `slow_call_seconds` count as failures. When the failure
+    rate over the last `window_seconds` reaches `failure_rate` (with at least
+    `min_calls` samples) the breaker opens and callers fail fast; after
+    `open_seconds` a single trial call is let through (half-open) and its
+    outcome closes or re-opens the breaker.
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, min_calls: int = 5, window_seconds: float = 60,
+                 slow_call_seconds: float = 5, open_seconds: float = 30):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.open_seconds = open_seconds
+
+        self._lock = threading.Lock()
+        self._calls = deque()  # (timestamp, failed)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        metrics.gauge(f"circuit.{name}.state", _STATE_VALUES[CLOSED])
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def _current_state(self, now: float) -> str:
+        if self._state == OPEN and now - self._opened_at >= self.open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning("Circuit %s: %s -> %s", self.name, self._state, state)
+        metrics.incr(f"circuit.{self.name}.transitions.{state}")
+        metrics.gauge(f"circuit.{self.name}.state", _STATE_VALUES[state])
+        self._state = state
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        if state != HALF_OPEN:
+            self._trial_in_flight = False
+        if state == CLOSED:
+            self._calls.clear()
+
+    def allow(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            state = self._current_state(now)
+            if state == CLOSED:
+                return True
+            # a trial that never reported back (e.g. its caller died) stops blocking after open_seconds
+            if state == HALF_OPEN and (not self._trial_in_flight or now - self._trial_started >= self.open_seconds):
+                self._trial_in_flight = True
+                self._trial_started = now
+                return True
+        metrics.incr(f"circuit.{self.name}.rejected")
+        return False
+
+    def release_trial(self):
+        """Ends a call with no verdict; a half-open trial slot goes back for the next caller."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record(self, success: bool, latency: float):
+        failed = not success or latency >= self.slow_call_seconds
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == HALF_OPEN:
+                self._transition(OPEN if failed else CLOSED)
+                return
+            if state == OPEN:
+                return  # a call that started before the breaker opened
+
+            self._calls.append((now, failed))
+            while self._calls and now - self._calls[0][0] > self.window_seconds:
+                self._calls.popleft()
+            total = len(self._calls)
+            failures = sum(1 for _, f in self._calls if f)
+            metrics.gauge(f"circuit.{self.name}.failure_rate", failures / total)
+            if total >= self.min_calls and failures / total >= self.failure_rate:
+                self._transition(OPEN)
@@ -0,0 +1,185 @@
+# coupons.py
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Dict, FrozenSet, Iterable, Optional
+from db import connect, transaction
+from metrics import metrics
+from product_service import MINOR_UNITS
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS coupons (
+    code_hash TEXT PRIMARY KEY,
+    code_hint TEXT NOT NULL,
+    percent_off INTEGER,
+    amount_off_minor INTEGER,
+    currency TEXT,
+    product_ids TEXT,
+    expires_at REAL,
+    max_redemptions INTEGER,
+    per_user_limit INTEGER,
+    redeemed INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS coupon_redemptions (
+    reference TEXT PRIMARY KEY,
+    code_hash TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS coupon_redemptions_user ON coupon_redemptions (code_hash, user_id);
+"""
+
+HELD, COMMITTED, RELEASED = "held", "committed", "released"
+
+
+def code_hash(code: str) -> str:
+    # codes are matched case-insensitively and only their hash is stored
+    return hashlib.sha256(code.strip().upper().encode("utf-8")).hexdigest()
+
+
+class _Rule:
+    """One coupon's eligibility rules, compiled once so a quote is a few comparisons."""
+
+    __slots__ = ("code_hash", "hint", "percent_off", "amount_off_minor", "currency", "product_ids",
+                 "expires_at", "max_redemptions", "per_user_limit")
+
+    def __init__(self, row: Dict[str, Any]):
+        self.code_hash = row["code_hash"]
+        self.hint = row["code_hint"]
+        self.percent_off = row["percent_off"]
+        self.amount_off_minor = row["amount_off_minor"]
+        self.currency = row["currency"]
+        ids = json.loads(row["product_ids"]) if row["product_ids"] else None
+        self.product_ids: Optional[FrozenSet[str]] = frozenset(map(str, ids)) if ids else None
+        self.expires_at = row["expires_at"]
+        self.max_redemptions = row["max_redemptions"]
+        self.per_user_limit = row["per_user_limit"]
+
+    def discount(self, product: Dict, now: float) -> Dict[str, Any]:
+        if product.get("plan_code"):
+            # Paystack bills the plan's own amount; a discount couldn't carry over to renewals
+            return {"ok": False, "error": "not_applicable", "detail": "Codes don't apply to subscriptions."}
+        if self.expires_at is not None and now >= self.expires_at:
+            return {"ok": False, "error": "expired", "detail": "This code has expired."}
+        if self.product_ids is not None and product["id"] not in self.product_ids:
+            return {"ok": False, "error": "not_applicable", "detail": "This code doesn't apply to this product."}
+        amount = product["amount_minor"]
+        if self.percent_off:
+            off = amount * self.percent_off // 100
+        elif self.currency == product["currency"]:
+            off = self.amount_off_minor
+        else:
+            return {"ok": False, "error": "not_applicable", "detail": "This code doesn't apply to this product."}
+        # never below one major unit: Paystack won't take a zero charge
+        new_amount = max(min(amount, MINOR_UNITS[product["currency"]]), amount - off)
+        return {"ok": True, "data": {"amount_minor": new_amount, "discount_minor": amount - new_amount}}
+
+
+class CouponBook:
+    """
+    Promo codes. Rules live in an in-memory dict keyed by code hash, so
+    quoting a price is one lookup with no I/O. Redemptions are counted in
+    SQLite under the payment reference, in the same way stock reservations
+    are: a conditional increment bounded by max_redemptions, a per-user
+    limit checked in the same transaction, released if the payment doesn't
+    happen.
+    """
+
+    def __init__(self):
+        self._rules: Dict[str, _Rule] = {}
+        self._lock = threading.Lock()
+        connect().executescript(SCHEMA)
+
+    def load(self):
+        rules = {row["code_hash"]: _Rule(row) for row in connect().execute("SELECT * FROM coupons")}
+        self._rules = rules
+        logger.info("Loaded %s coupons", len(rules))
+
+    def add(self, code: str, percent_off: Optional[int] = None, amount_off_minor: Optional[int] = None,
+            currency: Optional[str] = None, product_ids: Optional[Iterable[str]] = None,
+            expires_at: Optional[float] = None, max_redemptions: Optional[int] = None,
+            per_user_limit: Optional[int] = None):
+        """Creates or redefines a coupon; its redemption count is kept."""
+        if not (percent_off and 0 < percent_off <= 100) and not (amount_off_minor and amount_off_minor > 0):
+            raise ValueError("a coupon needs percent_off (1-100) or a positive amount_off_minor")
+        code = code.strip().upper()
+        conn = connect()
+        conn.execute(
+            "INSERT INTO coupons (code_hash, code_hint, percent_off, amount_off_minor, currency, product_ids, "
+            "expires_at, max_redemptions, per_user_limit, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(code_hash) DO UPDATE SET code_hint = excluded.code_hint, "
+            "percent_off = excluded.percent_off, amount_off_minor = excluded.amount_off_minor, "
+            "currency = excluded.currency, product_ids = excluded.product_ids, expires_at = excluded.expires_at, "
+            "max_redemptions = excluded.max_redemptions, per_user_limit = excluded.per_user_limit",
+            (code_hash(code), code[:2] + "…", percent_off, amount_off_minor, currency,
+             json.dumps(sorted(product_ids)) if product_ids else None, expires_at, max_redemptions,
+             per_user_limit, time.time()))
+        row = conn.execute("SELECT * FROM coupons WHERE code_hash = ?", (code_hash(code),)).fetchone()
+        with self._lock:
+            self._rules = {**self._rules, row["code_hash"]: _Rule(row)}
+
+    def quote(self, code: str, product: Dict) -> Dict[str, Any]:
+        """The discounted price for this product, from memory only."""
+        rule = self._rules.get(code_hash(code))
+        if rule is None:
+            return {"ok": False, "error": "unknown_code", "detail": "That code isn't valid."}
+        return rule.discount(product, time.time())
+
+    def redeem(self, code: str, reference: str, user_id: int) -> Dict[str, Any]:
+        """Counts one use of the code for this payment, if limits allow. Idempotent per reference."""
+        digest = code_hash(code)
+        rule = self._rules.get(digest)
+        if rule is None:
+            return {"ok": False, "error": "unknown_code", "detail": "That code isn't valid."}
+        conn = connect()
+        with transaction(conn):
+            if conn.execute("SELECT 1 FROM coupon_redemptions WHERE reference = ? AND status != ?",
+                            (reference, RELEASED)).fetchone():
+                return {"ok": True, "data": {}}
+            if rule.per_user_limit is not None:
+                used = conn.execute("SELECT COUNT(*) FROM coupon_redemptions "
+                                    "WHERE code_hash = ? AND user_id = ? AND status != ?",
+                                    (digest, user_id, RELEASED)).fetchone()[0]
+                if used >= rule.per_user_limit:
+                    return {"ok": False, "error": "user_limit", "detail": "You've already used this code."}
+            counted = conn.execute("UPDATE coupons SET redeemed = redeemed + 1 WHERE code_hash = ? "
+                                   "AND (max_redemptions IS NULL OR redeemed < max_redemptions)",
+                                   (digest,)).rowcount
+            if not counted:
+                metrics.incr("coupons.exhausted")
+                return {"ok": False, "error": "exhausted", "detail": "This code has been fully redeemed."}
+            conn.execute("INSERT OR REPLACE INTO coupon_redemptions (reference, code_hash, user_id, status, "
+                         "created_at) VALUES (?, ?, ?, ?, ?)", (reference, digest, user_id, HELD, time.time()))
+        metrics.incr("coupons.redeemed")
+        return {"ok": True, "data": {}}
+
+    def release(self, reference: str) -> bool:
+        """Gives a held use back when its payment fails or expires."""
+        conn = connect()
+        with transaction(conn):
+            released = conn.execute("UPDATE coupon_redemptions SET status = ? WHERE reference = ? AND status = ?",
+                                    (RELEASED, reference, HELD)).rowcount
+            if released:
+                conn.execute("UPDATE coupons SET redeemed = redeemed - 1 WHERE code_hash = "
+                             "(SELECT code_hash FROM coupon_redemptions WHERE reference = ?)", (reference,))
+        return bool(released)
+
+    def commit(self, reference: str) -> bool:
+        """Marks the use final once paid; a late payment re-counts a use that had been released."""
+        conn = connect()
+        with transaction(conn):
+            if conn.execute("UPDATE coupon_redemptions SET status = ? WHERE reference = ? AND status = ?",
+                            (COMMITTED, reference, HELD)).rowcount:
+                return True
+            if not conn.execute("UPDATE coupon_redemptions SET status = ? WHERE reference = ? AND status = ?",
+                                (COMMITTED, reference, RELEASED)).rowcount:
+                return False
+            conn.execute("UPDATE coupons SET redeemed = redeemed + 1 WHERE code_hash = "
+                         "(SELECT code_hash FROM coupon_redemptions WHERE reference = ?)", (reference,))
+        return True
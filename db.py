@@ -0,0 +1,46 @@
+# db.py
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+DB_PATH = os.getenv("BOT_DB_PATH", "bot.db")
+
+_local = threading.local()
+
+
+def connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """
+    Returns this thread's connection to the shared SQLite file. WAL lets the
+    bot and web processes read while one of them writes; busy_timeout makes
+    concurrent writers wait for the lock instead of failing.
+    """
+    path = path or DB_PATH
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    conn = conns.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        conns[path] = conn
+    return conn
+
+
+@contextmanager
+def transaction(conn: sqlite3.Connection):
+    """
+    BEGIN IMMEDIATE ... COMMIT, rolled back on error. Taking the write lock
+    up front keeps conditional updates race-free across processes.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -0,0 +1,77 @@
+# deadline.py
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Optional
+from metrics import metrics
+
+# absolute time.monotonic() by which the current update/webhook must be done
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+MIN_TIMEOUT = float(os.getenv("MIN_OUTBOUND_TIMEOUT", 0.5))  # not worth starting a call with less
+TIMEOUT_P99_MULTIPLIER = float(os.getenv("TIMEOUT_P99_MULTIPLIER", 3))
+MIN_LATENCY_SAMPLES = 20  # below this, observed percentiles are too noisy to trust
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting an outbound call that can no longer finish in time."""
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float] = None, at: Optional[float] = None):
+    """
+    Sets the deadline for everything run inside the block, either `seconds`
+    from now or at the monotonic time `at`. Nested scopes can only tighten it.
+    """
+    deadline = at if at is not None else time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def latency_metric(endpoint: str) -> str:
+    return f"latency.{endpoint}"
+
+
+def adaptive_timeout(endpoint: str, ceiling: float) -> float:
+    """
+    Timeout for one call to `endpoint`: a multiple of its observed p99
+    latency (capped at `ceiling`), further capped by what is left of the
+    current deadline. Raises DeadlineExceeded when less than MIN_TIMEOUT is left.
+    """
+    timeout = ceiling
+    name = latency_metric(endpoint)
+    if metrics.count(name) >= MIN_LATENCY_SAMPLES:
+        p99 = metrics.percentile(name, 0.99)
+        timeout = min(ceiling, max(MIN_TIMEOUT, p99 * TIMEOUT_P99_MULTIPLIER))
+
+    left = remaining()
+    if left is not None:
+        if left < MIN_TIMEOUT:
+            metrics.incr(f"deadline.cancelled.{endpoint}")
+            raise DeadlineExceeded(f"{endpoint}: {max(left, 0):.2f}s left")
+        timeout = min(timeout, left)
+    return timeout
+
+
+def timed_call(endpoint: str, ceiling: float, fn: Callable, *args, **kwargs) -> Any:
+    """
+    Calls fn(*args, timeout=<adaptive timeout>, **kwargs) and records its
+    latency, for outbound calls that take a `timeout` argument (Telegram sends).
+    """
+    timeout = adaptive_timeout(endpoint, ceiling)
+    start = time.monotonic()
+    result = fn(*args, timeout=timeout, **kwargs)
+    metrics.observe(latency_metric(endpoint), time.monotonic() - start)
+    return result
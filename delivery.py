@@ -0,0 +1,210 @@
+# delivery.py
+import os
+import uuid
+import logging
+import requests
+from typing import Dict, Any, List, Optional
+from telegram import Bot
+from telegram.error import BadRequest
+from file_id_cache import FileIdCache
+from deadline import timed_call
+from order_store import OrderStore
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_TIMEOUT = 300  # first upload of a large file can take a while
+TELEGRAM_TIMEOUT = float(os.getenv("TELEGRAM_TIMEOUT", 20))  # ceiling for adaptive send timeouts
+
+file_ids = FileIdCache()
+orders = OrderStore()
+
+
+class _MultipartFileStream:
+    """
+    File-like multipart/form-data body that reads the document from disk in
+    chunks while it is being sent. Exposes __len__ so requests sets a proper
+    Content-Length instead of buffering the whole file.
+    """
+
+    def __init__(self, fields: Dict[str, str], file_field: str, file_path: str):
+        self.boundary = uuid.uuid4().hex
+        self.file_path = file_path
+        head = []
+        for name, value in fields.items():
+            head.append(f"--{self.boundary}\r\n"
+                        f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+                        f"{value}\r\n")
+        filename = os.path.basename(file_path).replace('"', "")
+        head.append(f"--{self.boundary}\r\n"
+                    f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{filename}\"\r\n"
+                    f"Content-Type: application/octet-stream\r\n\r\n")
+        self._head = "".join(head).encode("utf-8")
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+        self._size = len(self._head) + os.path.getsize(file_path) + len(self._tail)
+        self._parts = [self._head, None, self._tail]
+        self._fh = None
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self._size
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = UPLOAD_CHUNK_SIZE
+        while self._parts:
+            part = self._parts[0]
+            if part is None:
+                if self._fh is None:
+                    self._fh = open(self.file_path, "rb")
+                chunk = self._fh.read(size)
+                if chunk:
+                    return chunk
+                self._fh.close()
+                self._parts.pop(0)
+                continue
+            chunk, rest = part[:size], part[size:]
+            if rest:
+                self._parts[0] = rest
+            else:
+                self._parts.pop(0)
+            return chunk
+        return b""
+
+    def close(self):
+        if self._fh is not None and not self._fh.closed:
+            self._fh.close()
+
+
+def _upload_document(bot: Bot, chat_id: int, file_path: str, caption: str) -> Optional[str]:
+    """
+    Streams a local file to Telegram's sendDocument and returns the file_id.
+    Runs once per file, so it keeps its own long timeout rather than the
+    request deadline: cutting it short would only mean uploading again.
+    """
+    body = _MultipartFileStream(
+        {"chat_id": str(chat_id), "caption": caption, "parse_mode": "Markdown"},
+        "document", file_path)
+    try:
+        resp = requests.post(f"https://api.telegram.org/bot{bot.token}/sendDocument",
+                             data=body, headers={"Content-Type": body.content_type},
+                             timeout=UPLOAD_TIMEOUT)
+        result = resp.json()
+    except (requests.RequestException, ValueError):
+        logger.exception("sendDocument upload failed for %s", file_path)
+        return None
+    finally:
+        body.close()
+
+    if not result.get("ok"):
+        logger.error("sendDocument rejected for %s: %s", file_path, result.get("description"))
+        return None
+    return result["result"]["document"]["file_id"]
+
+
+def _send_file(bot: Bot, chat_id: int, file_path: str, caption: str) -> bool:
+    try:
+        content_hash = file_ids.content_hash(file_path)
+    except OSError:
+        logger.exception("Product file %s is not readable", file_path)
+        return False
+
+    file_id = file_ids.get(content_hash)
+    if file_id:
+        try:
+            timed_call("telegram.send", TELEGRAM_TIMEOUT, bot.send_document,
+                       chat_id=chat_id, document=file_id, caption=caption, parse_mode="Markdown")
+            return True
+        except BadRequest:
+            # file_id no longer valid on Telegram's side; upload again below
+            logger.warning("Cached file_id for %s rejected, re-uploading", file_path)
+            file_ids.forget(content_hash, file_id)
+
+    file_id = _upload_document(bot, chat_id, file_path, caption)
+    if not file_id:
+        return False
+    file_ids.set(content_hash, file_id)
+    return True
+
+
+def _line_reference(reference: Optional[str], product: Dict[str, Any]) -> Optional[str]:
+    return f"{reference}/{product['id']}" if reference else None
+
+
+def deliver_product(bot: Bot, chat_id: int, product: Dict[str, Any], reference: Optional[str] = None) -> bool:
+    """
+    Claims the order and sends the purchased product to the buyer. Products
+    carrying a local `file_path` are delivered in-chat as a document;
+    otherwise (or if the upload fails) the `pixeldrain_link` is sent.
+    True once the order is delivered, now or earlier; False if another path
+    is still sending it. A failed send releases the claim and re-raises, so
+    a retry can deliver.
+    """
+    if not orders.claim(chat_id, product, reference):
+        return _claimed_elsewhere(chat_id, reference)
+    caption = f"✅ Payment confirmed for *{product['name']}*."
+    file_path = product.get("file_path")
+    try:
+        if not (file_path and _send_file(bot, chat_id, file_path, caption)):
+            link = product.get("pixeldrain_link", "No link")
+            timed_call("telegram.send", TELEGRAM_TIMEOUT, bot.send_message,
+                       chat_id=chat_id, text=f"{caption}\n\nDownload: {link}", parse_mode="Markdown")
+    except Exception:
+        orders.release(reference)
+        raise
+    orders.mark_delivered(chat_id, product, reference)
+    return True
+
+
+def _claimed_elsewhere(chat_id: int, reference: Optional[str]) -> bool:
+    if orders.delivered(reference):
+        logger.info("Order %s already delivered to user %s", reference, chat_id)
+        return True
+    logger.info("Order %s for user %s is being delivered by another path", reference, chat_id)
+    return False
+
+
+def deliver_products(bot: Bot, chat_id: int, products: List[Dict[str, Any]],
+                     reference: Optional[str] = None) -> bool:
+    """
+    Delivers everything bought in one payment. Documents go one by one (they
+    can't share a message); all download links go out together in a single
+    message. Orders are claimed per line as "<reference>/<product_id>", and
+    only lines not delivered before are sent. Same return and failure
+    contract as deliver_product(), across all lines.
+    """
+    if len(products) == 1:
+        return deliver_product(bot, chat_id, products[0], reference)
+    # claim every line first: whichever path (webhook, retry, bot) claims a line sends it
+    claimed, settled = [], True
+    for product in products:
+        line = _line_reference(reference, product)
+        if orders.claim(chat_id, product, line):
+            claimed.append(product)
+        elif not _claimed_elsewhere(chat_id, line):
+            settled = False
+    unsent = list(claimed)
+    links = []
+    try:
+        for product in claimed:
+            file_path = product.get("file_path")
+            if file_path and _send_file(bot, chat_id, file_path, f"✅ *{product['name']}*"):
+                orders.mark_delivered(chat_id, product, _line_reference(reference, product))
+                unsent.remove(product)
+            else:
+                links.append(product)
+        if links:
+            timed_call("telegram.send", TELEGRAM_TIMEOUT, bot.send_message, chat_id=chat_id,
+                       text=f"✅ Payment confirmed for {len(claimed)} items.\n\n" + "\n".join(
+                           f"• *{p['name']}*: {p.get('pixeldrain_link', 'No link')}" for p in links),
+                       parse_mode="Markdown", disable_web_page_preview=True)
+    except Exception:
+        for product in unsent:
+            orders.release(_line_reference(reference, product))
+        raise
+    for product in links:
+        orders.mark_delivered(chat_id, product, _line_reference(reference, product))
+    return settled
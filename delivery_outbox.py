@@ -0,0 +1,87 @@
+# delivery_outbox.py
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, Iterable, List, Optional
+from db import connect, transaction
+from metrics import metrics
+from order_store import CLAIM_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+QUEUED, DONE, FAILED = "queued", "done", "failed"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS delivery_outbox (
+    reference TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    product_ids TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS delivery_outbox_due ON delivery_outbox (next_attempt_at) WHERE status = '{QUEUED}';
+"""
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 12))
+OUTBOX_RETRY_BASE = 30  # seconds before the first retry, doubled per attempt
+OUTBOX_RETRY_MAX = 3600
+
+
+class DeliveryOutbox:
+    """
+    Paid deliveries that still have to be sent, shared by every process
+    through SQLite. A payment is queued as soon as it is confirmed; the
+    sender claims an entry by pushing its next_attempt_at past the send
+    time, so the webhook's immediate attempt and the bot's retry sweep never
+    send the same entry at once, and an entry whose sender died comes due
+    again. Failed sends back off exponentially up to OUTBOX_MAX_ATTEMPTS.
+    """
+
+    def __init__(self):
+        connect().executescript(SCHEMA)
+
+    def add(self, reference: str, user_id: int, product_ids: Iterable[str]) -> bool:
+        """Idempotent per reference; a webhook retry doesn't queue the payment twice."""
+        now = time.time()
+        return connect().execute(
+            "INSERT OR IGNORE INTO delivery_outbox (reference, user_id, product_ids, status, next_attempt_at, "
+            "created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (reference, int(user_id), json.dumps([str(p) for p in product_ids]), QUEUED, now, now)).rowcount == 1
+
+    def claim(self, reference: str) -> Optional[Dict[str, Any]]:
+        """The entry, if it is due and this caller got it."""
+        now = time.time()
+        conn = connect()
+        with transaction(conn):
+            if conn.execute("UPDATE delivery_outbox SET attempts = attempts + 1, next_attempt_at = ? "
+                            "WHERE reference = ? AND status = ? AND next_attempt_at <= ?",
+                            (now + CLAIM_TIMEOUT, reference, QUEUED, now)).rowcount != 1:
+                return None
+            row = conn.execute("SELECT * FROM delivery_outbox WHERE reference = ?", (reference,)).fetchone()
+        return {**dict(row), "product_ids": json.loads(row["product_ids"])}
+
+    def due(self, limit: int) -> List[str]:
+        rows = connect().execute("SELECT reference FROM delivery_outbox WHERE status = ? AND next_attempt_at <= ? "
+                                 "ORDER BY next_attempt_at LIMIT ?", (QUEUED, time.time(), limit))
+        return [row[0] for row in rows]
+
+    def done(self, reference: str):
+        connect().execute("UPDATE delivery_outbox SET status = ?, last_error = NULL WHERE reference = ?",
+                          (DONE, reference))
+
+    def retry(self, reference: str, attempts: int, error: str) -> bool:
+        """Schedules the next attempt; False once the entry has run out of attempts and is marked failed."""
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            connect().execute("UPDATE delivery_outbox SET status = ?, last_error = ? WHERE reference = ?",
+                              (FAILED, error, reference))
+            metrics.incr("delivery.outbox_failed")
+            return False
+        delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+        connect().execute("UPDATE delivery_outbox SET next_attempt_at = ?, last_error = ? WHERE reference = ?",
+                          (time.time() + delay, error, reference))
+        metrics.incr("delivery.outbox_retries")
+        return True
@@ -0,0 +1,62 @@
+# file_id_cache.py
+import os
+import time
+import hashlib
+import logging
+from typing import Dict, Optional, Tuple
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024  # 1 MiB
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_ids (
+    content_hash TEXT PRIMARY KEY,
+    file_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class FileIdCache:
+    """
+    Map of file content hash (sha256) -> Telegram file_id, shared by the bot
+    and every web worker through SQLite.
+
+    A file is uploaded to Telegram once; every later delivery of the same
+    content, from any process, reuses the returned file_id. Content hashes
+    are memoized per path against (size, mtime) so repeat sends only need a
+    stat, not a re-read.
+    """
+
+    def __init__(self):
+        connect().executescript(SCHEMA)
+        self._digests: Dict[str, Tuple[Tuple[int, int], str]] = {}  # path -> ((size, mtime_ns), sha256)
+
+    def content_hash(self, file_path: str) -> str:
+        st = os.stat(file_path)
+        sig = (st.st_size, st.st_mtime_ns)
+        memo = self._digests.get(file_path)
+        if memo and memo[0] == sig:
+            return memo[1]
+
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        value = digest.hexdigest()
+        self._digests[file_path] = (sig, value)
+        return value
+
+    def get(self, content_hash: str) -> Optional[str]:
+        row = connect().execute("SELECT file_id FROM file_ids WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row["file_id"] if row else None
+
+    def set(self, content_hash: str, file_id: str):
+        connect().execute("INSERT OR REPLACE INTO file_ids (content_hash, file_id, updated_at) VALUES (?, ?, ?)",
+                          (content_hash, file_id, time.time()))
+
+    def forget(self, content_hash: str, file_id: str):
+        # only the id that was rejected: another process may already have stored a fresh one
+        connect().execute("DELETE FROM file_ids WHERE content_hash = ? AND file_id = ?", (content_hash, file_id))
@@ -0,0 +1,188 @@
+# inventory.py
+import os
+import time
+import logging
+from typing import Dict, Iterable, Optional
+from db import connect, transaction
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inventory (
+    product_id TEXT PRIMARY KEY,
+    available INTEGER NOT NULL,
+    catalog_stock INTEGER
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    reference TEXT PRIMARY KEY,
+    product_id TEXT NOT NULL,
+    user_id INTEGER,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_status_expires ON reservations (status, expires_at);
+"""
+
+HELD, COMMITTED, RELEASED = "held", "committed", "released"
+
+# a payment's reservations: the reference itself, or "<reference>/<product_id>" per cart line
+_FOR_PAYMENT = "(reference = :ref OR (reference > :ref || '/' AND reference < :ref || '0'))"
+
+RESERVATION_TTL = float(os.getenv("RESERVATION_TTL", 900))
+RESERVATION_RETENTION = 30 * 86400  # finished reservations are kept this long for support
+
+
+class Inventory:
+    """
+    Stock for limited products, shared by every process through SQLite.
+    Products without an inventory row are unlimited. A unit is taken with a
+    conditional decrement (available > 0) and recorded as a reservation
+    under the payment reference (with a "/<product_id>" suffix per cart
+    line). A payment's reservations are committed when it succeeds, or
+    released (giving the units back) when it fails or expires. Every state change is a conditional UPDATE, so retries and
+    concurrent callers can't double-count.
+    """
+
+    def __init__(self, ttl: float = RESERVATION_TTL):
+        self.ttl = ttl
+        conn = connect()
+        conn.executescript(SCHEMA)
+        if "catalog_stock" not in [row["name"] for row in conn.execute("PRAGMA table_info(inventory)")]:
+            conn.execute("ALTER TABLE inventory ADD COLUMN catalog_stock INTEGER")
+
+    def sync(self, products: Iterable[Dict]):
+        """
+        Applies the catalog's "stock" field, the product's unsold units
+        (held ones included), to live inventory. When that value first
+        appears or changes, the available count is reset to it minus the
+        units held right now; an unchanged value leaves sales and restocks
+        since then alone. Removing the field makes the product unlimited
+        again, unless its row was created by restock() rather than the catalog.
+        """
+        conn = connect()
+        with transaction(conn):
+            for product in products:
+                row = conn.execute("SELECT catalog_stock FROM inventory WHERE product_id = ?",
+                                   (product["id"],)).fetchone()
+                if product.get("stock") in (None, ""):
+                    if row is not None and row["catalog_stock"] is not None:
+                        conn.execute("DELETE FROM inventory WHERE product_id = ?", (product["id"],))
+                    continue
+                stock = int(product["stock"])
+                if row is not None and row["catalog_stock"] == stock:
+                    continue
+                held = conn.execute("SELECT COUNT(*) FROM reservations WHERE product_id = ? AND status = ?",
+                                    (product["id"], HELD)).fetchone()[0]
+                conn.execute("INSERT INTO inventory (product_id, available, catalog_stock) VALUES (?, ?, ?) "
+                             "ON CONFLICT(product_id) DO UPDATE SET available = excluded.available, "
+                             "catalog_stock = excluded.catalog_stock", (product["id"], max(stock - held, 0), stock))
+                logger.info("Stock of %s set to %s from the catalog (%s held)", product["id"], stock, held)
+
+    def available(self, product_id: str) -> Optional[int]:
+        """Units left, or None for an unlimited product."""
+        row = connect().execute("SELECT available FROM inventory WHERE product_id = ?", (product_id,)).fetchone()
+        return None if row is None else row["available"]
+
+    def stock_level(self, product_id: str) -> Optional[int]:
+        """Unsold units including held ones, as the catalog's "stock" counts them; None if unlimited."""
+        row = connect().execute(
+            "SELECT available + (SELECT COUNT(*) FROM reservations r WHERE r.product_id = inventory.product_id "
+            "AND r.status = ?) FROM inventory WHERE product_id = ?", (HELD, product_id)).fetchone()
+        return None if row is None else row[0]
+
+    def restock(self, product_id: str, count: int) -> int:
+        conn = connect()
+        with transaction(conn):
+            conn.execute("INSERT INTO inventory (product_id, available) VALUES (?, ?) "
+                         "ON CONFLICT(product_id) DO UPDATE SET available = available + excluded.available",
+                         (product_id, count))
+            return conn.execute("SELECT available FROM inventory WHERE product_id = ?",
+                                (product_id,)).fetchone()[0]
+
+    def reserve(self, product_id: str, reference: str, user_id: Optional[int] = None) -> bool:
+        """Takes one unit for this payment; False if sold out. Idempotent per reference."""
+        if self.available(product_id) is None:
+            return True  # unlimited: no reservation, and no write lock taken
+        now = time.time()
+        conn = connect()
+        with transaction(conn):
+            existing = conn.execute("SELECT status FROM reservations WHERE reference = ?", (reference,)).fetchone()
+            if existing is not None:
+                return existing["status"] != RELEASED
+            taken = conn.execute("UPDATE inventory SET available = available - 1 "
+                                 "WHERE product_id = ? AND available > 0", (product_id,)).rowcount
+            if not taken:
+                metrics.incr("inventory.sold_out")
+                return False
+            conn.execute("INSERT INTO reservations (reference, product_id, user_id, status, created_at, expires_at) "
+                         "VALUES (?, ?, ?, ?, ?, ?)", (reference, product_id, user_id, HELD, now, now + self.ttl))
+        metrics.incr("inventory.reserved")
+        return True
+
+    def release(self, reference: str) -> bool:
+        """Gives a payment's held units back; True only for the caller that released them."""
+        conn = connect()
+        args = {"ref": reference, "held": HELD, "released": RELEASED}
+        with transaction(conn):
+            conn.execute(
+                "UPDATE inventory SET available = available + (SELECT COUNT(*) FROM reservations r "
+                f"WHERE r.product_id = inventory.product_id AND r.status = :held AND {_FOR_PAYMENT}) "
+                f"WHERE product_id IN (SELECT product_id FROM reservations WHERE status = :held AND {_FOR_PAYMENT})",
+                args)
+            released = conn.execute(f"UPDATE reservations SET status = :released "
+                                    f"WHERE status = :held AND {_FOR_PAYMENT}", args).rowcount
+        if released:
+            metrics.incr("inventory.released", released)
+        return bool(released)
+
+    def commit(self, reference: str) -> bool:
+        """
+        Marks a payment's units sold once it is verified. A payment that
+        lands after its reservations expired still counts: the units are
+        taken again, even if that oversells, because the customer has paid.
+        """
+        conn = connect()
+        args = {"ref": reference, "held": HELD, "released": RELEASED, "committed": COMMITTED}
+        with transaction(conn):
+            committed = conn.execute(f"UPDATE reservations SET status = :committed "
+                                     f"WHERE status = :held AND {_FOR_PAYMENT}", args).rowcount
+            late = conn.execute(f"SELECT product_id FROM reservations WHERE status = :released AND {_FOR_PAYMENT}",
+                                args).fetchall()
+            if late:
+                conn.executemany("UPDATE inventory SET available = available - 1 WHERE product_id = ?",
+                                 [(row["product_id"],) for row in late])
+                conn.execute(f"UPDATE reservations SET status = :committed "
+                             f"WHERE status = :released AND {_FOR_PAYMENT}", args)
+                oversold = conn.execute(
+                    "SELECT product_id, available FROM inventory WHERE available < 0 AND product_id IN (%s)"
+                    % ",".join("?" * len(late)), [row["product_id"] for row in late]).fetchall()
+        if committed:
+            metrics.incr("inventory.committed", committed)
+        if late:
+            metrics.incr("inventory.committed_late", len(late))
+            for row in oversold:
+                metrics.incr("inventory.oversold")
+                logger.warning("Product %s oversold by %s after a late payment (%s)",
+                               row["product_id"], -row["available"], reference)
+        return bool(committed or late)
+
+    def release_expired(self, now: Optional[float] = None) -> int:
+        """Releases every held reservation past its expiry in one transaction."""
+        now = now or time.time()
+        conn = connect()
+        with transaction(conn):
+            conn.execute(
+                "UPDATE inventory SET available = available + (SELECT COUNT(*) FROM reservations r "
+                "WHERE r.product_id = inventory.product_id AND r.status = ? AND r.expires_at <= ?) "
+                "WHERE product_id IN (SELECT product_id FROM reservations WHERE status = ? AND expires_at <= ?)",
+                (HELD, now, HELD, now))
+            released = conn.execute("UPDATE reservations SET status = ? WHERE status = ? AND expires_at <= ?",
+                                    (RELEASED, HELD, now)).rowcount
+            conn.execute("DELETE FROM reservations WHERE status != ? AND expires_at <= ?",
+                         (HELD, now - RESERVATION_RETENTION))
+        if released:
+            metrics.incr("inventory.expired", released)
+            logger.info("Released %s expired reservations", released)
+        return released
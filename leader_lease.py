@@ -0,0 +1,102 @@
+# leader_lease.py
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from typing import Callable, Optional
+from db import connect, transaction
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    holder TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class LeaderLease:
+    """
+    Lease-based leader election on the shared SQLite file. The holder renews
+    the lease every `heartbeat` seconds; anyone may take it over once it has
+    gone `ttl` seconds without a renewal. A holder that can't renew in time
+    steps down before the lease can pass to someone else.
+    """
+
+    def __init__(self, name: str, ttl: Optional[float] = None, heartbeat: Optional[float] = None,
+                 path: Optional[str] = None):
+        self.name = name
+        self.ttl = ttl or float(os.getenv("LEASE_TTL", 10))
+        self.heartbeat = heartbeat or float(os.getenv("LEASE_HEARTBEAT", 3))
+        self.path = path or os.getenv("LEASE_DB_PATH")  # None -> shared bot database
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lost = False
+        self._renewed_at = 0.0
+        self._stop = threading.Event()
+        connect(self.path).executescript(SCHEMA)
+
+    def try_acquire(self) -> bool:
+        """Takes or renews the lease if it is free, expired or already ours."""
+        now = time.time()
+        conn = connect(self.path)
+        try:
+            with transaction(conn):
+                conn.execute(
+                    "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+                    "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+                    (self.name, self.holder, now + self.ttl, now))
+                row = conn.execute("SELECT holder FROM leases WHERE name = ?", (self.name,)).fetchone()
+        except Exception:
+            logger.exception("Lease %s: acquire/renew failed", self.name)
+            return False
+        if row and row["holder"] == self.holder:
+            self._renewed_at = time.monotonic()
+            return True
+        return False
+
+    def wait_until_elected(self):
+        """Blocks as a standby until this process holds the lease."""
+        metrics.gauge(f"lease.{self.name}.leader", 0)
+        logged = False
+        while not self.try_acquire():
+            if not logged:
+                logger.info("Lease %s held by another instance; standing by", self.name)
+                logged = True
+            time.sleep(self.heartbeat)
+        logger.info("Lease %s acquired by %s", self.name, self.holder)
+        metrics.gauge(f"lease.{self.name}.leader", 1)
+        metrics.incr(f"lease.{self.name}.elections")
+
+    def start_heartbeat(self, on_lost: Callable[[], None]):
+        """Renews in the background; calls on_lost once if leadership can't be kept."""
+        def run():
+            while not self._stop.wait(self.heartbeat):
+                if self.try_acquire():
+                    continue
+                # keep trying until just before the lease could be taken over
+                if time.monotonic() - self._renewed_at < self.ttl - self.heartbeat:
+                    continue
+                logger.error("Lease %s lost; stepping down", self.name)
+                self.lost = True
+                metrics.gauge(f"lease.{self.name}.leader", 0)
+                on_lost()
+                return
+
+        threading.Thread(target=run, name=f"lease-{self.name}", daemon=True).start()
+
+    def release(self):
+        self._stop.set()
+        if self.lost:
+            return
+        try:
+            # expire it now so a standby takes over immediately instead of after ttl
+            connect(self.path).execute("UPDATE leases SET expires_at = 0 WHERE name = ? AND holder = ?",
+                                       (self.name, self.holder))
+        except Exception:
+            logger.exception("Lease %s: release failed", self.name)
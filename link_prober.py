@@ -0,0 +1,120 @@
+# link_prober.py
+import os
+import time
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+from requests.adapters import HTTPAdapter
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Status codes meaning "this server doesn't do HEAD", retried as a 1-byte range GET
+HEAD_UNSUPPORTED = {403, 405, 501}
+
+
+class LinkProber:
+    """
+    Periodically checks every product's download link in the background and
+    caches the result per product, so request handlers never probe inline.
+    """
+
+    def __init__(self, product_service, interval: Optional[float] = None,
+                 concurrency: Optional[int] = None, timeout: Optional[float] = None):
+        self.product_service = product_service
+        self.interval = interval or float(os.getenv("LINK_PROBE_INTERVAL", 600))
+        self.concurrency = concurrency or int(os.getenv("LINK_PROBE_CONCURRENCY", 4))
+        self.timeout = timeout or float(os.getenv("LINK_PROBE_TIMEOUT", 10))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._status: Dict[str, Dict[str, Any]] = {}
+        self.health_version = 0  # bumped whenever a product's health flips; keys cached menus
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _request(self, url: str) -> int:
+        resp = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        if resp.status_code not in HEAD_UNSUPPORTED:
+            return resp.status_code
+        resp = self.session.get(url, headers={"Range": "bytes=0-0"}, stream=True,
+                                allow_redirects=True, timeout=self.timeout)
+        resp.close()
+        return resp.status_code
+
+    def probe(self, product: Dict[str, Any]) -> Dict[str, Any]:
+        url = product.get("pixeldrain_link")
+        start = time.monotonic()
+        result = {"ok": True, "status_code": None, "error": None}
+        try:
+            result["status_code"] = self._request(url)
+            result["ok"] = result["status_code"] < 400
+        except requests.RequestException as e:
+            result.update(ok=False, error=str(e))
+        latency = time.monotonic() - start
+        result.update(latency=latency, checked_at=time.time())
+
+        metrics.observe("link_probe.latency", latency)
+        metrics.gauge(f"link_probe.ok.{product['id']}", int(result["ok"]))
+        if not result["ok"]:
+            metrics.incr("link_probe.failures")
+            logger.warning("Download link for product %s looks broken: %s %s",
+                           product["id"], result["status_code"], result["error"])
+        previous = self._status.get(product["id"])
+        self._status[product["id"]] = result
+        if previous is None or previous["ok"] != result["ok"]:
+            self.health_version += 1
+        return result
+
+    def on_catalog_change(self, changed_ids):
+        """Catalog listener: forgets stale results and probes new or edited links right away."""
+        for product_id in changed_ids:
+            self._status.pop(product_id, None)
+        self.health_version += 1
+        products = [p for p in map(self.product_service.get_product, changed_ids)
+                    if p and p.get("pixeldrain_link") and not p.get("file_path")]
+        if products:
+            threading.Thread(target=lambda: list(map(self.probe, products)), name="link-probe-changed",
+                             daemon=True).start()
+
+    def probe_all(self):
+        # products with a local file are delivered in-chat, their link doesn't matter
+        products = [p for p in self.product_service.get_products()
+                    if p.get("pixeldrain_link") and not p.get("file_path")]
+        if not products:
+            return
+        with metrics.timer("link_probe.round"):
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="link-probe") as pool:
+                list(pool.map(self.probe, products))
+        metrics.gauge("link_probe.broken", sum(1 for p in products if not self.is_healthy(p["id"])))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe_all()
+            except Exception:
+                logger.exception("Link probe round failed")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="link-prober", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def status(self, product_id: str) -> Optional[Dict[str, Any]]:
+        return self._status.get(str(product_id))
+
+    def is_healthy(self, product_id: str) -> bool:
+        # products not probed yet are assumed fine
+        status = self._status.get(str(product_id))
+        return status is None or status["ok"]
@@ -0,0 +1,141 @@
+# logging_setup.py
+import os
+import re
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Dict
+
+# payload fields that identify a customer or a card; values are replaced wholesale
+REDACT_KEYS = {
+    "email", "phone", "phonenumber", "partya", "msisdn", "first_name", "last_name", "customer",
+    "authorization", "authorization_code", "signature", "card", "bin", "last4", "account_name",
+    "mobile_money", "otp", "password", "ip_address", "customer_code",
+}
+REDACTED = "[REDACTED]"
+_EMAIL_RE = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+_PHONE_RE = re.compile(r"\+?\b254\d{9}\b|\b0[17]\d{8}\b")
+
+# attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener = None
+
+
+def redact(value: Any, depth: int = 0) -> Any:
+    if depth > 8:
+        return value
+    if isinstance(value, dict):
+        return {k: REDACTED if str(k).lower() in REDACT_KEYS else redact(v, depth + 1) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(redact(v, depth + 1) for v in value)
+    if isinstance(value, str):
+        return _PHONE_RE.sub(REDACTED, _EMAIL_RE.sub(REDACTED, value))
+    return value
+
+
+class RedactingFormatter(logging.Formatter):
+    """Plain-text formatter that redacts message args before interpolating them."""
+
+    def redacted_message(self, record: logging.LogRecord) -> str:
+        args = record.args
+        if isinstance(args, dict):
+            args = redact(args)
+        elif args:
+            args = tuple(redact(a) for a in args)
+        try:
+            message = str(record.msg) % args if args else str(record.msg)
+        except (TypeError, ValueError):
+            message = f"{record.msg} {args}"
+        return redact(message)
+
+    def format(self, record: logging.LogRecord) -> str:
+        clean = logging.makeLogRecord(record.__dict__)
+        clean.msg, clean.args = self.redacted_message(record), None
+        return super().format(clean)
+
+
+class JsonFormatter(RedactingFormatter):
+    """One JSON object per line, with message args and extra fields redacted."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": self.redacted_message(record),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = redact(value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops a share of high-volume records before they are queued. Records
+    logged with extra={"event": name} are kept with the rate configured for
+    that event in LOG_SAMPLE_RATES ("paystack.webhook=0.1,..."); warnings
+    and errors are always kept.
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(getattr(record, "event", None), 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # QueueHandler would format on the caller's thread; leave it to the listener
+        return record
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        name, _, rate = part.partition("=")
+        try:
+            rates[name.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+def setup_logging():
+    """
+    Routes all logging through a queue drained by a background listener, so
+    handlers never format or write on a request thread. Safe to call twice.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(sys.stdout)
+    if os.getenv("LOG_FORMAT", "json") == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(RedactingFormatter("%(levelname)s:%(name)s:%(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    handler = _DeferredQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(_parse_rates(os.getenv("LOG_SAMPLE_RATES", ""))))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
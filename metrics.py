@@ -0,0 +1,121 @@
+# metrics.py
+import json
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+TIMING_WINDOW = 1024  # recent samples kept per timing for percentiles
+
+
+class Metrics:
+    """
+    Tiny in-process metrics registry: counters, gauges and timings.
+    Timings keep a bounded window of recent samples so percentiles can be
+    read cheaply (snapshot, adaptive timeouts, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, Any] = {}
+        self._timings: Dict[str, deque] = defaultdict(lambda: deque(maxlen=TIMING_WINDOW))
+        self._timing_totals: Dict[str, list] = defaultdict(lambda: [0, 0.0])  # name -> [count, sum]
+        self._gauge_callbacks: Dict[str, Callable[[], Any]] = {}
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def gauge(self, name: str, value: Any):
+        with self._lock:
+            self._gauges[name] = value
+
+    def register_gauge(self, name: str, fn: Callable[[], Any]):
+        # evaluated on every snapshot, for values that are cheaper to read than to push
+        with self._lock:
+            self._gauge_callbacks[name] = fn
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self._timings[name].append(seconds)
+            totals = self._timing_totals[name]
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def count(self, name: str) -> int:
+        # samples currently in the window for a timing
+        with self._lock:
+            return len(self._timings.get(name, ()))
+
+    def percentile(self, name: str, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._timings.get(name, ()))
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, max(0, int(round(q * (len(samples) - 1)))))
+        return samples[idx]
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            callbacks = dict(self._gauge_callbacks)
+            names = list(self._timings)
+            totals = {k: list(v) for k, v in self._timing_totals.items()}
+        for name, fn in callbacks.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                logger.exception("Gauge callback %s failed", name)
+        timings = {}
+        for name in names:
+            count, total = totals.get(name, [0, 0.0])
+            timings[name] = {
+                "count": count,
+                "avg": total / count if count else None,
+                "p50": self.percentile(name, 0.50),
+                "p95": self.percentile(name, 0.95),
+                "p99": self.percentile(name, 0.99),
+            }
+        return {"counters": counters, "gauges": gauges, "timings": timings}
+
+
+metrics = Metrics()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = json.dumps(metrics.snapshot(), default=str).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(port: int) -> ThreadingHTTPServer:
+    """
+    Serves the metrics snapshot as JSON for processes without a web app
+    (the polling bot). The web server exposes the same data on /metrics.
+    """
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logger.info("Metrics available on port %s", port)
+    return server
@@ -0,0 +1,171 @@
+# mpesa_handler.py
+import os
+import time
+import base64
+import logging
+import requests
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mpesa_requests (
+    checkout_request_id TEXT PRIMARY KEY,
+    reference TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    product_id TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mpesa_requests_status_created ON mpesa_requests (status, created_at);
+"""
+
+
+class MpesaHandler:
+    """
+    Direct M-Pesa STK push through Safaricom Daraja, used as the fallback
+    payment route while Paystack is unavailable. Pending requests are kept in
+    SQLite so the web process can deliver when Daraja calls back.
+    """
+
+    def __init__(self):
+        self.consumer_key = os.getenv("MPESA_CONSUMER_KEY")
+        self.consumer_secret = os.getenv("MPESA_CONSUMER_SECRET")
+        self.passkey = os.getenv("MPESA_PASSKEY")
+        self.shortcode = os.getenv("MPESA_BUSINESS_SHORTCODE")
+        self.callback_url = os.getenv("MPESA_CALLBACK_URL")
+        self.base_url = os.getenv("MPESA_BASE_URL", "https://api.safaricom.co.ke")
+        self._token = None
+        self._token_expires = 0.0
+        connect().executescript(SCHEMA)
+
+    @property
+    def configured(self) -> bool:
+        return all((self.consumer_key, self.consumer_secret, self.passkey, self.shortcode, self.callback_url))
+
+    def _access_token(self) -> str:
+        # Daraja tokens last an hour; reuse until shortly before expiry
+        if self._token and time.time() < self._token_expires:
+            return self._token
+        resp = requests.get(f"{self.base_url}/oauth/v1/generate?grant_type=client_credentials",
+                            auth=(self.consumer_key, self.consumer_secret), timeout=10)
+        resp.raise_for_status()
+        body = resp.json()
+        self._token = body["access_token"]
+        self._token_expires = time.time() + int(body.get("expires_in", 3599)) - 60
+        return self._token
+
+    def _password(self):
+        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+        return base64.b64encode(f"{self.shortcode}{self.passkey}{timestamp}".encode()).decode(), timestamp
+
+    def stk_push(self, phone: str, product: Dict[str, Any], reference: str, user_id: int) -> Dict[str, Any]:
+        """
+        Sends an M-Pesa PIN prompt to `phone` (+2547XXXXXXXX). Returns
+        {'ok': True, 'data': {'checkout_request_id': ..., 'customer_message': ...}}
+        or {'ok': False, 'error': 'reason', 'detail': ...}
+        """
+        if not self.configured:
+            return {"ok": False, "error": "mpesa_not_configured", "detail": "MPESA_* env vars are not set."}
+        amount_minor = product.get("price_minor", {}).get("KES")
+        if not amount_minor or amount_minor % 100:
+            # M-Pesa only takes whole shillings
+            return {"ok": False, "error": "invalid_price", "detail": f"No whole KES price for {product['id']}"}
+
+        password, timestamp = self._password()
+        msisdn = phone.lstrip("+")
+        payload = {
+            "BusinessShortCode": self.shortcode,
+            "Password": password,
+            "Timestamp": timestamp,
+            "TransactionType": "CustomerPayBillOnline",
+            "Amount": amount_minor // 100,
+            "PartyA": msisdn,
+            "PartyB": self.shortcode,
+            "PhoneNumber": msisdn,
+            "CallBackURL": self.callback_url,
+            # the tail: a time-ordered reference shares its leading characters with its neighbours
+            "AccountReference": reference[-12:],
+            "TransactionDesc": product["name"][:13],
+        }
+        try:
+            resp = requests.post(f"{self.base_url}/mpesa/stkpush/v1/processrequest", json=payload,
+                                 headers={"Authorization": f"Bearer {self._access_token()}"}, timeout=15)
+            body = resp.json()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.exception("M-Pesa STK push HTTP error")
+            return {"ok": False, "error": "http_error", "detail": str(e)}
+
+        if resp.status_code >= 400 or str(body.get("ResponseCode")) != "0":
+            logger.error("M-Pesa STK push failed status=%s body=%s", resp.status_code, body)
+            return {"ok": False, "error": "stk_push_failed", "detail": body.get("errorMessage") or body}
+
+        checkout_request_id = body["CheckoutRequestID"]
+        connect().execute(
+            "INSERT OR REPLACE INTO mpesa_requests (checkout_request_id, reference, user_id, product_id, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (checkout_request_id, reference, int(user_id), product["id"], time.time()))
+        return {"ok": True, "data": {"checkout_request_id": checkout_request_id,
+                                     "customer_message": body.get("CustomerMessage")}}
+
+    def get_request(self, checkout_request_id: str) -> Optional[Dict[str, Any]]:
+        row = connect().execute("SELECT * FROM mpesa_requests WHERE checkout_request_id = ?",
+                                (checkout_request_id,)).fetchone()
+        return dict(row) if row else None
+
+    def query_status(self, checkout_request_id: str) -> Dict[str, Any]:
+        """
+        Asks Daraja (STK push query) how a request ended; callbacks are
+        unauthenticated, so this is what decides delivery. Returns
+        {'ok': True, 'data': {'status': 'paid'|'failed'|'pending', 'detail': ...}}
+        or {'ok': False, 'error': 'reason', 'detail': ...}
+        """
+        if not self.configured:
+            return {"ok": False, "error": "mpesa_not_configured", "detail": "MPESA_* env vars are not set."}
+        password, timestamp = self._password()
+        payload = {"BusinessShortCode": self.shortcode, "Password": password, "Timestamp": timestamp,
+                   "CheckoutRequestID": checkout_request_id}
+        try:
+            resp = requests.post(f"{self.base_url}/mpesa/stkpushquery/v1/query", json=payload,
+                                 headers={"Authorization": f"Bearer {self._access_token()}"}, timeout=15)
+            body = resp.json()
+        except (requests.RequestException, ValueError, KeyError) as e:
+            logger.exception("M-Pesa STK query HTTP error")
+            return {"ok": False, "error": "http_error", "detail": str(e)}
+
+        if "ResultCode" in body and str(body.get("ResponseCode")) == "0":
+            status = "paid" if str(body["ResultCode"]) == "0" else "failed"
+            return {"ok": True, "data": {"status": status, "detail": body.get("ResultDesc")}}
+        if "being processed" in str(body.get("errorMessage", "")).lower():
+            return {"ok": True, "data": {"status": "pending", "detail": body.get("errorMessage")}}
+        logger.error("M-Pesa STK query failed status=%s body=%s", resp.status_code, body)
+        return {"ok": False, "error": "stk_query_failed", "detail": body.get("errorMessage") or body}
+
+    def pending_before(self, cutoff: float, limit: int) -> List[Dict[str, Any]]:
+        """Oldest requests still pending that were pushed before `cutoff`."""
+        rows = connect().execute("SELECT * FROM mpesa_requests WHERE status = 'pending' AND created_at < ? "
+                                 "ORDER BY created_at LIMIT ?", (cutoff, limit))
+        return [dict(row) for row in rows]
+
+    def complete(self, checkout_request_id: str, success: bool) -> Optional[Dict[str, Any]]:
+        """
+        Marks a pending STK request paid or failed. Returns the request row the
+        first time only, so callback retries never deliver twice.
+        """
+        return self._finish(checkout_request_id, "paid" if success else "failed")
+
+    def expire(self, checkout_request_id: str) -> Optional[Dict[str, Any]]:
+        """Gives up on a request Daraja never confirmed either way; first caller only, like complete()."""
+        return self._finish(checkout_request_id, "expired")
+
+    def _finish(self, checkout_request_id: str, status: str) -> Optional[Dict[str, Any]]:
+        conn = connect()
+        cur = conn.execute("UPDATE mpesa_requests SET status = ? WHERE checkout_request_id = ? AND status = 'pending'",
+                           (status, checkout_request_id))
+        if cur.rowcount != 1:
+            return None
+        row = conn.execute("SELECT * FROM mpesa_requests WHERE checkout_request_id = ?",
+                           (checkout_request_id,)).fetchone()
+        return dict(row)
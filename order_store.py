@@ -0,0 +1,106 @@
+# order_store.py
+import os
+import time
+import logging
+from typing import Dict, Any, Iterator, List, Optional
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    reference TEXT UNIQUE,
+    user_id INTEGER NOT NULL,
+    product_id TEXT NOT NULL,
+    amount_minor INTEGER,
+    currency TEXT,
+    status TEXT NOT NULL DEFAULT 'delivered',
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS orders_user_id ON orders (user_id);
+CREATE TABLE IF NOT EXISTS blocked_users (
+    user_id INTEGER PRIMARY KEY,
+    blocked_at REAL NOT NULL
+);
+"""
+
+PENDING, DELIVERED = "pending", "delivered"
+
+# longer than the slowest send (a cold document upload), so only a sender that died loses its claim
+CLAIM_TIMEOUT = float(os.getenv("DELIVERY_CLAIM_TIMEOUT", 900))
+
+
+class OrderStore:
+    """Delivered orders, and buyers who have blocked the bot."""
+
+    def __init__(self):
+        conn = connect()
+        conn.executescript(SCHEMA)
+        # orders tables created before claims were reversible only ever held delivered rows
+        if "status" not in [row["name"] for row in conn.execute("PRAGMA table_info(orders)")]:
+            conn.execute(f"ALTER TABLE orders ADD COLUMN status TEXT NOT NULL DEFAULT '{DELIVERED}'")
+
+    def claim(self, user_id: int, product: Dict[str, Any], reference: Optional[str] = None) -> bool:
+        """
+        Reserves a reference for delivery; True only for the one caller allowed
+        to send it. The claim stays pending until mark_delivered(), and
+        release() hands it back if the send fails. A pending claim older than
+        CLAIM_TIMEOUT belongs to a sender that died and can be taken over.
+        """
+        if reference is None:
+            return True  # nothing to deduplicate on; mark_delivered() records it
+        now = time.time()
+        conn = connect()
+        if conn.execute(
+                "INSERT OR IGNORE INTO orders (reference, user_id, product_id, amount_minor, currency, status, "
+                "created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (reference, int(user_id), str(product["id"]), product.get("amount_minor"), product.get("currency"),
+                 PENDING, now)).rowcount == 1:
+            return True
+        return conn.execute("UPDATE orders SET created_at = ? WHERE reference = ? AND status = ? AND created_at < ?",
+                            (now, reference, PENDING, now - CLAIM_TIMEOUT)).rowcount == 1
+
+    def mark_delivered(self, user_id: int, product: Dict[str, Any], reference: Optional[str] = None):
+        connect().execute(
+            "INSERT INTO orders (reference, user_id, product_id, amount_minor, currency, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(reference) DO UPDATE SET status = excluded.status",
+            (reference, int(user_id), str(product["id"]), product.get("amount_minor"), product.get("currency"),
+             DELIVERED, time.time()))
+
+    def release(self, reference: Optional[str]):
+        """Drops a pending claim after a failed send so a retry can deliver."""
+        if reference is not None:
+            connect().execute("DELETE FROM orders WHERE reference = ? AND status = ?", (reference, PENDING))
+
+    def delivered(self, reference: Optional[str]) -> bool:
+        return reference is not None and connect().execute(
+            "SELECT 1 FROM orders WHERE reference = ? AND status = ?", (reference, DELIVERED)).fetchone() is not None
+
+    def buyers_after(self, user_id: int, limit: int) -> List[int]:
+        """One page of distinct buyer ids above `user_id`, in id order, skipping blocked users."""
+        rows = connect().execute(
+            "SELECT DISTINCT user_id FROM orders WHERE user_id > ? "
+            "AND user_id NOT IN (SELECT user_id FROM blocked_users) ORDER BY user_id LIMIT ?",
+            (int(user_id), limit))
+        return [r[0] for r in rows]
+
+    def iter_buyers(self, after: int = 0, page_size: int = 500) -> Iterator[int]:
+        while True:
+            page = self.buyers_after(after, page_size)
+            if not page:
+                return
+            yield from page
+            after = page[-1]
+
+    def count_buyers(self, after: int = 0) -> int:
+        return connect().execute(
+            "SELECT COUNT(DISTINCT user_id) FROM orders WHERE user_id > ? "
+            "AND user_id NOT IN (SELECT user_id FROM blocked_users)", (int(after),)).fetchone()[0]
+
+    def mark_blocked(self, user_id: int):
+        connect().execute("INSERT OR REPLACE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+                          (int(user_id), time.time()))
+
+    def unmark_blocked(self, user_id: int):
+        connect().execute("DELETE FROM blocked_users WHERE user_id = ?", (int(user_id),))
@@ -1,15 +1,63 @@
 # paystack_handler.py
 import os
+import hmac
+import time
+import hashlib
 import requests
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from product_service import ProductService
+from authorization_store import AuthorizationStore
+from circuit_breaker import CircuitBreaker, OPEN
+from deadline import adaptive_timeout, latency_metric, remaining, DeadlineExceeded, MIN_TIMEOUT, MIN_LATENCY_SAMPLES
+from metrics import metrics
+from retry import RetryBudget, RetryPolicy, hedged_call
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# States a direct /charge can be in. pending/pay_offline mean the customer has
+# a prompt on their phone and we poll; send_otp means an OTP must be submitted.
+CHARGE_SUCCESS = "success"
+CHARGE_FAILED = "failed"
+CHARGE_PENDING = "pending"
+CHARGE_PAY_OFFLINE = "pay_offline"
+CHARGE_SEND_OTP = "send_otp"
+CHARGE_WAITING = {CHARGE_PENDING, CHARGE_PAY_OFFLINE}
+
+CART_PRODUCT_ID = "cart"  # metadata.product_id of a multi-item transaction
+
+MOBILE_MONEY_PROVIDER = os.getenv("PAYSTACK_MOBILE_MONEY_PROVIDER", "mpesa")  # empty disables
+
+PAYSTACK_TIMEOUT = float(os.getenv("PAYSTACK_TIMEOUT", 15))  # ceiling for adaptive timeouts
+GET_ATTEMPTS = int(os.getenv("PAYSTACK_GET_ATTEMPTS", 3))  # for idempotent GETs (verify, charge status)
+HEDGE_GETS = os.getenv("PAYSTACK_HEDGE_GETS", "0") == "1"
+MIN_HEDGE_DELAY = 0.05
+
+# shown as-is while the circuit breaker is open, so callers fail fast
+UNAVAILABLE_MESSAGE = "Card payments are temporarily unavailable. Please try again in a few minutes."
+
+
+class FailFast(requests.RequestException):
+    """Raised by _call when a request is refused before it is sent."""
+    error = "fail_fast"
+
+    def result(self) -> Dict[str, Any]:
+        return {"ok": False, "error": self.error, "detail": str(self)}
+
+
+class PaystackUnavailable(FailFast):
+    """The circuit breaker is open."""
+    error = "paystack_unavailable"
+
+
+class PaystackDeadlineExceeded(FailFast):
+    """Not enough time left in the current update/webhook to finish the call."""
+    error = "deadline_exceeded"
+
 class PaystackHandler:
-    def __init__(self):
+    def __init__(self, product_service: Optional[ProductService] = None):
         self.secret_key = os.getenv("PAYSTACK_SECRET_KEY")
         if not self.secret_key:
             # Don't raise here; let callers handle and show message
@@ -19,11 +67,145 @@ class PaystackHandler:
             "Authorization": f"Bearer {self.secret_key}" if self.secret_key else "",
             "Content-Type": "application/json"
         }
-        self.products = ProductService()
+        self.products = product_service or ProductService()
+        self._customer_codes: Dict[str, str] = {}  # email -> customer_code
+        self.authorizations = AuthorizationStore()
+        self.breaker = CircuitBreaker(
+            "paystack",
+            failure_rate=float(os.getenv("PAYSTACK_BREAKER_FAILURE_RATE", 0.5)),
+            slow_call_seconds=float(os.getenv("PAYSTACK_BREAKER_SLOW_SECONDS", 5)),
+            open_seconds=float(os.getenv("PAYSTACK_BREAKER_OPEN_SECONDS", 30)),
+        )
+        self.retry_policy = RetryPolicy(attempts=GET_ATTEMPTS, budget=RetryBudget())
+        self._hedge_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="paystack-hedge") if HEDGE_GETS else None
+
+    def verify_signature(self, body: bytes, signature: Optional[str]) -> bool:
+        """Checks x-paystack-signature: the HMAC-SHA512 of the raw webhook body under the secret key."""
+        if not self.secret_key or not signature:
+            return False
+        expected = hmac.new(self.secret_key.encode(), body, hashlib.sha512).hexdigest()
+        return hmac.compare_digest(expected, signature)
 
-    def initialize_payment(self, email: str, product_id: str, reference: str, callback_url: str) -> Dict[str, Any]:
+    def available(self) -> bool:
+        return self.breaker.state != OPEN
+
+    def _call(self, method: str, path: str, endpoint: Optional[str] = None, **kwargs) -> requests.Response:
+        # every Paystack request goes through here so the breaker and latency stats see it
+        endpoint = f"paystack.{endpoint or path.strip('/')}"
+        try:
+            timeout = adaptive_timeout(endpoint, PAYSTACK_TIMEOUT)
+        except DeadlineExceeded as e:
+            raise PaystackDeadlineExceeded(str(e))
+        if not self.breaker.allow():
+            raise PaystackUnavailable(UNAVAILABLE_MESSAGE)
+        left = remaining()
+        deadline_bound = left is not None and timeout >= left
+
+        start = time.monotonic()
+        outcome = None  # (success, latency) for the breaker; None means the call says nothing about Paystack
+        try:
+            resp = requests.request(method, f"{self.base_url}{path}", headers=self.headers,
+                                    timeout=timeout, **kwargs)
+            outcome = (resp.status_code < 500, time.monotonic() - start)
+        except requests.Timeout:
+            # a timeout we cut short for the deadline says nothing about Paystack's health
+            if not deadline_bound:
+                outcome = (False, time.monotonic() - start)
+            raise
+        except requests.RequestException:
+            outcome = (False, time.monotonic() - start)
+            raise
+        finally:
+            if outcome is None:
+                # still hand back a half-open trial slot, or the breaker would never close again
+                self.breaker.release_trial()
+            else:
+                self.breaker.record(*outcome)
+        metrics.observe(latency_metric(endpoint), outcome[1])
+        return resp
+
+    def _get_once(self, path: str, endpoint: str) -> requests.Response:
+        if self._hedge_pool is None:
+            return self._call("GET", path, endpoint=endpoint)
+        p95 = metrics.percentile(latency_metric(f"paystack.{endpoint}"), 0.95)
+        if p95 is None or metrics.count(latency_metric(f"paystack.{endpoint}")) < MIN_LATENCY_SAMPLES:
+            return self._call("GET", path, endpoint=endpoint)
+        # a second request after the p95 delay trims the slow tail
+        return hedged_call(lambda: self._call("GET", path, endpoint=endpoint), max(p95, MIN_HEDGE_DELAY),
+                           self._hedge_pool, budget=self.retry_policy.budget, name=f"paystack.{endpoint}")
+
+    def _get_idempotent(self, path: str, endpoint: str) -> requests.Response:
+        """
+        GET with jittered exponential backoff on network errors, 429 and 5xx,
+        limited by the retry budget and the current deadline.
+        """
+        policy = self.retry_policy
+        policy.budget.deposit()
+        for attempt in range(policy.attempts):
+            error, resp = None, None
+            try:
+                resp = self._get_once(path, endpoint)
+                if resp.status_code < 500 and resp.status_code != 429:
+                    return resp
+            except FailFast:
+                raise
+            except requests.RequestException as e:
+                error = e
+
+            delay = policy.backoff(attempt)
+            left = remaining()
+            if (attempt + 1 == policy.attempts or (left is not None and left < delay + MIN_TIMEOUT)
+                    or not policy.budget.withdraw()):
+                break
+            metrics.incr(f"paystack.{endpoint}.retries")
+            logger.warning("Retrying Paystack %s in %.2fs (attempt %s): %s",
+                           endpoint, delay, attempt + 1, error or resp.status_code)
+            time.sleep(delay)
+
+        if error is not None:
+            raise error
+        return resp
+
+    def get_or_create_customer(self, email: str) -> Dict[str, Any]:
+        """
+        Returns {'ok': True, 'data': {'customer_code': ...}} for the Paystack customer
+        with this email, creating it if needed. Codes are cached per email, so this
+        only goes to Paystack once per address.
+        """
+        email = email.strip().lower()
+        if email in self._customer_codes:
+            return {"ok": True, "data": {"customer_code": self._customer_codes[email]}}
+        if not self.secret_key:
+            return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
+
+        try:
+            # Paystack returns the existing customer when the email is already known
+            resp = self._call("POST", "/customer", json={"email": email})
+        except FailFast as e:
+            return e.result()
+        except requests.RequestException as e:
+            logger.exception("Paystack customer HTTP error")
+            return {"ok": False, "error": "http_error", "detail": str(e)}
+
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"raw_text": resp.text}
+
+        if resp.status_code >= 400 or not body.get("status"):
+            logger.error("Paystack customer create failed status=%s body=%s", resp.status_code, body)
+            return {"ok": False, "error": "customer_failed", "detail": body}
+
+        customer_code = body.get("data", {}).get("customer_code")
+        self._customer_codes[email] = customer_code
+        return {"ok": True, "data": {"customer_code": customer_code}}
+
+    def initialize_payment(self, email: str, product_id: str, reference: str, callback_url: str,
+                           metadata: Optional[Dict[str, Any]] = None,
+                           amount_minor: Optional[int] = None) -> Dict[str, Any]:
         """
         Returns either {'ok': True, 'data': {...}} or {'ok': False, 'error': 'reason', 'detail': {...}}
+        amount_minor overrides the catalog price, e.g. after a coupon.
         """
         # Basic checks
         if not self.secret_key:
@@ -37,23 +219,68 @@ class PaystackHandler:
         if not product:
             return {"ok": False, "error": "product_not_found", "detail": f"Product id {product_id} not found."}
 
-        amount = product.get("price")
-        try:
-            amount_smallest = int(round(float(amount) * 100))
-        except Exception as e:
-            return {"ok": False, "error": "invalid_price", "detail": f"Invalid product price: {amount}. error: {e}"}
+        # integer minor units are precomputed and validated when the catalog loads
+        amount_minor = amount_minor or product.get("amount_minor")
+        if not amount_minor:
+            return {"ok": False, "error": "invalid_price", "detail": f"Invalid product price: {product.get('price')}"}
+
+        payload = {
+            "email": email,
+            "amount": amount_minor,
+            "currency": product["currency"],
+            "reference": reference,
+            "callback_url": callback_url,
+            "metadata": {**(metadata or {}), "product_id": product_id}
+        }
+        if product.get("plan_code"):
+            # Paystack charges the plan's amount and creates the subscription once this payment succeeds
+            payload["plan"] = product["plan_code"]
+        return self._initialize(payload)
+
+    def initialize_cart_payment(self, email: str, product_ids: List[str], reference: str, callback_url: str,
+                                metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        One transaction for several products. The ids travel in metadata.items
+        so verify_payment can return every product; custom_fields lists them
+        on the Paystack dashboard. Same result shape as initialize_payment.
+        """
+        if not self.secret_key:
+            return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
+        if not callback_url:
+            return {"ok": False, "error": "missing_callback", "detail": "PAYSTACK_CALLBACK_URL env var is not set."}
+        if not email or "@" not in email:
+            return {"ok": False, "error": "invalid_email", "detail": f"Invalid email: {email}"}
+
+        products = [self.products.get_product(product_id) for product_id in product_ids]
+        missing = [pid for pid, product in zip(product_ids, products) if not product]
+        if missing or not products:
+            return {"ok": False, "error": "product_not_found", "detail": f"Product ids not found: {missing}"}
+        currencies = {product["currency"] for product in products}
+        if len(currencies) > 1:
+            return {"ok": False, "error": "mixed_currencies", "detail": f"Cart mixes {sorted(currencies)}"}
 
         payload = {
             "email": email,
-            "amount": amount_smallest,
+            "amount": sum(product["amount_minor"] for product in products),
+            "currency": currencies.pop(),
             "reference": reference,
             "callback_url": callback_url,
-            "metadata": {"product_id": product_id}
+            "metadata": {
+                **(metadata or {}),
+                "product_id": CART_PRODUCT_ID,
+                "items": [product["id"] for product in products],
+                "custom_fields": [{"display_name": "Item", "variable_name": f"item_{i}",
+                                   "value": f"{product['name']} ({product['price_label']})"}
+                                  for i, product in enumerate(products, start=1)],
+            }
         }
+        return self._initialize(payload)
 
+    def _initialize(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         try:
-            resp = requests.post(f"{self.base_url}/transaction/initialize",
-                                 json=payload, headers=self.headers, timeout=15)
+            resp = self._call("POST", "/transaction/initialize", json=payload)
+        except FailFast as e:
+            return e.result()
         except requests.RequestException as e:
             logger.exception("HTTP request to Paystack failed")
             return {"ok": False, "error": "http_error", "detail": str(e)}
@@ -71,7 +298,8 @@ class PaystackHandler:
 
         # success
         data = body.get("data", {})
-        logger.info("Paystack initialized: reference=%s auth_url=%s", data.get("reference"), data.get("authorization_url"))
+        logger.info("Paystack initialized: reference=%s auth_url=%s", data.get("reference"), data.get("authorization_url"),
+                    extra={"event": "paystack.initialized"})
         return {"ok": True, "data": data}
 
     def verify_payment(self, reference: str) -> Dict[str, Any]:
@@ -82,8 +310,9 @@ class PaystackHandler:
         if not self.secret_key:
             return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
         try:
-            resp = requests.get(f"{self.base_url}/transaction/verify/{reference}",
-                                headers=self.headers, timeout=15)
+            resp = self._get_idempotent(f"/transaction/verify/{reference}", "transaction/verify")
+        except FailFast as e:
+            return e.result()
         except requests.RequestException as e:
             logger.exception("Paystack verify HTTP error")
             return {"ok": False, "error": "http_error", "detail": str(e)}
@@ -101,7 +330,175 @@ class PaystackHandler:
         if data.get("status") != "success":
             return {"ok": False, "error": "not_successful", "detail": data}
 
-        # get product info
-        product_id = data.get("metadata", {}).get("product_id")
+        self._remember_authorization(data)
+
+        # get product info; a cart carries its product ids in metadata.items.
+        # ids no longer in the catalog come back in "missing": paid for, but nothing to deliver
+        metadata = data.get("metadata") or {}
+        product = self.products.get_product(metadata.get("product_id"))
+        items = metadata.get("items") or [metadata.get("product_id")]
+        products = [p for p in map(self.products.get_product, items) if p]
+        missing = [product_id for product_id in items if not self.products.get_product(product_id)]
+        return {"ok": True, "data": {"product": product, "products": products, "missing": missing, "payload": data}}
+
+    def subscription_manage_link(self, subscription_code: str) -> Dict[str, Any]:
+        """
+        A Paystack-hosted page where the subscriber can update their card or
+        cancel: {'ok': True, 'data': {'link': ...}} or an error dict.
+        """
+        if not self.secret_key:
+            return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
+        try:
+            resp = self._get_idempotent(f"/subscription/{subscription_code}/manage/link", "subscription/manage")
+        except FailFast as e:
+            return e.result()
+        except requests.RequestException as e:
+            logger.exception("Paystack manage link HTTP error")
+            return {"ok": False, "error": "http_error", "detail": str(e)}
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"raw_text": resp.text}
+        if resp.status_code >= 400 or not body.get("status"):
+            logger.error("Paystack manage link failed status=%s body=%s", resp.status_code, body)
+            return {"ok": False, "error": "manage_link_failed", "detail": body}
+        return {"ok": True, "data": {"link": (body.get("data") or {}).get("link")}}
+
+    def _remember_authorization(self, data: Dict[str, Any]):
+        # keep reusable cards so returning buyers can pay with one tap
+        user_id = (data.get("metadata") or {}).get("user_id")
+        email = (data.get("customer") or {}).get("email")
+        if not user_id or not email:
+            return
+        try:
+            self.authorizations.save(user_id, email, data.get("authorization") or {})
+        except Exception:
+            logger.exception("Could not store authorization for user %s", user_id)
+
+    def get_saved_authorization(self, user_id: int) -> Optional[Dict[str, Any]]:
+        return self.authorizations.get(user_id)
+
+    def charge_authorization(self, email: str, authorization_code: str, product_id: str, reference: str,
+                             metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Charges a saved card server-side, no redirect. Returns
+        {'ok': True, 'data': {'product': {...}, 'payload': {...}}} once the charge succeeded,
+        or {'ok': False, 'error': 'reason', 'detail': {...}}. error 'charge_unknown'
+        means the card may still be charged (timeout, 5xx, pending): verify the
+        reference before offering another payment.
+        """
+        if not self.secret_key:
+            return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
+
         product = self.products.get_product(product_id)
+        if not product:
+            return {"ok": False, "error": "product_not_found", "detail": f"Product id {product_id} not found."}
+
+        payload = {
+            "email": email,
+            "amount": product["amount_minor"],
+            "currency": product["currency"],
+            "authorization_code": authorization_code,
+            "reference": reference,
+            "metadata": {**(metadata or {}), "product_id": product_id}
+        }
+
+        try:
+            resp = self._call("POST", "/transaction/charge_authorization", json=payload)
+        except FailFast as e:
+            return e.result()  # never sent
+        except requests.RequestException as e:
+            # not idempotent: the request may have reached Paystack before the error
+            logger.exception("Paystack charge_authorization HTTP error")
+            return {"ok": False, "error": "charge_unknown", "detail": str(e)}
+
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"raw_text": resp.text}
+
+        if resp.status_code >= 500:
+            logger.error("Paystack charge_authorization outcome unknown status=%s body=%s", resp.status_code, body)
+            return {"ok": False, "error": "charge_unknown", "detail": body}
+        if resp.status_code >= 400 or not body.get("status"):
+            logger.error("Paystack charge_authorization failed status=%s body=%s", resp.status_code, body)
+            return {"ok": False, "error": "charge_failed", "detail": body}
+
+        data = body.get("data", {})
+        if data.get("status") in ("pending", "processing", "ongoing"):
+            return {"ok": False, "error": "charge_unknown", "detail": data}
+        if data.get("status") != "success":
+            # failed, or the bank wants extra steps (otp/pin/redirect) we can't do in-chat
+            return {"ok": False, "error": "not_successful", "detail": data}
+
+        logger.info("Paystack charged saved card: reference=%s", data.get("reference"),
+                    extra={"event": "paystack.charged"})
         return {"ok": True, "data": {"product": product, "payload": data}}
+
+    def _charge_request(self, method: str, path: str, payload: Optional[Dict[str, Any]] = None,
+                        endpoint: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Shared plumbing for the /charge endpoints. Returns
+        {'ok': True, 'data': {'status': <CHARGE_*>, 'reference', 'display_text', 'payload'}}
+        while the charge is successful or still in progress, {'ok': False, ...} otherwise.
+        """
+        if not self.secret_key:
+            return {"ok": False, "error": "missing_secret_key", "detail": "PAYSTACK_SECRET_KEY env var is not set."}
+        try:
+            if method == "GET":
+                resp = self._get_idempotent(path, endpoint or path.strip("/"))
+            else:
+                resp = self._call(method, path, endpoint=endpoint, json=payload)
+        except FailFast as e:
+            return e.result()
+        except requests.RequestException as e:
+            logger.exception("Paystack %s HTTP error", path)
+            return {"ok": False, "error": "http_error", "detail": str(e)}
+
+        try:
+            body = resp.json()
+        except Exception:
+            body = {"raw_text": resp.text}
+
+        data = body.get("data") or {}
+        status = data.get("status")
+        if resp.status_code >= 400 or not body.get("status") or status == CHARGE_FAILED:
+            logger.error("Paystack %s failed status=%s body=%s", path, resp.status_code, body)
+            return {"ok": False, "error": "charge_failed",
+                    "detail": data.get("gateway_response") or body.get("message") or body}
+        return {"ok": True, "data": {
+            "status": status,
+            "reference": data.get("reference"),
+            "display_text": data.get("display_text") or data.get("message"),
+            "payload": data,
+        }}
+
+    def charge_mobile_money(self, phone: str, product_id: str, reference: str, email: str,
+                            metadata: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Starts a mobile money (M-Pesa) charge directly, so the customer gets the
+        prompt on their phone without visiting the hosted checkout page.
+        """
+        if not MOBILE_MONEY_PROVIDER:
+            return {"ok": False, "error": "mobile_money_disabled", "detail": "PAYSTACK_MOBILE_MONEY_PROVIDER is empty."}
+        product = self.products.get_product(product_id)
+        if not product:
+            return {"ok": False, "error": "product_not_found", "detail": f"Product id {product_id} not found."}
+
+        result = self._charge_request("POST", "/charge", {
+            "email": email,
+            "amount": product["amount_minor"],
+            "currency": product["currency"],
+            "mobile_money": {"phone": phone, "provider": MOBILE_MONEY_PROVIDER},
+            "reference": reference,
+            "metadata": {**(metadata or {}), "product_id": product_id}
+        })
+        if result.get("ok"):
+            result["data"]["product"] = product
+        return result
+
+    def submit_otp(self, otp: str, reference: str) -> Dict[str, Any]:
+        return self._charge_request("POST", "/charge/submit_otp", {"otp": otp, "reference": reference})
+
+    def check_pending_charge(self, reference: str) -> Dict[str, Any]:
+        return self._charge_request("GET", f"/charge/{reference}", endpoint="charge/status")
@@ -0,0 +1,80 @@
+# pending_store.py
+import time
+import logging
+from collections.abc import MutableMapping
+from typing import Dict, Any, Iterator, Optional
+from db import connect
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pending_payments (
+    reference TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    product_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    reminded INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pending_payments_expires_at ON pending_payments (expires_at);
+"""
+
+
+class PendingPayments(MutableMapping):
+    """
+    Hosted-checkout references awaiting the charge.success webhook, shared by
+    the bot and the webhook server through SQLite. Behaves like the dict it
+    replaces (reference -> {user_id, product_id}); entries expire after `ttl`.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        connect().executescript(SCHEMA)
+
+    def __getitem__(self, reference: str) -> Dict[str, Any]:
+        row = connect().execute("SELECT * FROM pending_payments WHERE reference = ?", (reference,)).fetchone()
+        if row is None:
+            raise KeyError(reference)
+        return dict(row)
+
+    def __setitem__(self, reference: str, value: Dict[str, Any]):
+        now = time.time()
+        connect().execute(
+            "INSERT OR REPLACE INTO pending_payments (reference, user_id, product_id, created_at, expires_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (reference, int(value["user_id"]), str(value["product_id"]), now, now + self.ttl))
+
+    def __delitem__(self, reference: str):
+        if not self.discard(reference):
+            raise KeyError(reference)
+
+    def __iter__(self) -> Iterator[str]:
+        for row in connect().execute("SELECT reference FROM pending_payments"):
+            yield row[0]
+
+    def __len__(self) -> int:
+        return connect().execute("SELECT COUNT(*) FROM pending_payments").fetchone()[0]
+
+    def discard(self, reference: str) -> bool:
+        """Removes the entry; True only for the caller that actually removed it."""
+        return connect().execute("DELETE FROM pending_payments WHERE reference = ?", (reference,)).rowcount == 1
+
+    def claim_reminder(self, reference: str) -> Optional[Dict[str, Any]]:
+        """Marks the entry reminded and returns it, once; None if gone or already reminded."""
+        cur = connect().execute("UPDATE pending_payments SET reminded = 1 WHERE reference = ? AND reminded = 0",
+                                (reference,))
+        return self.get(reference) if cur.rowcount == 1 else None
+
+    def superseded(self, entry: Dict[str, Any]) -> bool:
+        """True if the user has started a newer checkout for the same product."""
+        return connect().execute(
+            "SELECT 1 FROM pending_payments WHERE user_id = ? AND product_id = ? AND created_at > ? LIMIT 1",
+            (entry["user_id"], entry["product_id"], entry["created_at"])).fetchone() is not None
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        return connect().execute("DELETE FROM pending_payments WHERE expires_at <= ?",
+                                 (now or time.time(),)).rowcount
+
+    def iter_live(self) -> Iterator[Dict[str, Any]]:
+        for row in connect().execute("SELECT * FROM pending_payments ORDER BY expires_at"):
+            yield dict(row)
@@ -0,0 +1,138 @@
+# product_search.py
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InlineQueryResultArticle, InputTextMessageContent
+from metrics import metrics
+
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class _TrieNode:
+    __slots__ = ("children", "ids")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.ids: Set[str] = set()  # products with a token starting with this node's prefix
+
+
+class SearchIndex:
+    """
+    Immutable index over one catalog version: a prefix trie whose nodes hold
+    every product id reachable below them, so a typeahead prefix costs one
+    walk of len(prefix) steps, plus an exact-token inverted index used for
+    ranking.
+    """
+
+    def __init__(self, products: List[Dict], version: int):
+        self.version = version
+        self.all_ids = [p["id"] for p in products]
+        self.order = {product_id: i for i, product_id in enumerate(self.all_ids)}
+        self.root = _TrieNode()
+        self.name_tokens: Dict[str, Set[str]] = {}  # token -> ids with it in the name
+        for product in products:
+            name_tokens = tokenize(product.get("name", ""))
+            for token in name_tokens:
+                self.name_tokens.setdefault(token, set()).add(product["id"])
+            for token in set(name_tokens + tokenize(product.get("description", ""))):
+                node = self.root
+                node.ids.add(product["id"])
+                for char in token:
+                    node = node.children.setdefault(char, _TrieNode())
+                    node.ids.add(product["id"])
+
+    def _prefix(self, prefix: str) -> Set[str]:
+        node = self.root
+        for char in prefix:
+            node = node.children.get(char)
+            if node is None:
+                return set()
+        return node.ids
+
+    def search(self, query: str) -> List[str]:
+        """Ids of products matching every query token as a prefix, best first."""
+        tokens = tokenize(query)
+        if not tokens:
+            return list(self.all_ids)
+        matches = None
+        for token in sorted(tokens, key=len, reverse=True):  # longest prefix is usually the smallest set
+            found = self._prefix(token)
+            matches = set(found) if matches is None else matches & found
+            if not matches:
+                return []
+
+        name_sets = [self.name_tokens.get(t, ()) for t in tokens]
+
+        def rank(product_id: str) -> Tuple[int, int]:
+            # exact name-token hits first, then catalog order
+            return -sum(product_id in names for names in name_sets), self.order[product_id]
+
+        return sorted(matches, key=rank)
+
+
+class ProductSearch:
+    """
+    Inline-mode search over ProductService. The index is rebuilt lazily when
+    the catalog version changes; finished result lists are kept in a small
+    LRU keyed by (version, query), so repeated typeahead queries cost a dict
+    lookup.
+    """
+
+    def __init__(self, product_service, cache_size: int = 256):
+        self.product_service = product_service
+        self.cache_size = cache_size
+        self._index: Optional[SearchIndex] = None
+        self._cache: "OrderedDict[Tuple[int, str, str], List[InlineQueryResultArticle]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def index(self) -> SearchIndex:
+        index = self._index
+        version = self.product_service.version
+        if index is None or index.version != version:
+            with self._lock:
+                if self._index is None or self._index.version != version:
+                    with metrics.timer("search.index_build"):
+                        self._index = SearchIndex(self.product_service.get_products(), version)
+                    self._cache.clear()
+                index = self._index
+        return index
+
+    def articles(self, query: str, bot_username: str) -> List[InlineQueryResultArticle]:
+        index = self.index()
+        key = (index.version, " ".join(tokenize(query)), bot_username)
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                metrics.incr("search.cache_hit")
+                return cached
+        metrics.incr("search.cache_miss")
+        results = []
+        for product_id in index.search(query):
+            product = self.product_service.get_product(product_id)
+            if product:
+                results.append(self._article(product, bot_username))
+        with self._lock:
+            self._cache[key] = results
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return results
+
+    @staticmethod
+    def _article(product: Dict, bot_username: str) -> InlineQueryResultArticle:
+        # inline messages land in other chats, so buying goes through a buy_ deep link
+        buy_url = f"https://t.me/{bot_username}?start=buy_{product['id']}"
+        return InlineQueryResultArticle(
+            id=str(product["id"]),
+            title=product["name"],
+            description=f"{product['price_label']} — {product.get('description', '')}",
+            input_message_content=InputTextMessageContent(
+                f"*{product['name']}* — {product['price_label']}\n{product.get('description', '')}",
+                parse_mode="Markdown"),
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Buy", url=buy_url)]]),
+        )
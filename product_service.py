@@ -1,7 +1,288 @@
-from typing import Dict, List
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+from db import connect, transaction
 
+logger = logging.getLogger(__name__)
+
+BASE_CURRENCY = os.getenv("CATALOG_CURRENCY", "KES")
+CATALOG_PATH = os.getenv("CATALOG_PATH")  # .json, .jsonl or SQLite (.db/.sqlite); unset -> built-in products
+CATALOG_POLL_INTERVAL = float(os.getenv("CATALOG_POLL_INTERVAL", 5))
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+# computed by prepare_product; never written back to a catalog file
+DERIVED_FIELDS = ("price_minor", "amount_minor", "price_label")
+ID_BLOCK = 50  # product ids reserved from the shared sequence at a time
+
+SEQUENCE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS id_sequences (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+"""
+# minor units per major unit; every currency we sell or display in has 2 decimals
+MINOR_UNITS = {"KES": 100, "USD": 100, "NGN": 100, "GHS": 100}
+
+_fx_rates = None
+
+
+def get_fx_rates() -> Dict[str, Decimal]:
+    """
+    Display-only FX table: units of each currency per 1 BASE_CURRENCY, read
+    once from FX_RATES (JSON, e.g. {"USD": "0.0077", "NGN": "11.9"}) and cached.
+    """
+    global _fx_rates
+    if _fx_rates is None:
+        rates = {}
+        try:
+            raw = json.loads(os.getenv("FX_RATES") or "{}")
+        except ValueError:
+            logger.error("FX_RATES is not valid JSON; showing %s prices only", BASE_CURRENCY)
+            raw = {}
+        for currency, rate in raw.items():
+            currency = currency.upper()
+            try:
+                rate = Decimal(str(rate))
+            except InvalidOperation:
+                logger.error("Ignoring invalid FX rate %s=%r", currency, rate)
+                continue
+            if currency in MINOR_UNITS and currency != BASE_CURRENCY and rate > 0:
+                rates[currency] = rate
+        _fx_rates = rates
+    return _fx_rates
+
+
+def to_minor_units(amount, currency: str) -> int:
+    """
+    Exact major -> minor unit conversion. Raises ValueError for anything that
+    is not a positive amount representable in the currency's minor unit.
+    """
+    if currency not in MINOR_UNITS:
+        raise ValueError(f"unsupported currency {currency}")
+    if isinstance(amount, float):
+        amount = repr(amount)
+    try:
+        value = Decimal(str(amount)) * MINOR_UNITS[currency]
+    except InvalidOperation:
+        raise ValueError(f"invalid price {amount!r}")
+    if not value.is_finite() or value <= 0 or value != value.to_integral_value():
+        raise ValueError(f"invalid price {amount!r} for {currency}")
+    return int(value)
+
+
+def format_minor(amount_minor: int, currency: str) -> str:
+    major, minor = divmod(amount_minor, MINOR_UNITS[currency])
+    if minor:
+        return f"{currency} {major:,}.{minor:02d}"
+    return f"{currency} {major:,}"
+
+
+def prepare_product(product: Dict) -> Dict:
+    """
+    Validates a catalog entry and precomputes its integer prices once:
+    price_minor (per currency), amount_minor/currency (what gets charged)
+    and price_label (what gets shown).
+    """
+    currency = product.get("currency", BASE_CURRENCY)
+    price_minor = {currency: to_minor_units(product["price"], currency)}
+    # explicit per-currency prices win over FX conversions
+    for cur, amount in (product.get("prices") or {}).items():
+        price_minor[cur.upper()] = to_minor_units(amount, cur.upper())
+    if currency == BASE_CURRENCY:
+        for cur, rate in get_fx_rates().items():
+            if cur not in price_minor:
+                converted = (Decimal(price_minor[currency]) * rate).quantize(Decimal(1), ROUND_HALF_UP)
+                price_minor[cur] = max(1, int(converted))
+
+    product["currency"] = currency
+    product["price_minor"] = price_minor
+    product["amount_minor"] = price_minor[currency]
+    label = format_minor(price_minor[currency], currency)
+    others = [format_minor(v, c) for c, v in price_minor.items() if c != currency]
+    if others:
+        label += f" (≈ {', '.join(others)})"
+    product["price_label"] = label
+    return product
+
+
+def _catalog_stat(path: str) -> Tuple:
+    # a SQLite catalog may change only in its WAL until the next checkpoint
+    paths = [path, path + "-wal"] if path.lower().endswith(SQLITE_SUFFIXES) else [path]
+    stat = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stat.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            stat.append(None)
+    return tuple(stat)
+
+
+def read_catalog(path: str) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Reads raw catalog entries and a content hash. JSON may be a list of
+    products, {"products": [...]}, or an {id: product} object; JSONL has one
+    product per line; SQLite needs a `products` table whose columns are
+    product fields ("prices" as JSON text).
+    """
+    if path.lower().endswith(SQLITE_SUFFIXES):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = [{k: v for k, v in dict(r).items() if v is not None}
+                    for r in conn.execute("SELECT * FROM products ORDER BY rowid")]
+        finally:
+            conn.close()
+        for row in rows:
+            if isinstance(row.get("prices"), str):
+                row["prices"] = json.loads(row["prices"])
+        digest = hashlib.sha256(json.dumps(rows, sort_keys=True, default=str).encode()).hexdigest()
+        return digest, rows
+
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    text = raw.decode("utf-8")
+    if path.lower().endswith(".jsonl"):
+        return digest, [json.loads(line) for line in text.splitlines() if line.strip()]
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("products", data)
+    if isinstance(data, dict):
+        data = [{"id": key, **value} for key, value in data.items()]
+    if not isinstance(data, list):
+        raise ValueError("catalog must be a list of products")
+    return digest, data
+
+
+def validate_entry(entry: Any, require_id: bool = True) -> Dict:
+    """
+    Checks one raw catalog entry and returns a prepared copy. Raises
+    ValueError (or TypeError for wrongly typed fields) saying what's wrong.
+    """
+    if not isinstance(entry, dict):
+        raise ValueError("not an object")
+    product = {k: v for k, v in entry.items() if k not in DERIVED_FIELDS}
+    product_id = str(product.get("id") or "").strip()
+    if product_id:
+        if ":" in product_id or "__" in product_id:
+            raise ValueError("id may not contain ':' or '__'")  # callback data and deep-link separators
+        product["id"] = product_id
+    elif require_id:
+        raise ValueError("missing id")
+    else:
+        product.pop("id", None)
+    if not product.get("name"):
+        raise ValueError("missing name")
+    if not product.get("pixeldrain_link") and not product.get("file_path"):
+        raise ValueError("needs pixeldrain_link or file_path")
+    if "price" not in product:
+        raise ValueError("missing price")
+    if isinstance(product.get("prices"), str):
+        product["prices"] = json.loads(product["prices"])
+    if product.get("stock") not in (None, ""):
+        # limited stock; checked here so one bad entry can't break the inventory sync at startup
+        if isinstance(product["stock"], bool) or not str(product["stock"]).strip().isdigit():
+            raise ValueError("stock must be a non-negative integer")
+        product["stock"] = int(str(product["stock"]).strip())
+    else:
+        product.pop("stock", None)
+    if product.get("plan_code"):
+        # a subscription product: Paystack's plan sets the recurring amount, period_days our access window
+        if not str(product["plan_code"]).startswith("PLN_"):
+            raise ValueError("plan_code must be a Paystack plan code (PLN_...)")
+        product["period_days"] = int(product.get("period_days") or 30)
+        if product["period_days"] <= 0:
+            raise ValueError("period_days must be positive")
+    else:
+        product.pop("plan_code", None)
+    return prepare_product(product)
+
+
+def build_catalog(entries: List[Dict[str, Any]]) -> Dict[str, Dict]:
+    """Validates and prepares every entry; raises ValueError listing what's wrong."""
+    products, errors = {}, []
+    for i, entry in enumerate(entries):
+        try:
+            product = validate_entry(entry)
+            if product["id"] in products:
+                raise ValueError(f"duplicate id {product['id']}")
+            products[product["id"]] = product
+        except (ValueError, TypeError, AttributeError) as e:
+            errors.append(f"entry {i} ({entry.get('id') if isinstance(entry, dict) else '?'}): {e}")
+    if errors:
+        raise ValueError(f"{len(errors)} invalid catalog entries: " + "; ".join(errors[:10]))
+    return products
+
+
+def source_fields(product: Dict) -> Dict:
+    """A product as it would appear in a catalog file, without derived fields."""
+    return {k: v for k, v in product.items() if k not in DERIVED_FIELDS}
+
+
+def _write_catalog_file(path: str, products: Iterable[Dict]) -> str:
+    """
+    Streams products to a temp file beside `path` in the same format, then
+    renames it over `path`; readers see the old file or the new one, never
+    a partial write. Returns the sha256 of what was written.
+    """
+    jsonl = path.lower().endswith(".jsonl")
+    digest = hashlib.sha256()
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            def write(text: str):
+                data = text.encode("utf-8")
+                digest.update(data)
+                f.write(data)
+
+            if not jsonl:
+                write("[\n")
+            for i, product in enumerate(products):
+                line = json.dumps(source_fields(product), ensure_ascii=False, default=str)
+                write(f"{line}\n" if jsonl else f"{',' if i else ''}{line}\n")
+            if not jsonl:
+                write("]\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return digest.hexdigest()
+
+
+# Products may also carry an optional "file_path" pointing at a local file.
+# Such products are delivered in-chat as a Telegram document (see delivery.py)
+# instead of sending the pixeldrain link.
 class ProductService:
-    def __init__(self):
+    """
+    The product catalog. With CATALOG_PATH set, products come from that file
+    and a background thread reloads it when its mtime and then its content
+    hash change. A new catalog is validated on that thread and swapped in
+    as a whole, so readers see either the old or the new one; listeners
+    registered with add_listener() then get the set of changed ids.
+    """
+
+    def __init__(self, catalog_path: Optional[str] = None, poll_interval: float = CATALOG_POLL_INTERVAL):
+        self.catalog_path = catalog_path or CATALOG_PATH
+        self.poll_interval = poll_interval
+        self.version = 1  # bumped on every catalog change; derived caches compare against it
+        self._listeners: List[Callable[[Set[str]], None]] = []
+        self._lock = threading.Lock()
+        self._stat = None
+        self._hash = None
+        self._id_lock = threading.Lock()
+        self._reserved_ids = iter(())
+        connect().executescript(SEQUENCE_SCHEMA)
+        if self.catalog_path:
+            self.products: Dict[str, Dict] = {}
+            self.reload()  # an invalid catalog at startup is fatal
+            threading.Thread(target=self._watch, name="catalog-watch", daemon=True).start()
+            return
+
         self.products = {
             "1": {
                 "id": "1",
@@ -25,6 +306,84 @@ class ProductService:
                 "pixeldrain_link": "https://pixeldrain.com/u/your-file-id-3"
             }
         }
+        for product in self.products.values():
+            prepare_product(product)
+
+    def add_listener(self, listener: Callable[[Set[str]], None]):
+        self._listeners.append(listener)
+
+    def _swap(self, products: Dict[str, Dict], changed: Set[str]):
+        self.products = products
+        self.version += 1
+        for listener in self._listeners:
+            try:
+                listener(changed)
+            except Exception:
+                logger.exception("Catalog listener failed")
+
+    def reload(self) -> bool:
+        """Loads the catalog file if it changed; True if a new catalog was swapped in."""
+        with self._lock:
+            stat = _catalog_stat(self.catalog_path)
+            if stat == self._stat:
+                return False
+            digest, entries = read_catalog(self.catalog_path)
+            self._stat = stat
+            if digest == self._hash:
+                return False  # touched, not changed
+            products = build_catalog(entries)
+            old = self.products
+            changed = {pid for pid in old.keys() | products.keys() if old.get(pid) != products.get(pid)}
+            self._hash = digest
+            self._swap(products, changed)
+        logger.info("Catalog v%s loaded from %s: %s products, %s changed",
+                    self.version, self.catalog_path, len(products), len(changed))
+        return True
+
+    def commit(self, products: Dict[str, Dict]) -> Set[str]:
+        """
+        Makes `products` (already prepared) the whole catalog in one swap. A
+        file-backed catalog is rewritten atomically first, so other
+        processes watching the same file pick the change up too.
+        """
+        with self._lock:
+            if self.catalog_path:
+                if self.catalog_path.lower().endswith(SQLITE_SUFFIXES):
+                    raise ValueError("a SQLite catalog is edited through its products table, not rewritten")
+                self._hash = _write_catalog_file(self.catalog_path, products.values())
+                self._stat = _catalog_stat(self.catalog_path)
+            old = self.products
+            changed = {pid for pid in old.keys() | products.keys() if old.get(pid) != products.get(pid)}
+            self._swap(products, changed)
+        return changed
+
+    def allocate_id(self) -> str:
+        """
+        A product id never handed out before, by any process sharing the
+        database, and above every numeric id in the catalog; ids of deleted
+        products are never reused. Reserved from SQLite in blocks of ID_BLOCK.
+        """
+        with self._id_lock:
+            for value in self._reserved_ids:
+                return str(value)
+            floor = max((int(pid) for pid in self.products if pid.isdigit()), default=0) + 1
+            conn = connect()
+            with transaction(conn):
+                conn.execute("INSERT OR IGNORE INTO id_sequences (name, value) VALUES ('products', 1)")
+                current = conn.execute("SELECT value FROM id_sequences WHERE name = 'products'").fetchone()[0]
+                start = max(floor, current)
+                conn.execute("UPDATE id_sequences SET value = ? WHERE name = 'products'", (start + ID_BLOCK,))
+            self._reserved_ids = iter(range(start + 1, start + ID_BLOCK))
+            return str(start)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                # keep serving the last good catalog; retried when the file changes again
+                logger.error("Catalog reload from %s failed: %s", self.catalog_path, e)
 
     def get_products(self) -> List[Dict]:
         return list(self.products.values())
@@ -39,7 +398,9 @@ class ProductService:
         return product["pixeldrain_link"]
 
     def add_product(self, product_data: Dict):
-        new_id = str(len(self.products) + 1)
+        prepare_product(product_data)
+        new_id = self.allocate_id()
         product_data["id"] = new_id
-        self.products[new_id] = product_data
+        with self._lock:
+            self._swap({**self.products, new_id: product_data}, {new_id})
         return new_id
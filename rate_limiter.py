@@ -0,0 +1,57 @@
+# rate_limiter.py
+import time
+import threading
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class TokenBucket:
+    """Blocking token bucket: `rate` operations per second, bursts up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class KeyedRateLimiter:
+    """
+    At most one operation per `min_interval` seconds for each key (e.g. chat).
+    Keys are forgotten once their interval has passed, so memory stays bounded
+    by the number of keys active within one interval.
+    """
+
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._last = OrderedDict()  # key -> monotonic time of last operation, oldest first
+        self._lock = threading.Lock()
+
+    def acquire(self, key: Hashable):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._last:
+                    oldest = next(iter(self._last.values()))
+                    if now - oldest < self.min_interval:
+                        break
+                    self._last.popitem(last=False)
+                last = self._last.get(key)
+                if last is None:
+                    self._last[key] = now
+                    return
+                wait = self.min_interval - (now - last)
+            time.sleep(wait)
@@ -0,0 +1,52 @@
+# references.py
+import os
+import time
+import threading
+
+# Crockford base32: no I, L, O or U, so references survive being read aloud or retyped
+ALPHABET = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+LENGTH = 26  # 10 chars of millisecond timestamp + 16 chars of randomness
+
+_RANDOM_BITS = 80
+_RANDOM_MAX = (1 << _RANDOM_BITS) - 1
+
+_lock = threading.Lock()
+_last_ms = 0
+_last_random = 0
+
+
+def _encode(value: int, length: int) -> str:
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(ALPHABET[digit])
+    return "".join(reversed(chars))
+
+
+def new_reference() -> str:
+    """
+    A 26-character ULID-style payment reference. References sort by creation
+    time, so inserts land at the right edge of any index on them, and they
+    are strictly increasing within this process: a second reference in the
+    same millisecond increments the random part instead of drawing a new one.
+    Only [0-9A-Z] is used, which Paystack accepts in references.
+    """
+    global _last_ms, _last_random
+    with _lock:
+        now_ms = int(time.time() * 1000)
+        if now_ms > _last_ms:
+            _last_ms, _last_random = now_ms, int.from_bytes(os.urandom(10), "big")
+        elif _last_random < _RANDOM_MAX:
+            _last_random += 1
+        else:
+            # randomness exhausted in this millisecond (or the clock went back): borrow the next one
+            _last_ms, _last_random = _last_ms + 1, int.from_bytes(os.urandom(10), "big")
+        return _encode(_last_ms, 10) + _encode(_last_random, 16)
+
+
+def reference_time(reference: str) -> float:
+    """Creation time (epoch seconds) encoded in a reference from new_reference()."""
+    ms = 0
+    for char in reference[:10].upper():
+        ms = ms * 32 + ALPHABET.index(char)
+    return ms / 1000
@@ -0,0 +1,92 @@
+# retry.py
+import time
+import random
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Optional
+from metrics import metrics
+
+
+class RetryBudget:
+    """
+    Caps retries to a fraction of normal traffic so retries can't multiply
+    load on a struggling upstream. Every call deposits `ratio` tokens, every
+    retry (or hedge) spends one; `min_per_second` keeps a trickle available
+    when traffic is low.
+    """
+
+    def __init__(self, ratio: float = 0.2, min_per_second: float = 1.0, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.max_tokens, self._tokens + (now - self._last) * self.min_per_second)
+        self._last = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter: the n-th retry waits a random time
+    in [0, min(max_delay, base_delay * 2**n)].
+    """
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0,
+                 budget: Optional[RetryBudget] = None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+
+    def backoff(self, retry: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+
+def hedged_call(fn: Callable[[], Any], hedge_after: float, executor: ThreadPoolExecutor,
+                budget: Optional[RetryBudget] = None, name: str = "hedge") -> Any:
+    """
+    Runs fn(); if it hasn't returned after `hedge_after` seconds, starts a
+    second identical call and returns whichever finishes first successfully.
+    Only for idempotent calls: the slower one is left to finish in the
+    background and its result is dropped. Context (e.g. the deadline) is
+    carried into the worker threads.
+    """
+    def submit():
+        return executor.submit(contextvars.copy_context().run, fn)
+
+    first = submit()
+    done, _ = wait([first], timeout=hedge_after)
+    if done or (budget is not None and not budget.withdraw()):
+        return first.result()
+
+    metrics.incr(f"{name}.hedged")
+    second = submit()
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    metrics.incr(f"{name}.hedge_won")
+                return future.result()
+            error = future.exception()
+    raise error
@@ -1,30 +1,98 @@
 # server.py
+import io
 import os
+import hmac
 import logging
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, request, jsonify, stream_with_context
 from telegram import Bot
 from paystack_handler import PaystackHandler
-from bot import PENDING_PAYMENTS
+from mpesa_handler import MpesaHandler
+from product_service import ProductService
+from bot import PENDING_PAYMENTS, inventory, coupons, entitlements, outbox, deliver_queued, settle_mpesa_request
+from metrics import metrics
+from deadline import deadline_scope
+from logging_setup import setup_logging
+from catalog_io import import_products, export_products, FORMATS
+from subscriptions import plan_code_of, parse_paystack_time
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 bot = Bot(token=os.getenv("TELEGRAM_BOT_TOKEN"))
-paystack = PaystackHandler()
+products = ProductService()
+paystack = PaystackHandler(products)
+WEBHOOK_DEADLINE = float(os.getenv("WEBHOOK_DEADLINE", 25))  # answer Paystack before it gives up
+# a cold-cache upload can take minutes: paid deliveries are queued in the outbox, acknowledged,
+# then first tried from here; the bot's outbox sweep retries whatever doesn't go out
+deliveries = ThreadPoolExecutor(max_workers=int(os.getenv("DELIVERY_WORKERS", 4)), thread_name_prefix="delivery")
+mpesa = MpesaHandler()
+SUBSCRIPTION_EVENTS = ("subscription.create", "invoice.payment_failed", "subscription.disable",
+                       "subscription.not_renew")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # enables /admin endpoints, sent as "Authorization: Bearer <token>"
 
 @app.route("/", methods=["GET"])
 def index():
     return "OK", 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics_snapshot():
+    return jsonify(metrics.snapshot()), 200
+
+def _is_admin_request() -> bool:
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(request.headers.get("Authorization", ""),
+                                                     f"Bearer {ADMIN_TOKEN}")
+
+@app.route("/admin/catalog/export", methods=["GET"])
+def catalog_export():
+    if not _is_admin_request():
+        return jsonify({"status": "forbidden"}), 403
+    fmt = request.args.get("format", "jsonl")
+    if fmt not in FORMATS:
+        return jsonify({"status": "bad_request", "detail": f"format must be one of {FORMATS}"}), 400
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(export_products(products, fmt, stock_level=inventory.stock_level)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=catalog.{fmt}"})
+
+@app.route("/admin/catalog/import", methods=["POST"])
+def catalog_import():
+    # ?format=csv|jsonl&replace=1&partial=1; the body is streamed, not buffered
+    if not _is_admin_request():
+        return jsonify({"status": "forbidden"}), 403
+    if not products.catalog_path:
+        # the bot process only sees catalog changes through the shared file
+        return jsonify({"status": "conflict", "detail": "set CATALOG_PATH to import products"}), 409
+    fmt = request.args.get("format") or ("csv" if request.mimetype == "text/csv" else "jsonl")
+    if fmt not in FORMATS:
+        return jsonify({"status": "bad_request", "detail": f"format must be one of {FORMATS}"}), 400
+    stream = io.TextIOWrapper(request.stream, encoding="utf-8-sig", newline="")
+    result = import_products(products, stream, fmt, replace=request.args.get("replace") == "1",
+                             partial=request.args.get("partial") == "1")
+    if not result.get("ok"):
+        return jsonify({"status": result["error"], "detail": result["detail"]}), 422
+    return jsonify({"status": "ok", **result["data"]}), 200
+
 @app.route("/paystack-callback", methods=["POST"])
 def paystack_callback():
+    with deadline_scope(WEBHOOK_DEADLINE):
+        return _handle_paystack_callback()
+
+def _handle_paystack_callback():
     try:
+        # every event changes orders or entitlements, so only Paystack-signed bodies are handled
+        if not paystack.verify_signature(request.get_data(), request.headers.get("x-paystack-signature")):
+            logger.warning("Rejected Paystack webhook with a missing or bad signature")
+            metrics.incr("paystack.webhook.bad_signature")
+            return jsonify({"status": "forbidden"}), 401
         payload = request.get_json(force=True)
-        logger.info("Paystack webhook payload: %s", payload)
+        # sampled via LOG_SAMPLE_RATES; customer fields are redacted by the log listener
+        logger.info("Paystack webhook received: %s", payload.get("event"),
+                    extra={"event": "paystack.webhook", "payload": payload})
 
-        # Optional: verify x-paystack-signature header here in production
         event = payload.get("event")
+        if event in SUBSCRIPTION_EVENTS:
+            return _handle_subscription_event(event, payload.get("data") or {})
         if event != "charge.success":
             logger.info("Ignoring event: %s", event)
             return jsonify({"status": "ignored"}), 200
@@ -40,25 +108,98 @@ def paystack_callback():
             logger.error("Webhook verify failed for %s: %s", reference, verify)
             return jsonify({"status": "verify_failed", "detail": verify}), 400
 
+        # verified paid: the reserved unit and coupon use (if any) are final, even without a bot session
+        inventory.commit(reference)
+        coupons.commit(reference)
+
+        paid = verify["data"]["payload"]
+        customer = paid.get("customer") or {}
         pending = PENDING_PAYMENTS.get(reference)
+        # a checkout we started always carries the buyer in metadata, so an expired session still gets delivered
+        user_id = pending["user_id"] if pending else (paid.get("metadata") or {}).get("user_id")
         if not pending:
-            logger.warning("No pending payment for reference %s", reference)
-            # still return 200 to Paystack to avoid retries, but log it
-            return jsonify({"status": "ok", "message": "no_session_found"}), 200
-
-        user_id = pending["user_id"]
-        product = verify["data"]["product"]
-        link = product.get("pixeldrain_link", "No link")
-        bot.send_message(chat_id=user_id,
-                         text=f"✅ Payment confirmed for *{product['name']}*.\n\nDownload: {link}",
-                         parse_mode="Markdown")
-        # remove pending
-        del PENDING_PAYMENTS[reference]
-        return jsonify({"status": "delivered"}), 200
+            plan_code = plan_code_of(paid.get("plan")) or plan_code_of(paid.get("plan_object"))
+            # Paystack starts recurring charges itself, so a renewal never has a bot session
+            if plan_code and entitlements.renew(customer.get("customer_code"), plan_code, reference):
+                return jsonify({"status": "renewed"}), 200
+            if not user_id:
+                logger.warning("No pending payment or buyer for reference %s", reference)
+                # still return 200 to Paystack to avoid retries, but log it
+                return jsonify({"status": "ok", "message": "no_session_found"}), 200
+            logger.info("No pending payment for %s; delivering from the verified metadata", reference)
+
+        user_id = int(user_id)
+        for product in verify["data"]["products"]:
+            if product and product.get("plan_code"):
+                entitlements.grant(user_id, product, reference, customer.get("customer_code"), customer.get("email"))
+        # queued before Paystack hears 200, so a crash or a failed send from here on is retried
+        outbox.add(reference, user_id, [p["id"] for p in verify["data"]["products"]] + verify["data"]["missing"])
+        PENDING_PAYMENTS.discard(reference)
+        deliveries.submit(deliver_queued, bot, reference)
+        return jsonify({"status": "accepted"}), 200
 
     except Exception as e:
         logger.exception("Exception processing Paystack webhook: %s", e)
         return jsonify({"status": "error", "detail": str(e)}), 500
 
+def _handle_subscription_event(event: str, data: dict):
+    subscription_code = data.get("subscription_code") or (data.get("subscription") or {}).get("subscription_code")
+    if not subscription_code:
+        logger.warning("No subscription code in %s webhook", event)
+        return jsonify({"status": "bad_request"}), 400
+    if event == "subscription.create":
+        attached = entitlements.attach((data.get("customer") or {}).get("customer_code"),
+                                       plan_code_of(data.get("plan")), subscription_code, data.get("email_token"),
+                                       parse_paystack_time(data.get("next_payment_date")))
+        if not attached:
+            # its first charge.success hasn't been handled yet; Paystack retries non-2xx webhooks
+            logger.warning("No entitlement yet for subscription %s", subscription_code)
+            return jsonify({"status": "retry"}), 409
+    elif event == "invoice.payment_failed":
+        entitlements.payment_failed(subscription_code)
+    else:
+        entitlements.cancel(subscription_code)
+    # users hear about failures and cancellations from the bot's daily sweep, at a controlled rate
+    return jsonify({"status": "ok"}), 200
+
+@app.route("/mpesa-callback", methods=["POST"])
+def mpesa_callback():
+    # STK push results for checkouts routed to M-Pesa while Paystack was down
+    try:
+        payload = request.get_json(force=True)
+        callback = (payload.get("Body") or {}).get("stkCallback") or {}
+        checkout_request_id = callback.get("CheckoutRequestID")
+        if not checkout_request_id:
+            logger.warning("No CheckoutRequestID in M-Pesa callback")
+            return jsonify({"ResultCode": 0, "ResultDesc": "ignored"}), 200
+
+        request_row = mpesa.get_request(checkout_request_id)
+        if not request_row or request_row["status"] != "pending":
+            logger.info("M-Pesa callback for unknown or finished request %s", checkout_request_id)
+            return jsonify({"ResultCode": 0, "ResultDesc": "ok"}), 200
+
+        # the callback is unauthenticated: it only triggers a status query to Daraja
+        status = mpesa.query_status(checkout_request_id)
+        if not status.get("ok") or status["data"]["status"] == "pending":
+            # Daraja won't call back again; the bot's resolve_mpesa_requests() job re-queries it
+            logger.warning("M-Pesa request %s not confirmed yet: %s", checkout_request_id, status)
+            return jsonify({"ResultCode": 1, "ResultDesc": "unconfirmed"}), 503
+        success = status["data"]["status"] == "paid"
+        if success != (str(callback.get("ResultCode")) == "0"):
+            logger.warning("M-Pesa callback for %s disagrees with Daraja's status %s",
+                           checkout_request_id, status["data"])
+        if success:
+            items = {item.get("Name"): item.get("Value")
+                     for item in (callback.get("CallbackMetadata") or {}).get("Item") or []}
+            logger.info("M-Pesa payment %s confirmed, receipt %s", checkout_request_id, items.get("MpesaReceiptNumber"))
+        if not settle_mpesa_request(bot, checkout_request_id, success, status["data"]["detail"]) or not success:
+            return jsonify({"ResultCode": 0, "ResultDesc": "ok"}), 200
+        deliveries.submit(deliver_queued, bot, request_row["reference"])
+        return jsonify({"ResultCode": 0, "ResultDesc": "accepted"}), 200
+
+    except Exception as e:
+        logger.exception("Exception processing M-Pesa callback: %s", e)
+        return jsonify({"ResultCode": 1, "ResultDesc": "error"}), 500
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=int(os.getenv("PORT", 5000)))
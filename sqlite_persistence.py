@@ -0,0 +1,193 @@
+# sqlite_persistence.py
+import os
+import json
+import pickle
+import logging
+import threading
+from collections import defaultdict
+from typing import Dict, Any, DefaultDict, Optional, Tuple
+from telegram.ext import BasePersistence
+from db import connect, transaction
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+_DELETE = object()  # marks a conversation key whose state should be removed
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Persistence for the bot storing user_data, chat_data, bot_data and
+    conversation states in SQLite, one row per key.
+
+    Updates only mark keys dirty; a background thread coalesces them and
+    writes every `flush_interval` seconds in one transaction, so the cost of
+    a flush depends on what changed, not on how many users exist.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: Optional[float] = None,
+                 store_user_data: bool = True, store_chat_data: bool = True, store_bot_data: bool = True):
+        super().__init__(store_user_data=store_user_data, store_chat_data=store_chat_data,
+                         store_bot_data=store_bot_data)
+        self.path = path or os.getenv("PERSISTENCE_DB_PATH")  # None -> shared bot database
+        self.flush_interval = flush_interval or float(os.getenv("PERSISTENCE_FLUSH_INTERVAL", 5))
+
+        conn = connect(self.path)
+        conn.executescript(SCHEMA)
+
+        self.user_data: Optional[DefaultDict[int, Dict]] = None
+        self.chat_data: Optional[DefaultDict[int, Dict]] = None
+        self.bot_data: Optional[Dict] = None
+        self.conversations: Dict[str, Dict[Tuple, Any]] = {}
+
+        self._lock = threading.Lock()
+        self._dirty_users = set()
+        self._dirty_chats = set()
+        self._dirty_bot = False
+        self._dirty_conversations: Dict[Tuple[str, str], Any] = {}
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="persistence-flush", daemon=True)
+        self._thread.start()
+
+    # ---- loading (called once by the dispatcher at startup) ----
+
+    def _load_rows(self, table: str, key_column: str) -> DefaultDict[int, Dict]:
+        data = defaultdict(dict)
+        for row in connect(self.path).execute(f"SELECT {key_column}, data FROM {table}"):
+            data[row[0]] = pickle.loads(row[1])
+        return data
+
+    def get_user_data(self) -> DefaultDict[int, Dict]:
+        if self.user_data is None:
+            self.user_data = self._load_rows("user_data", "user_id")
+        return self.user_data
+
+    def get_chat_data(self) -> DefaultDict[int, Dict]:
+        if self.chat_data is None:
+            self.chat_data = self._load_rows("chat_data", "chat_id")
+        return self.chat_data
+
+    def get_bot_data(self) -> Dict:
+        if self.bot_data is None:
+            row = connect(self.path).execute("SELECT data FROM bot_data WHERE id = 0").fetchone()
+            self.bot_data = pickle.loads(row[0]) if row else {}
+        return self.bot_data
+
+    def get_conversations(self, name: str) -> Dict[Tuple, Any]:
+        if name not in self.conversations:
+            rows = connect(self.path).execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+            self.conversations[name] = {tuple(json.loads(r[0])): pickle.loads(r[1]) for r in rows}
+        return self.conversations[name]
+
+    # ---- updates (only mark dirty; written by the flush thread) ----
+
+    def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]):
+        conversations = self.conversations.setdefault(name, {})
+        if new_state is None:
+            conversations.pop(key, None)
+        else:
+            conversations[key] = new_state
+        with self._lock:
+            self._dirty_conversations[(name, json.dumps(list(key)))] = _DELETE if new_state is None else new_state
+
+    def update_user_data(self, user_id: int, data: Dict):
+        if self.user_data is None:
+            self.user_data = defaultdict(dict)
+        self.user_data[user_id] = data
+        with self._lock:
+            self._dirty_users.add(user_id)
+
+    def update_chat_data(self, chat_id: int, data: Dict):
+        if self.chat_data is None:
+            self.chat_data = defaultdict(dict)
+        self.chat_data[chat_id] = data
+        with self._lock:
+            self._dirty_chats.add(chat_id)
+
+    def update_bot_data(self, data: Dict):
+        self.bot_data = data
+        with self._lock:
+            self._dirty_bot = True
+
+    # ---- write-behind ----
+
+    def _take_dirty(self):
+        with self._lock:
+            users, self._dirty_users = self._dirty_users, set()
+            chats, self._dirty_chats = self._dirty_chats, set()
+            bot, self._dirty_bot = self._dirty_bot, False
+            convs, self._dirty_conversations = self._dirty_conversations, {}
+        return users, chats, bot, convs
+
+    def _requeue(self, users, chats, bot, convs):
+        with self._lock:
+            self._dirty_users |= users
+            self._dirty_chats |= chats
+            self._dirty_bot = self._dirty_bot or bot
+            for key, state in convs.items():
+                self._dirty_conversations.setdefault(key, state)
+
+    @staticmethod
+    def _dump(source, keys, retry: set):
+        rows = []
+        for key in keys:
+            try:
+                rows.append((key, pickle.dumps(source[key])))
+            except RuntimeError:
+                # dict mutated by a handler while pickling; pick it up next round
+                retry.add(key)
+        return rows
+
+    def _write(self):
+        users, chats, bot, convs = self._take_dirty()
+        if not (users or chats or bot or convs):
+            return
+        retry_users, retry_chats = set(), set()
+        user_rows = self._dump(self.user_data or {}, users, retry_users)
+        chat_rows = self._dump(self.chat_data or {}, chats, retry_chats)
+        conn = connect(self.path)
+        try:
+            with metrics.timer("persistence.flush"), transaction(conn):
+                if user_rows:
+                    conn.executemany("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)", user_rows)
+                if chat_rows:
+                    conn.executemany("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)", chat_rows)
+                if bot:
+                    conn.execute("INSERT OR REPLACE INTO bot_data (id, data) VALUES (0, ?)",
+                                 (pickle.dumps(self.bot_data or {}),))
+                deletes = [k for k, s in convs.items() if s is _DELETE]
+                upserts = [(n, k, pickle.dumps(s)) for (n, k), s in convs.items() if s is not _DELETE]
+                if deletes:
+                    conn.executemany("DELETE FROM conversations WHERE name = ? AND key = ?", deletes)
+                if upserts:
+                    conn.executemany("INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                                     upserts)
+        except Exception:
+            logger.exception("Persistence flush failed; will retry")
+            self._requeue(users, chats, bot, convs)
+            return
+        metrics.incr("persistence.rows_written", len(user_rows) + len(chat_rows) + len(convs) + int(bot))
+        if retry_users or retry_chats:
+            self._requeue(retry_users, retry_chats, False, {})
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._write()
+
+    def flush(self):
+        # called by the updater on shutdown
+        self._stop.set()
+        self._write()
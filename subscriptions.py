@@ -0,0 +1,190 @@
+# subscriptions.py
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from db import connect, transaction
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+ACTIVE, PAST_DUE, CANCELLED, REVOKED = "active", "past_due", "cancelled", "revoked"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS entitlements (
+    user_id INTEGER NOT NULL,
+    product_id TEXT NOT NULL,
+    plan_code TEXT NOT NULL,
+    period_days INTEGER NOT NULL,
+    customer_code TEXT,
+    email TEXT,
+    subscription_code TEXT,
+    email_token TEXT,
+    status TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    notified_for REAL,
+    last_reference TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (user_id, product_id)
+);
+CREATE INDEX IF NOT EXISTS entitlements_live_expires ON entitlements (expires_at) WHERE status != '{REVOKED}';
+CREATE INDEX IF NOT EXISTS entitlements_customer_plan ON entitlements (customer_code, plan_code);
+CREATE INDEX IF NOT EXISTS entitlements_subscription ON entitlements (subscription_code);
+"""
+
+# literal, not a parameter, so SQLite can use the partial index above
+_LIVE = f"status != '{REVOKED}'"
+
+SUBSCRIPTION_GRACE = float(os.getenv("SUBSCRIPTION_GRACE", 3 * 86400))  # late renewals land inside this
+DEFAULT_PERIOD_DAYS = 30
+
+
+def plan_code_of(value: Any) -> Optional[str]:
+    # Paystack sends a plan as its code in some payloads and as an object in others
+    if isinstance(value, dict):
+        return value.get("plan_code")
+    return value or None
+
+
+def parse_paystack_time(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+    except ValueError:
+        return None
+
+
+class Entitlements:
+    """
+    Access to subscription products, one row per (user, product), shared by
+    the bot and web processes through SQLite. The web process grants and
+    extends access from Paystack webhooks. The bot's daily sweep walks the
+    expires_at index in batches: it claims the rows that are due a reminder
+    or past their grace period, then messages them at a controlled rate.
+    """
+
+    def __init__(self, grace: float = SUBSCRIPTION_GRACE):
+        self.grace = grace
+        connect().executescript(SCHEMA)
+
+    def grant(self, user_id: int, product: Dict, reference: str, customer_code: Optional[str] = None,
+              email: Optional[str] = None) -> float:
+        """Starts (or restarts) a subscription after its first payment; returns the new expiry."""
+        period_days = int(product.get("period_days") or DEFAULT_PERIOD_DAYS)
+        now = time.time()
+        conn = connect()
+        with transaction(conn):
+            row = conn.execute("SELECT expires_at, last_reference FROM entitlements "
+                               "WHERE user_id = ? AND product_id = ?", (user_id, product["id"])).fetchone()
+            if row is not None and row["last_reference"] == reference:
+                return row["expires_at"]  # webhook retry
+            # paying again before expiry adds a period rather than losing the days left
+            start = max(now, row["expires_at"]) if row is not None else now
+            expires_at = start + period_days * 86400
+            conn.execute(
+                "INSERT INTO entitlements (user_id, product_id, plan_code, period_days, customer_code, email, "
+                "status, expires_at, last_reference, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, product_id) DO UPDATE SET plan_code = excluded.plan_code, "
+                "period_days = excluded.period_days, customer_code = excluded.customer_code, "
+                "email = excluded.email, subscription_code = NULL, email_token = NULL, status = excluded.status, "
+                "expires_at = excluded.expires_at, notified_for = NULL, last_reference = excluded.last_reference, "
+                "updated_at = excluded.updated_at",
+                (user_id, product["id"], product["plan_code"], period_days, customer_code, email, ACTIVE,
+                 expires_at, reference, now))
+        metrics.incr("subscriptions.granted")
+        return expires_at
+
+    def attach(self, customer_code: str, plan_code: str, subscription_code: str, email_token: Optional[str],
+               next_payment_at: Optional[float]) -> bool:
+        """
+        Links Paystack's subscription to the entitlement its first payment
+        created. False if that payment hasn't been seen yet.
+        """
+        conn = connect()
+        with transaction(conn):
+            row = conn.execute("SELECT user_id, product_id, expires_at FROM entitlements "
+                               "WHERE customer_code = ? AND plan_code = ? AND " + _LIVE +
+                               " AND (subscription_code IS NULL OR subscription_code = ?) "
+                               "ORDER BY updated_at DESC LIMIT 1",
+                               (customer_code, plan_code, subscription_code)).fetchone()
+            if row is None:
+                return False
+            # the webhook is signature-checked, so Paystack's billing date is authoritative
+            expires_at = next_payment_at or row["expires_at"]
+            conn.execute("UPDATE entitlements SET subscription_code = ?, email_token = ?, expires_at = ?, "
+                         "updated_at = ? WHERE user_id = ? AND product_id = ?",
+                         (subscription_code, email_token, expires_at, time.time(), row["user_id"], row["product_id"]))
+        return True
+
+    def renew(self, customer_code: str, plan_code: str, reference: str) -> Optional[Dict[str, Any]]:
+        """Extends access by one period for a recurring charge; idempotent per reference."""
+        now = time.time()
+        conn = connect()
+        with transaction(conn):
+            row = conn.execute("SELECT * FROM entitlements WHERE customer_code = ? AND plan_code = ? "
+                               "ORDER BY updated_at DESC LIMIT 1", (customer_code, plan_code)).fetchone()
+            if row is None:
+                return None
+            if row["last_reference"] == reference:
+                return dict(row)
+            expires_at = max(now, row["expires_at"]) + row["period_days"] * 86400
+            # a renewal also restores access that lapsed or was revoked meanwhile
+            conn.execute("UPDATE entitlements SET status = ?, expires_at = ?, notified_for = NULL, "
+                         "last_reference = ?, updated_at = ? WHERE user_id = ? AND product_id = ?",
+                         (ACTIVE, expires_at, reference, now, row["user_id"], row["product_id"]))
+        metrics.incr("subscriptions.renewed")
+        return {**dict(row), "status": ACTIVE, "expires_at": expires_at}
+
+    def _set_status(self, subscription_code: str, status: str) -> bool:
+        # notified_for is cleared so the next sweep tells the user about the change
+        changed = connect().execute(
+            "UPDATE entitlements SET status = ?, notified_for = NULL, updated_at = ? "
+            "WHERE subscription_code = ? AND " + _LIVE + " AND status != ?",
+            (status, time.time(), subscription_code, status)).rowcount
+        if changed:
+            metrics.incr(f"subscriptions.{status}")
+        return bool(changed)
+
+    def payment_failed(self, subscription_code: str) -> bool:
+        """A renewal charge failed; access continues through the grace period."""
+        return self._set_status(subscription_code, PAST_DUE)
+
+    def cancel(self, subscription_code: str) -> bool:
+        """Paystack won't renew; access lasts until the paid period ends."""
+        return self._set_status(subscription_code, CANCELLED)
+
+    def active(self, user_id: int, product_id: str) -> Optional[Dict[str, Any]]:
+        row = connect().execute("SELECT * FROM entitlements WHERE user_id = ? AND product_id = ? AND " + _LIVE +
+                                " AND expires_at > ?", (user_id, product_id, time.time())).fetchone()
+        return dict(row) if row else None
+
+    def claim_reminders(self, horizon: float, limit: int, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Up to `limit` live entitlements that expire before `horizon` and
+        haven't been notified for their current expiry, marked notified in the
+        same transaction so a restart never sends a reminder twice.
+        """
+        now = now or time.time()
+        conn = connect()
+        with transaction(conn):
+            rows = conn.execute("SELECT * FROM entitlements WHERE " + _LIVE + " AND expires_at >= ? "
+                                "AND expires_at < ? AND (notified_for IS NULL OR notified_for != expires_at) "
+                                "ORDER BY expires_at LIMIT ?", (now - self.grace, horizon, limit)).fetchall()
+            conn.executemany("UPDATE entitlements SET notified_for = expires_at WHERE user_id = ? AND product_id = ?",
+                             [(row["user_id"], row["product_id"]) for row in rows])
+        return [dict(row) for row in rows]
+
+    def claim_lapsed(self, limit: int, now: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Up to `limit` entitlements past expiry plus grace, revoked in the same transaction."""
+        now = now or time.time()
+        conn = connect()
+        with transaction(conn):
+            rows = conn.execute("SELECT * FROM entitlements WHERE " + _LIVE + " AND expires_at < ? "
+                                "ORDER BY expires_at LIMIT ?", (now - self.grace, limit)).fetchall()
+            conn.executemany("UPDATE entitlements SET status = ?, updated_at = ? WHERE user_id = ? AND product_id = ?",
+                             [(REVOKED, now, row["user_id"], row["product_id"]) for row in rows])
+        if rows:
+            metrics.incr("subscriptions.revoked", len(rows))
+        return [dict(row) for row in rows]
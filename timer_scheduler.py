@@ -0,0 +1,89 @@
+# timer_scheduler.py
+import time
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List, Tuple
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TimerScheduler:
+    """
+    One thread and a min-heap of (due, seq, key) for many one-shot timers.
+    Each timer costs one heap entry plus one dict slot; rescheduling or
+    cancelling a key just bumps its sequence number and the stale heap entry
+    is skipped when it surfaces. Due callbacks run on a small worker pool so
+    a slow one never delays the rest. `due` is a wall-clock timestamp, so
+    timers rebuilt from persisted state after a restart keep their deadlines.
+    """
+
+    def __init__(self, name: str = "timers", workers: int = 2):
+        self.name = name
+        self._heap: List[Tuple[float, int, Hashable]] = []
+        self._live: Dict[Hashable, Tuple[int, Callable[[], None]]] = {}
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{name}-cb")
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        metrics.register_gauge(f"{name}.pending", lambda: len(self._live))
+
+    def start(self):
+        self._thread.start()
+
+    def schedule(self, key: Hashable, due: float, callback: Callable[[], None]):
+        """Runs callback at `due` (epoch seconds); replaces any timer already set for key."""
+        with self._cond:
+            self._seq += 1
+            self._live[key] = (self._seq, callback)
+            heapq.heappush(self._heap, (due, self._seq, key))
+            if self._heap[0][1] == self._seq:
+                self._cond.notify()
+
+    def cancel(self, key: Hashable) -> bool:
+        with self._cond:
+            return self._live.pop(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._pool.shutdown(wait=False)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                _, seq, key = heapq.heappop(self._heap)
+                live = self._live.get(key)
+                if live is None or live[0] != seq:
+                    continue  # cancelled or rescheduled
+                del self._live[key]
+                callback = live[1]
+                # drop stale entries when they dominate, so cancelled timers don't pin memory
+                if len(self._heap) > 1024 and len(self._heap) > 2 * len(self._live):
+                    self._heap = [e for e in self._heap if self._live.get(e[2], (None,))[0] == e[1]]
+                    heapq.heapify(self._heap)
+            metrics.incr(f"{self.name}.fired")
+            self._pool.submit(self._fire, key, callback)
+
+    def _fire(self, key: Hashable, callback: Callable[[], None]):
+        try:
+            callback()
+        except Exception:
+            logger.exception("Timer %s failed", key)